@@ -1,7 +1,16 @@
+import argparse
+import datetime
 import os
+import sys
+
+# `python -m Backend` runs this file from the repository's root, but the modules and the paths in the config are
+# relative to the Backend folder. The paths in the arguments are relative to LAUNCH_DIR.
+LAUNCH_DIR = os.getcwd()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 from models.qcsi.mask import mask
-from app import app
+from base.model_registry import model_registry
 from flask_cors import CORS
 
 
@@ -31,9 +40,87 @@ def init_models():
     models_init_file.close()
 
 
-if __name__ == '__main__':
-    mask()
-    init_models()
+def serve(args):
+    if args.production:
+        from base import production_server
+
+        production_server.run(production_server.server_options(args.bind, args.workers, args.threads, args.timeout,
+                                                               args.app), args.app)
+        return
+    if args.app == "cds-hooks":
+        from base import production_server
+        from base.config_manager import table_manager
+
+        cds_hooks = production_server.load_app(args.app)
+        model_registry.preload()
+        table_manager.start()
+        cds_hooks.run(host="0.0.0.0", port=5001, debug=True)
+        return
+
+    from app import app
+    from base.config_manager import table_manager
+
+    model_registry.preload()
+    table_manager.start()
     CORS(app)
     app.debug = True
     app.run()
+
+
+def score_cohort(args):
+    from base.cohort_scoring import score_cohort
+
+    output = os.path.join(LAUNCH_DIR, args.output)
+    count = score_cohort(output,
+                         store_path=None if args.store is None else os.path.join(LAUNCH_DIR, args.store),
+                         export=not args.no_export,
+                         server=args.server,
+                         models=args.model,
+                         default_time=None if args.time is None else datetime.datetime.fromisoformat(args.time),
+                         chunk_size=args.chunk_size,
+                         processes=args.processes)
+    print("{} results are written to {}".format(count, output))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Backend", description="MoCab backend")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="run the API server (default)")
+    serve_parser.add_argument("--production", action="store_true",
+                              help="run the multi-worker gunicorn server instead of the flask debug server")
+    serve_parser.add_argument("--app", choices=["api", "cds-hooks"], default="api",
+                              help="the API (app.py) or the CDS Hooks service (cds-hooks.py) (default: %(default)s)")
+    serve_parser.add_argument("--bind", help="address of the production server (default: config's server BIND, or "
+                                             "CDS_HOOKS_BIND of cds-hooks)")
+    serve_parser.add_argument("--workers", type=int, help="worker processes (default: 2 * number of CPUs + 1)")
+    serve_parser.add_argument("--threads", type=int, help="threads of each worker (default: config's server THREADS)")
+    serve_parser.add_argument("--timeout", type=int,
+                              help="seconds a request may take before its worker is restarted")
+    serve_parser.set_defaults(func=serve)
+
+    cohort_parser = subparsers.add_parser(
+        "score-cohort", help="score every patient of the bulk data server with every model")
+    cohort_parser.add_argument("-o", "--output", default="cohort_scores.parquet",
+                               help="result file, .parquet or .csv (default: %(default)s)")
+    cohort_parser.add_argument("--store", help="feature store directory (default: config's feature_store PATH)")
+    cohort_parser.add_argument("--no-export", action="store_true",
+                               help="score the feature store as it is, without syncing it with the bulk data server")
+    cohort_parser.add_argument("--server", help="bulk data server (default: config's BULK_SERVER_URL)")
+    cohort_parser.add_argument("-m", "--model", action="append",
+                               help="model to score, can be repeated (default: every model)")
+    cohort_parser.add_argument("--time", help="score at this time instead of now, e.g. 2022-01-20T00:00:00")
+    cohort_parser.add_argument("--chunk-size", type=int, help="patients scored together in one process")
+    cohort_parser.add_argument("--processes", type=int, help="worker processes (default: number of CPUs)")
+    cohort_parser.set_defaults(func=score_cohort)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(["serve"])
+    return args
+
+
+if __name__ == '__main__':
+    mask()
+    init_models()
+    arguments = parse_args()
+    arguments.func(arguments)
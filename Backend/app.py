@@ -1,26 +1,31 @@
 import os
 import csv
+import json
 import importlib
 import configparser
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 
 from config import configObject as config
 from flask import Flask
 from flask import jsonify
 from flask import request
 from flask import abort
+from flask import Response
+from flask import stream_with_context
 from flask_cors import CORS
 # TODO: munch可以將dictionary轉成Object，日後可能會用到
 from base import patient_data_search as ds
-from base.feature_table import feature_table
+from base.config_manager import table_manager
 from base.model_input_transformer import transformer
+from base.model_input_transformer import transformer_batch
+from base.model_registry import model_registry
 from models import *
 
 app = Flask(__name__)
 CORS(app)
 
-# Map the csv into dictionary
-table = feature_table
-
 
 @app.route('/', methods=['GET'])
 def index():
@@ -53,17 +58,20 @@ def api_with_id(api):
     if request.values.get('data_alive_time') is not None:
         hour_alive_time = request.values.get('hour_alive_time')
 
+    # The whole request uses one version of the tables, even if they are reloaded meanwhile
+    tables = table_manager.current
     patient_data_dict = ds.model_feature_search_with_patient_id(
-        patient_id, table.get_model_feature_dict(api), None, hour_alive_time)
+        patient_id, tables.feature_table.get_model_feature_dict(api), None, hour_alive_time)
     print(patient_data_dict)
-    patient_data_dict["predict_value"] = return_model_result(patient_data_dict, api)
+    patient_data_dict["predict_value"] = return_model_result(patient_data_dict, api, tables)
     return jsonify(patient_data_dict)
 
 
-def verify_data(patient_data_dict, api):
+def verify_data(patient_data_dict, api, tables=None):
     # MUST HAVE: 1. Keys with each feature. 2. Value with Dict type and has Key with the name "value".
+    tables = tables or table_manager.current
     try:
-        validation_table = table.get_model_feature_dict(api)
+        validation_table = tables.feature_table.get_model_feature_dict(api)
     except KeyError:
         raise KeyError("{} Model is not in the table".format(api))
 
@@ -95,24 +103,206 @@ def api_with_post(api):
         }
     """
     patient_data_dict = request.get_json()
-    verify_data(patient_data_dict, api)
-    patient_data_dict["predict_value"] = return_model_result(patient_data_dict, api)
+    tables = table_manager.current
+    verify_data(patient_data_dict, api, tables)
+    patient_data_dict["predict_value"] = return_model_result(patient_data_dict, api, tables)
     return jsonify(patient_data_dict)
 
 
-def return_model_result(patient_data_dict, api):
+@app.route('/admin/config', methods=['GET'])
+def admin_config():
+    """
+    Description:
+        The active version of the feature and transformation tables, see base/config_manager.py
+    :return: json object
+        {"version": <int>, "digest": <sha256 of the tables>, "loaded_at": ..., "models": [...],
+         "files": {"FEATURE_TABLE": {"path": ..., "modified": ...}, ...},
+         "watching": <bool>, "last_check": ..., "last_error": <the error of the last invalid table> or null}
+    """
+    return jsonify(table_manager.status())
+
+
+@app.route('/batch', methods=['POST'])
+def api_batch():
+    """
+    Description:
+        This api scores many patients and models in one request. The features of the patients are searched
+        concurrently, and the lines are sent as soon as the items are ready: the rows that are ready together are
+        predicted together, at most config['batch']['PREDICT_ROWS'] rows per predict call of a model.
+
+    :param: POST <base>/batch
+        [
+            {"model": <model name>, "id": <patient's id>},
+            {"model": <model name>, "data": {"<feature's name>": {"date": ..., "value": ...}, ...}},
+            ...
+        ]
+    :return: NDJSON stream, one json object per item in the order they are ready, the "index" is the item's position
+             in the request
+        {"index": <int>, "model": <model name>, "id": <patient's id or null>, "predict_value": <int> or <double>,
+         "<feature's name>": {"date": YYYY-MM-DDThh:mm:ss, "value": ...}}
+        or {"index": <int>, "model": <model name>, "id": <patient's id or null>, "error": <message>}
+    """
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(400, description="Please post a list of {\"model\", \"id\" or \"data\"} items.")
+    tables = table_manager.current
+    predict_rows = config['batch']['PREDICT_ROWS']
+
+    def generate():
+        for ready in iter_batch_items(items, tables):
+            rows = dict()
+            for index, patient_data_dict in ready.items():
+                if isinstance(patient_data_dict, Exception):
+                    yield batch_line(index, items[index], error=patient_data_dict)
+                    continue
+                rows.setdefault(items[index]['model'], []).append((index, patient_data_dict))
+
+            for api, model_rows in rows.items():
+                for start in range(0, len(model_rows), predict_rows):
+                    group = model_rows[start:start + predict_rows]
+                    predict_values = return_model_results([patient_data_dict for _, patient_data_dict in group], api,
+                                                          tables)
+                    for (index, patient_data_dict), predict_value in zip(group, predict_values):
+                        if isinstance(predict_value, Exception):
+                            yield batch_line(index, items[index], error=predict_value)
+                            continue
+                        patient_data_dict["predict_value"] = predict_value
+                        yield batch_line(index, items[index], patient_data_dict)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def iter_batch_items(items: list, tables=None):
+    """
+    Get the patient data of every batch item, yields {index: patient data dict, or the exception of the item} of the
+    items that are ready at the same time: first the items with data (and the invalid items), then the patients as
+    their searches complete.
+    Items with patient's id are searched concurrently, the models of the same patient share one search.
+    """
+    tables = tables or table_manager.current
+    ready = dict()
+    patients = dict()
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict) or "model" not in item:
+                raise KeyError("The item has no model.")
+            if "data" in item:
+                verify_data(item["data"], item["model"], tables)
+                ready[index] = item["data"]
+            elif "id" in item:
+                patients.setdefault(item["id"], dict())[index] = item["model"]
+            else:
+                raise KeyError("Please fill in patient's ID or data.")
+        except KeyError as e:
+            ready[index] = e
+    if ready:
+        yield ready
+
+    def search_patient(patient_id, indexes):
+        try:
+            model_tables = {model: tables.feature_table.get_model_feature_dict(model) for model in set(indexes.values())}
+            models_result = ds.models_feature_search_with_patient_id(patient_id, model_tables)
+        except Exception as e:
+            return {index: e for index in indexes}
+        # Every item gets its own copy of the patient data
+        return {index: models_result[model] if isinstance(models_result[model], Exception)
+                else {name: dict(value) for name, value in models_result[model].items()}
+                for index, model in indexes.items()}
+
+    if not patients:
+        return
+    with ThreadPoolExecutor(max_workers=config['feature_search']['MAX_WORKERS']) as executor:
+        pending = {executor.submit(search_patient, patient_id, indexes) for patient_id, indexes in patients.items()}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                ready = dict()
+                for future in done:
+                    ready.update(future.result())
+                yield dict(sorted(ready.items()))
+        finally:
+            # The client may stop reading the stream, the searches not started are not needed anymore
+            for future in pending:
+                future.cancel()
+
+
+def batch_line(index: int, item, patient_data_dict: dict = None, error: Exception = None) -> str:
+    line = {"index": index,
+            "model": item.get("model") if isinstance(item, dict) else None,
+            "id": item.get("id") if isinstance(item, dict) else None}
+    if error is not None:
+        line["error"] = str(error)
+    else:
+        line.update(patient_data_dict)
+    return json.dumps(line, default=str) + "\n"
+
+
+def return_model_result(patient_data_dict, api, tables=None):
     """
         Function return_model_result會對 model執行 predict的動作，回傳 model的結果
         2022-10-10 新增一個新的動作：在丟入Model之前，會先將資料根據ModelFeature Table轉譯成model prefer的category
         TODO: 把return_model_result獨立成一個新的檔案，需要解決的技術難點: globals()[api]
+        Model artifacts are kept in memory by base.model_registry, so predict() won't load the artifact again.
     """
 
     # transfer patient data into model preferred input
-    patient_data_list = transformer(patient_data_dict, api)
+    patient_data_list = transformer(patient_data_dict, api, None if tables is None else tables.transformation_table)
     model_results = globals()[api].predict(patient_data_list)
     return model_results
 
 
+def return_model_results(patient_data_dicts: list, api, tables=None) -> list:
+    """
+    Function return_model_results is the batch version of return_model_result, the patient data are transformed into
+    one 2-D model input by transformer_batch, and the model predicts all the rows with one predict_batch() call.
+    Models without predict_batch() predict the rows one by one.
+    The columns are the features that the model's transformation needs, a row that misses one of them gets a KeyError.
+    If the model can't predict the rows at once, they are predicted one by one, so a bad row only fails itself.
+    :return: the predict value of each row, or the exception of the row
+    """
+    tables = tables or table_manager.current
+    required = tables.transformation_table.get_model_plan(api).required
+    results = [None] * len(patient_data_dicts)
+    complete = []
+    for row, patient_data_dict in enumerate(patient_data_dicts):
+        missing = [name for name in required
+                   if not isinstance(patient_data_dict.get(name), dict) or "value" not in patient_data_dict[name]]
+        if missing:
+            results[row] = KeyError("{} was not given".format(", ".join(missing)))
+        else:
+            complete.append(row)
+    if not complete:
+        return results
+
+    def columns(rows):
+        return {name: [patient_data_dicts[row][name]["value"] for row in rows] for name in required}
+
+    try:
+        predict_values = return_model_column_results(columns(complete), api, tables)
+    except Exception:
+        # One row the model can't predict fails the whole batch, find it by predicting the rows one by one
+        predict_values = []
+        for row in complete:
+            try:
+                predict_values.append(return_model_column_results(columns([row]), api, tables)[0])
+            except Exception as e:
+                predict_values.append(e)
+    for row, predict_value in zip(complete, predict_values):
+        results[row] = predict_value
+    return results
+
+
+def return_model_column_results(patient_data_columns: dict, api, tables=None) -> list:
+    """
+    Same as return_model_results, but the patient data are already in columns, {feature: [value of each patient]}
+    """
+    model_input = transformer_batch(patient_data_columns, api,
+                                    None if tables is None else tables.transformation_table)
+    if hasattr(globals()[api], "predict_batch"):
+        return list(globals()[api].predict_batch(model_input))
+    return [globals()[api].predict(patient_data_list) for patient_data_list in model_input.tolist()]
+
+
 def import_model():
     # TODO: Need to figure out what actions does this function done, and optimize it.
     # get a handle on the module
@@ -133,5 +323,7 @@ import_model()
 
 if __name__ == "__main__":
     print(globals())
+    model_registry.preload()
+    table_manager.start()
     app.debug = True
     app.run()
@@ -1,18 +1,18 @@
+import asyncio
 import json
+import queue
+import threading
 
 from config import configObject as config
-from time import sleep
-from urllib import parse
-from urllib.parse import urljoin
+from typing import Callable
+from typing import Iterator
 
-import ndjson
 import base64
 import jmespath
 import requests
 
 
 # Fixed variables
-COMMAND = '/Patient/$export'
 RESOURCES = [
     "Patient",
     "Group"
@@ -28,6 +28,92 @@ VALID_QUERY_PARAMS = [
 ]
 MANIFEST_URLS = jmespath.compile('output[*].url')
 SERVER_URLS = config['bulk_server']['BULK_SERVER_URL']
+NDJSON_CONTENT_TYPES = ('application/fhir+ndjson', 'application/ndjson', 'application/x-ndjson')
+CHUNK_SIZE = 64 * 1024
+
+
+def new_session() -> requests.Session:
+    session = requests.Session()
+    session.headers = dict(HEADERS)
+    return session
+
+
+class NDJSONStreamDecoder(object):
+    """
+    Decodes a manifest file into resources while its bytes arrive, without holding the whole file in memory.
+
+    The file is either plain NDJSON, or a FHIR Binary resource whose "data" is the base64 encoded NDJSON, e.g.
+        {"resourceType": "Binary", "contentType": "application/fhir+ndjson", "data": "eyJyZXNvdXJjZVR5cGUiOi..."}
+    """
+
+    def __init__(self, base64_encoded: bool):
+        self.base64_encoded = base64_encoded
+        self._in_data = not base64_encoded
+        self._data_ended = False
+        self._raw = b''
+        self._base64 = b''
+        # The partial line after the last newline, it's the only part that's kept between the chunks
+        self._lines = bytearray()
+
+    def feed(self, chunk: bytes) -> Iterator[dict]:
+        if not self.base64_encoded:
+            yield from self._feed_ndjson(chunk)
+            return
+
+        if self._data_ended:
+            return
+        self._raw += chunk
+        if not self._in_data:
+            # Look for the beginning of the "data" string
+            key_position = self._raw.find(b'"data"')
+            if key_position == -1:
+                # Keep the tail in case the key is split between two chunks
+                self._raw = self._raw[-5:]
+                return
+            quote_position = self._raw.find(b'"', key_position + len(b'"data"'))
+            if quote_position == -1:
+                return
+            self._in_data = True
+            self._raw = self._raw[quote_position + 1:]
+
+        end_position = self._raw.find(b'"')
+        if end_position != -1:
+            self._data_ended = True
+            data, self._raw = self._raw[:end_position], b''
+        elif self._raw.endswith(b'\\'):
+            # Keep the backslash until the escaped character arrives
+            data, self._raw = self._raw[:-1], b'\\'
+        else:
+            data, self._raw = self._raw, b''
+        # Undo the JSON escapes ("\/", "\n") that some servers put in the base64 string
+        self._base64 += data.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+
+        decodable_length = len(self._base64) - len(self._base64) % 4
+        decoded = base64.b64decode(self._base64[:decodable_length])
+        self._base64 = self._base64[decodable_length:]
+        yield from self._feed_ndjson(decoded)
+
+    def _feed_ndjson(self, data: bytes) -> Iterator[dict]:
+        # Only the new bytes are searched for newlines, a long line split over many chunks is not scanned again
+        start, end = 0, data.find(b'\n')
+        while end != -1:
+            if self._lines:
+                self._lines += data[start:end]
+                line, self._lines = self._lines, bytearray()
+            else:
+                line = data[start:end]
+            if line.strip():
+                yield json.loads(line)
+            start, end = end + 1, data.find(b'\n', end + 1)
+        self._lines += data[start:]
+
+    def close(self) -> Iterator[dict]:
+        if self._base64:
+            yield from self._feed_ndjson(base64.b64decode(self._base64))
+            self._base64 = b''
+        if self._lines.strip():
+            yield json.loads(self._lines)
+        self._lines = bytearray()
 
 
 class BulkDataClient(object):
@@ -41,8 +127,7 @@ class BulkDataClient(object):
             self,
             server=SERVER_URLS):
         self.server = server
-        self.session = requests.Session()
-        self.session.headers = HEADERS
+        self.session = new_session()
 
     def __enter__(self):
         return self
@@ -50,47 +135,123 @@ class BulkDataClient(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.session.close()
 
-    def _issue(self, url, **params):
-        response = self.session.get(url, params=params, timeout=30)
+    def _issue(self, url, stream=False, session: requests.Session = None, **params):
+        response = (session or self.session).get(url, params=params, timeout=30, stream=stream)
         response.raise_for_status()
         return response
 
     def provision(self, compartment=None, **query_params):
-        # TODO 3 options: /$export, /Group/[id]/$export, /Patient/$export
-        params = {
-            k: v for (k, v) in query_params.items()
-            if k in VALID_QUERY_PARAMS
-        }
-        response = self._issue(self.server + COMMAND, **params)
-        content = response.headers.get('Content-Location')
-        # NOTE `content` should be an absolute URL, but we're being kind :)
+        """
+        Run one export job and keep its manifest, see base.bulk_export for running several jobs at once.
+        :param compartment: None or "Patient" (/Patient/$export), "Group/[id]" (/Group/[id]/$export) or "system" ($export)
+        """
+        from base.bulk_export import BulkExportManager
+        from base.bulk_export import ExportJob
+
+        job = asyncio.run(BulkExportManager(self.server).export(ExportJob(compartment, **query_params)))[0]
+        if job.error is not None:
+            raise job.error
+        self.manifest = job.output_urls
+
+    def iter_manifest_file(self, url, session: requests.Session = None) -> Iterator[dict]:
+        """
+        Download one manifest file and yield its resources one by one as the bytes arrive.
+        :param session: the session of the downloading thread, default is self.session
+        """
+        response = self._issue(url, stream=True, session=session)
         try:
-            assert parse.urlparse(content).scheme
-        except AssertionError:
-            content = urljoin(self.server, content)
-        while True:
-            # TODO backoff
-            # TODO would be a good place for asyncio
-            sleep(0.5)
-            response = self._issue(content)
-            if response.status_code == 200:
-                self.manifest = MANIFEST_URLS.search(response.json())
-                return
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            decoder = NDJSONStreamDecoder(base64_encoded=content_type not in NDJSON_CONTENT_TYPES)
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                yield from decoder.feed(chunk)
+            yield from decoder.close()
+        finally:
+            response.close()
+
+    def iter_resources(self, max_workers: int = 4, queue_size: int = 1024) -> Iterator[dict]:
+        """
+        Yield the resources of every manifest file one at a time. The files are downloaded in parallel by max_workers
+        threads, which hand the resources over through a bounded queue, so the memory stays flat no matter how big the
+        export is.
+        """
+        if not self.provisioned:
+            return
+
+        resource_queue = queue.Queue(maxsize=queue_size)
+        urls = queue.Queue()
+        for url in self.manifest:
+            urls.put(url)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    resource_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def download():
+            # A requests.Session is not thread-safe, every downloading thread has its own
+            session = new_session()
+            try:
+                while not stop.is_set():
+                    try:
+                        url = urls.get_nowait()
+                    except queue.Empty:
+                        break
+                    for resource in self.iter_manifest_file(url, session):
+                        put(resource)
+                        if stop.is_set():
+                            break
+            except Exception as e:
+                put(e)
+            finally:
+                session.close()
+                put(done)
+
+        workers = [threading.Thread(target=download, daemon=True)
+                   for _ in range(max(1, min(max_workers, len(self.manifest))))]
+        for worker in workers:
+            worker.start()
+
+        try:
+            running = len(workers)
+            while running:
+                item = resource_queue.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # The consumer may stop early, let the downloading threads quit
+            stop.set()
+
+    def export_to(self, sink: Callable[[dict], None], max_workers: int = 4) -> int:
+        """
+        Hand every resource of the export to the sink, return the number of resources.
+        """
+        count = 0
+        for resource in self.iter_resources(max_workers=max_workers):
+            sink(resource)
+            count += 1
+        return count
 
     def iter_ndjson_dict(self) -> {str: list} or None:
+        """
+        Collect every resource into { "{data.resourceType}" : [data[0], data[1]... ] }.
+        XXX: Holds the whole export in memory, use iter_resources() for big exports.
+        """
         if not self.provisioned:
             return
-        # return_data_dict = { "{data.resourceType}" : [data[0], data[1]... ] }
         return_data_dict = dict()
-        for url in self.manifest:
-            bulk_data_response = self._issue(url)
-            bulk_data_base64 = str(json.loads(bulk_data_response.content)["data"])
-            bulk_data_ndjson = base64.b64decode(bulk_data_base64)
-            bulk_data_ndjson = ndjson.loads(bulk_data_ndjson)
-            for bulk_data_json in bulk_data_ndjson:
-                if bulk_data_json['resourceType'] not in return_data_dict:
-                    return_data_dict[bulk_data_json['resourceType']] = []
-                return_data_dict[bulk_data_json['resourceType']].append(bulk_data_json)
+        for bulk_data_json in self.iter_resources():
+            if bulk_data_json['resourceType'] not in return_data_dict:
+                return_data_dict[bulk_data_json['resourceType']] = []
+            return_data_dict[bulk_data_json['resourceType']].append(bulk_data_json)
 
         return return_data_dict
 
@@ -98,5 +259,5 @@ class BulkDataClient(object):
 if __name__ == "__main__":
     bulk_server = BulkDataClient()
     bulk_server.provision()
-    ndj = bulk_server.iter_ndjson_dict()
-    pass
+    for bulk_resource in bulk_server.iter_resources():
+        print(bulk_resource['resourceType'], bulk_resource.get('id'))
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib import parse
+from urllib.parse import urljoin
+
+import aiohttp
+
+from config import configObject as config
+from base.bulk_client import HEADERS
+from base.bulk_client import MANIFEST_URLS
+from base.bulk_client import VALID_QUERY_PARAMS
+from base.exceptions import BulkExportError
+
+"""
+    Async manager of FHIR Bulk Data export jobs (https://hl7.org/fhir/uv/bulkdata/export.html):
+        1. kick-off: GET [base]/Patient/$export, [base]/Group/[id]/$export or [base]/$export, the server answers 202
+           with the status url in Content-Location
+        2. poll the status url until it answers 200 with the manifest, the server may send X-Progress and Retry-After
+           with the 202 (in progress), 429 or 503 (too busy) responses
+    Every job polls in its own coroutine, so many jobs wait at the same time without blocking any thread.
+"""
+
+TRANSIENT_STATUS = (429, 503)
+
+
+def export_path(compartment: str = None) -> str:
+    """
+    None or "Patient" → /Patient/$export, "Group/[id]" → /Group/[id]/$export, "system" → /$export
+    """
+    if compartment is None or compartment == "Patient":
+        return "/Patient/$export"
+    elif compartment == "system":
+        return "/$export"
+    elif compartment.startswith("Group/") and len(compartment) > len("Group/"):
+        return "/{}/$export".format(compartment)
+    raise AttributeError("'{}' is not an export compartment, expect 'Patient', 'Group/[id]' or 'system'."
+                         .format(compartment))
+
+
+def parse_retry_after(value: str | None, now: datetime.datetime = None) -> float | None:
+    """
+    Retry-After is either seconds ("120") or an HTTP date ("Wed, 21 Oct 2015 07:28:00 GMT"), return the seconds.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+class ExportJob(object):
+    PENDING = "pending"
+    IN_PROGRESS = "in-progress"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, compartment: str = None, **query_params):
+        self.compartment = compartment
+        self.query_params = {k: v for (k, v) in query_params.items() if k in VALID_QUERY_PARAMS}
+        self.status = ExportJob.PENDING
+        self.status_url = None
+        self.progress = None  # The server's X-Progress, e.g. "50% complete"
+        self.polls = 0
+        self.next_poll_delay = None
+        self.manifest = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def output_urls(self) -> list:
+        if not self.manifest:
+            return []
+        return MANIFEST_URLS.search(self.manifest) or []
+
+    @property
+    def done(self) -> bool:
+        return self.status in (ExportJob.COMPLETED, ExportJob.FAILED, ExportJob.CANCELLED)
+
+    def to_dict(self) -> dict:
+        return {
+            "compartment": self.compartment or "Patient",
+            "status": self.status,
+            "progress": self.progress,
+            "polls": self.polls,
+            "next_poll_delay": self.next_poll_delay,
+            "status_url": self.status_url,
+            "output": len(self.output_urls),
+            "error": None if self.error is None else str(self.error),
+            "elapsed": None if self.started_at is None else (self.finished_at or time.monotonic()) - self.started_at,
+        }
+
+
+class BulkExportManager(object):
+    """
+    Kick off export jobs and poll them with exponential backoff until they complete:
+        delay = min(max_delay, initial_delay * 2 ** polls), or the server's Retry-After if it is given
+    A small jitter spreads the polls of the jobs started together. A job running longer than timeout seconds is
+    cancelled on the server (DELETE status url) and fails with BulkExportError.
+    """
+
+    def __init__(self,
+                 server: str = None,
+                 headers: dict = None,
+                 initial_delay: float = None,
+                 max_delay: float = None,
+                 timeout: float = None,
+                 jitter: float = 0.1):
+        bulk_config = config['bulk_server']
+        self.server = (server or bulk_config['BULK_SERVER_URL']).rstrip('/')
+        self.headers = dict(HEADERS, **(headers or {}))
+        self.initial_delay = bulk_config['POLL_INITIAL_DELAY'] if initial_delay is None else initial_delay
+        self.max_delay = bulk_config['POLL_MAX_DELAY'] if max_delay is None else max_delay
+        self.timeout = bulk_config['EXPORT_TIMEOUT'] if timeout is None else timeout
+        self.jitter = jitter
+        self.jobs = []
+
+    def progress(self) -> list:
+        return [job.to_dict() for job in self.jobs]
+
+    def _backoff(self, polls: int, retry_after: float | None) -> float:
+        if retry_after is not None:
+            # Never poll earlier than the server asked
+            return retry_after
+        delay = min(self.max_delay, self.initial_delay * 2 ** polls)
+        return delay * (1 + random.uniform(0, self.jitter))
+
+    async def kick_off(self, session: aiohttp.ClientSession, job: ExportJob) -> ExportJob:
+        url = self.server + export_path(job.compartment)
+        job.started_at = time.monotonic()
+        async with session.get(url, params=job.query_params, headers=self.headers) as response:
+            if response.status != 202:
+                raise BulkExportError("Kick-off of {} failed with {}: {}".format(
+                    url, response.status, await response.text()))
+            content = response.headers.get('Content-Location')
+        if not content:
+            raise BulkExportError("Kick-off of {} has no Content-Location".format(url))
+        # NOTE `content` should be an absolute URL, but we're being kind :)
+        job.status_url = content if parse.urlparse(content).scheme else urljoin(self.server + '/', content)
+        job.status = ExportJob.IN_PROGRESS
+        return job
+
+    async def poll(self, session: aiohttp.ClientSession, job: ExportJob) -> ExportJob:
+        deadline = job.started_at + self.timeout
+        while True:
+            async with session.get(job.status_url, headers={'Accept': 'application/json'}) as response:
+                job.polls += 1
+                if response.status == 200:
+                    job.manifest = await response.json(content_type=None)
+                    job.status = ExportJob.COMPLETED
+                    job.next_poll_delay = None
+                    return job
+                if response.status != 202 and response.status not in TRANSIENT_STATUS:
+                    raise BulkExportError("Export job {} failed with {}: {}".format(
+                        job.status_url, response.status, await response.text()))
+                job.progress = response.headers.get('X-Progress', job.progress)
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+            delay = self._backoff(job.polls - 1, retry_after)
+            if time.monotonic() + delay > deadline:
+                await self.cancel(session, job)
+                raise BulkExportError("Export job {} did not complete in {} seconds".format(
+                    job.status_url, self.timeout))
+            job.next_poll_delay = delay
+            await asyncio.sleep(delay)
+
+    async def cancel(self, session: aiohttp.ClientSession, job: ExportJob) -> None:
+        if job.status_url is not None and not job.done:
+            try:
+                async with session.delete(job.status_url):
+                    pass
+            except aiohttp.ClientError:
+                pass
+        job.status = ExportJob.CANCELLED
+
+    async def run(self, session: aiohttp.ClientSession, job: ExportJob) -> ExportJob:
+        try:
+            await self.kick_off(session, job)
+            await self.poll(session, job)
+        except asyncio.CancelledError:
+            await self.cancel(session, job)
+            raise
+        except Exception as e:
+            job.error = e
+            if job.status != ExportJob.CANCELLED:
+                job.status = ExportJob.FAILED
+        finally:
+            job.finished_at = time.monotonic()
+        return job
+
+    async def export(self, *jobs: ExportJob) -> list:
+        """
+        Run the jobs at the same time and return them when all of them are done, a failed job keeps its error in
+        job.error instead of stopping the others.
+        """
+        self.jobs.extend(jobs)
+        async with aiohttp.ClientSession() as session:
+            return list(await asyncio.gather(*(self.run(session, job) for job in jobs)))
+
+
+if __name__ == "__main__":
+    manager = BulkExportManager()
+    for export_job in asyncio.run(manager.export(ExportJob("Patient"), ExportJob("system", _type="Patient"))):
+        print(export_job.to_dict(), export_job.output_urls)
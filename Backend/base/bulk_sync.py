@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import threading
+
+import jmespath
+
+from config import configObject as config
+from base.bulk_client import BulkDataClient
+from base.bulk_export import BulkExportManager
+from base.bulk_export import ExportJob
+from base.feature_store import FeatureStoreWriter
+from base.feature_store import feature_codes
+
+"""
+    Incremental sync of the feature store with a bulk data server:
+        1. export with _since={the transactionTime of the last successful sync of the server}, the first sync exports
+           everything
+        2. write the updated resources to the store, and remove the deleted ones (the "deleted" files of the manifest,
+           Bundles of DELETE requests)
+        3. save the export's transactionTime as the new watermark, only after the store was written
+    A failed sync doesn't move the watermark, so the next sync asks for the same changes again.
+"""
+
+WATERMARK_FILE = "_watermarks.json"
+DELETED_URLS = jmespath.compile('deleted[*].url')
+
+
+class WatermarkStore(object):
+    """
+    {server url: transactionTime of the last successful export} in a JSON file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+
+    def get(self, server: str) -> str | None:
+        with self._lock:
+            return self._read().get(server.rstrip('/'))
+
+    def _write(self, watermarks: dict) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Write a new file and replace the old one, a crash never leaves a half written file
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(watermarks, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def set(self, server: str, transaction_time: str) -> None:
+        with self._lock:
+            watermarks = self._read()
+            watermarks[server.rstrip('/')] = transaction_time
+            self._write(watermarks)
+
+    def reset(self, server: str) -> None:
+        """
+        Forget the watermark, the next sync exports everything again
+        """
+        with self._lock:
+            watermarks = self._read()
+            if watermarks.pop(server.rstrip('/'), None) is not None:
+                self._write(watermarks)
+
+
+def deleted_resources(bundle: dict) -> list:
+    """
+    Return [(resource type, id)] of the DELETE requests in the Bundle of a "deleted" file, e.g.
+        {"resourceType": "Bundle", "type": "transaction",
+         "entry": [{"request": {"method": "DELETE", "url": "Observation/123"}}]}
+    """
+    if bundle.get('resourceType') != 'Bundle':
+        return []
+    deleted = []
+    for entry in bundle.get('entry', []):
+        request = entry.get('request') or {}
+        if str(request.get('method', '')).upper() != 'DELETE':
+            continue
+        resource_type, _, resource_id = str(request.get('url', '')).strip('/').split('?')[0].rpartition('/')
+        if resource_type and resource_id:
+            deleted.append((resource_type.split('/')[-1], resource_id))
+    return deleted
+
+
+def sync_feature_store(path: str = None,
+                       server: str = None,
+                       feature_table=None,
+                       watermarks: WatermarkStore = None,
+                       compartment: str = None,
+                       max_workers: int = 4,
+                       **query_params) -> dict:
+    """
+    Bring the feature store at path up to date with the bulk data server, only the resources changed since the last
+    sync are exported.
+    :param feature_table: only keep the codes of its features, see base.feature_store.build_feature_store
+    :param watermarks: default is the watermark file in the store's directory
+    :param query_params: other export parameters, e.g. _type="Patient,Observation,Condition"
+    :return: summary of the sync
+    """
+    path = path or config['feature_store']['PATH']
+    server = (server or config['bulk_server']['BULK_SERVER_URL']).rstrip('/')
+    watermarks = watermarks or WatermarkStore(os.path.join(path, WATERMARK_FILE))
+    since = watermarks.get(server)
+    if since is not None:
+        query_params['_since'] = since
+
+    job = asyncio.run(BulkExportManager(server).export(ExportJob(compartment, **query_params)))[0]
+    if job.error is not None:
+        raise job.error
+
+    codes = None if feature_table is None else feature_codes(feature_table)
+    writer = FeatureStoreWriter(path, codes, incremental=since is not None)
+    with BulkDataClient(server) as bulk_client:
+        bulk_client.manifest = job.output_urls
+        bulk_client.export_to(writer, max_workers=max_workers)
+        for url in DELETED_URLS.search(job.manifest) or []:
+            for bundle in bulk_client.iter_manifest_file(url):
+                for resource_type, resource_id in deleted_resources(bundle):
+                    writer.delete(resource_type, resource_id)
+
+    transaction_time = job.manifest.get('transactionTime')
+    writer.close(transactionTime=transaction_time)
+    if transaction_time is not None:
+        watermarks.set(server, transaction_time)
+
+    return {"server": server, "since": since, "transactionTime": transaction_time, "updated": writer.count,
+            "deleted": writer.deleted, "generation": writer.generation}
+
+
+if __name__ == "__main__":
+    from base.feature_table import feature_table
+
+    print(sync_feature_store(feature_table=feature_table, _type="Patient,Observation,Condition"))
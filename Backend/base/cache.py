@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from urllib.parse import quote
+
+from config import configObject as config
+
+"""
+    The feature cache keeps the search result ({"date": date, "value": value}) of a patient's feature, the key is:
+        (fhir base url, patient id, type_of_data, code, data_alive_time, search_type, default_value, authorization)
+    that is every field of features.csv that changes the search result (code_system is part of the code), as
+    base.patient_data_search.feature_search_key. The same server may answer differently to different access tokens,
+    so the results of a token are only returned to the same token, the key holds the sha256 of the Authorization
+    header, never the token itself.
+"""
+
+
+def authorization_digest(authorization: str = None) -> str:
+    return "" if authorization is None else hashlib.sha256(authorization.encode()).hexdigest()
+
+
+def cache_key(base_url: str, patient_id: str, feature_table: dict, authorization: str = None) -> tuple:
+    return (base_url, patient_id, str(feature_table['type_of_data']).lower(), feature_table['code'],
+            repr(feature_table['data_alive_time']), str(feature_table['search_type']).lower(),
+            repr(feature_table.get('default_value')), authorization_digest(authorization))
+
+
+class CacheInterface(ABC):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._counter_lock = threading.Lock()
+
+    @abstractmethod
+    def get(self, key: tuple) -> dict | None:
+        """
+        Return the cached value, or None if the key is not cached or expired.
+        """
+        pass
+
+    @abstractmethod
+    def set(self, key: tuple, value: dict) -> None:
+        pass
+
+    @abstractmethod
+    def invalidate(self, patient_id: str = None, base_url: str = None) -> None:
+        """
+        Remove the cached values of the patient (of the FHIR server if base_url is given), or everything if both
+        patient_id and base_url are None.
+        """
+        pass
+
+    def _count(self, hit: bool) -> None:
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class LRUCache(CacheInterface):
+    """
+    In-process LRU cache, every value expires ttl seconds after it was set.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 60):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> dict | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] < time.monotonic():
+                del self._data[key]
+                item = None
+            if item is not None:
+                self._data.move_to_end(key)
+        self._count(item is not None)
+        return None if item is None else item[1]
+
+    def set(self, key: tuple, value: dict) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, patient_id: str = None, base_url: str = None) -> None:
+        with self._lock:
+            for key in list(self._data.keys()):
+                if (patient_id is None or key[1] == patient_id) and (base_url is None or key[0] == base_url):
+                    del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache(CacheInterface):
+    """
+    Cache on a Redis compatible server. The client only needs get(), set(name, value, ex=), delete() and
+    scan_iter(match=), e.g. redis.Redis, so it can be replaced by a local stand-in in tests.
+    Redis expires the keys by itself, so evictions are not counted here.
+    """
+
+    def __init__(self, client, ttl: float = 60, prefix: str = "mocab:feature:"):
+        super(RedisCache, self).__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _redis_key(self, key: tuple) -> str:
+        # Every part is quoted, so ":" only separates the parts and glob characters never appear in them
+        return self.prefix + ":".join(quote(str(i), safe='') for i in key)
+
+    def get(self, key: tuple) -> dict | None:
+        value = self.client.get(self._redis_key(key))
+        self._count(value is not None)
+        return None if value is None else json.loads(value)
+
+    def set(self, key: tuple, value: dict) -> None:
+        self.client.set(self._redis_key(key), json.dumps(value), ex=max(1, int(self.ttl)))
+
+    def invalidate(self, patient_id: str = None, base_url: str = None) -> None:
+        pattern = self.prefix + "{}:{}:*".format("*" if base_url is None else quote(base_url, safe=''),
+                                                 "*" if patient_id is None else quote(patient_id, safe=''))
+        keys = list(self.client.scan_iter(match=pattern))
+        if keys:
+            self.client.delete(*keys)
+
+
+def create_cache(cache_config: dict) -> CacheInterface | None:
+    backend = str(cache_config.get("BACKEND", "")).lower()
+    if backend == "lru":
+        return LRUCache(cache_config.get("MAXSIZE", 4096), cache_config.get("TTL", 60))
+    elif backend == "redis":
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("The redis cache backend requires redis, install it with `pip install redis`.")
+        return RedisCache(redis.Redis.from_url(cache_config["REDIS_URL"]), cache_config.get("TTL", 60))
+    elif backend in ("", "none"):
+        return None
+    raise AttributeError("'{}' cache backend is not supported, expect 'lru', 'redis' or 'none'.".format(backend))
+
+
+feature_cache = create_cache(config['cache'])
+
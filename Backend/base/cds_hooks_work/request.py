@@ -21,7 +21,7 @@ class Request(object):
     hookInstance: str  # REQUIRED	string	A UUID for this particular hook call (see more information below).
     fhirServer: str = ""  # OPTIONAL: an fhir server to access
     fhirAuthorization: FHIRAuthorization = None  # OPTIONAL: an fhirAuthorization
-    prefetch: object  # OPTIONAL	object	The FHIR data that was prefetched by the CDS Client (see more information below).
+    prefetch: object = None  # OPTIONAL	object	The FHIR data that was prefetched by the CDS Client (see more information below).
 
     def hydrate(self, req):
         self.set_hooks(req)
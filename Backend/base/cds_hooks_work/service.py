@@ -14,7 +14,7 @@ class Service(object):
     # {baseUrl}/cds-services/{id}
     description: str  # REQUIRED	string	The description of this service.
     title: str  # RECOMMENDED	string	The human-friendly name of this service.
-    prefetch: object  # optional
+    prefetch: object  # optional, a dict or a callable that returns the current dict
     handler: HookHandler
 
     def __init__(self, hook, id, description, title="", prefetch=None, handler: HookHandler = None):
@@ -35,7 +35,7 @@ class Service(object):
             "id": self.id,
             "description": self.description,
             "title": self.title,
-            "prefetch": self.prefetch
+            "prefetch": self.prefetch() if callable(self.prefetch) else self.prefetch
         }
 
     def set_handler(self, handler: Callable):
@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import datetime
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import pandas
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import configObject as config
+from base.feature_store import FeatureStore
+from base.patient_data_search import feature_search_key
+from base.search_sets import code_tokens
+from base.search_sets import effective_days
+from base.search_sets import get_data_time_since
+
+"""
+    Population-level scoring: every model predicts every patient of the feature store.
+        1. (optional) sync the feature store with the bulk data server, see base.bulk_sync
+        2. split the patients of the store into chunks, and score the chunks in a process pool
+        3. in each chunk, every distinct feature of features.csv is computed for all the chunk's patients with
+           group-by operations on the store's columns, then each model predicts all the rows at once
+        4. the results are appended to the output file (.parquet or .csv) chunk by chunk
+    A process only holds the rows of its own chunk, so the memory is bounded by the chunk size.
+"""
+
+RESULT_SCHEMA = pa.schema([
+    ("patient_id", pa.string()),
+    ("model", pa.string()),
+    ("predict_value", pa.float64()),
+    ("error", pa.string()),
+])
+
+
+def _code_frame(store: FeatureStore, resource_type: str, code: str, patient_ids: List[str],
+                since: str = None) -> pandas.DataFrame:
+    """
+    Rows of every code of the feature ("system|code,code..."), a resource matching several codes is kept once
+    """
+    # The code system and the date are filtered by the Parquet reader
+    frames = [store.frame(resource_type, value, patient_ids, since, system) for system, value in code_tokens(code)]
+    frame = pandas.concat(frames, ignore_index=True)
+    return frame.drop_duplicates('id', keep='first')
+
+
+def _window_values(frame: pandas.DataFrame, search_type: str) -> pandas.Series:
+    """
+    delta (the latest value - the earliest value) or slope (least squares, value per day) of each patient, the
+    patients with less than two values are left out
+    """
+    frame = frame.assign(days=effective_days(frame['effective'].tolist()))
+    frame = frame.sort_values('days', kind='stable')
+    groups = frame.groupby('patient_id')
+    enough = groups['value'].size() >= 2
+    if search_type == "delta":
+        values = groups['value'].last() - groups['value'].first()
+    else:
+        days = frame['days'] - groups['days'].transform('mean')
+        value = frame['value'] - groups['value'].transform('mean')
+        numerator = (days * value).groupby(frame['patient_id']).sum()
+        denominator = (days * days).groupby(frame['patient_id']).sum()
+        enough &= denominator > 0
+        values = numerator / denominator.where(denominator > 0)
+    return values[enough]
+
+
+def compute_feature(store: FeatureStore, table: dict, patient_ids: List[str],
+                    default_time: datetime.datetime) -> pandas.Series:
+    """
+    Vectorized feature search, the value of the feature for each of the patients (None if it's not found), which is
+    the same as the value of base.search_sets.get_patient_resources of each patient.
+    """
+    type_of_data = str(table['type_of_data']).lower()
+    search_type = str(table['search_type']).lower()
+    result = pandas.Series(None, index=pandas.Index(patient_ids, name='patient_id'), dtype=object)
+
+    if type_of_data == "patient":
+        if str(table['code']).lower() != "age":
+            return result
+        patients = store.frame("Patient", patient_ids=patient_ids).drop_duplicates('patient_id', keep='last')
+        birth_date = pandas.to_datetime(patients.set_index('patient_id')['effective'], format="%Y-%m-%d",
+                                        errors="coerce")
+        age = ((default_time - birth_date).dt.days / 365).dropna().astype(int)
+        result.loc[age.index] = age.astype(object)
+        return result
+
+    if type_of_data == "condition":
+        frame = _code_frame(store, "Condition", table['code'], patient_ids)
+        return pandas.Series(result.index.isin(frame['patient_id']), index=result.index, dtype=object)
+
+    if type_of_data != "observation":
+        raise AttributeError("'{}' type_of_data is not supported now, check it again.".format(table['type_of_data']))
+    if search_type not in ("latest", "min", "max", "mean", "count", "delta", "slope"):
+        raise AttributeError("'{}' search_type is not supported now, check it again.".format(table['search_type']))
+
+    since = get_data_time_since(table, default_time)
+    frame = _code_frame(store, "Observation", table['code'], patient_ids, since)
+    if search_type == "latest":
+        # The value of the latest row, even if it has no value (last() would skip it and take an older value)
+        latest = frame.sort_values('effective', kind='stable').groupby('patient_id').tail(1)
+        values = latest.set_index('patient_id')['value']
+    elif search_type in ("min", "max", "mean"):
+        values = frame.dropna(subset=['value']).groupby('patient_id')['value'].agg(search_type)
+    elif search_type == "count":
+        # No value in the window is a count of 0, not a missing feature
+        values = frame.dropna(subset=['value']).groupby('patient_id')['value'].size()
+        values = values.reindex(result.index, fill_value=0)
+    else:
+        values = _window_values(frame.dropna(subset=['value']), search_type)
+    values = values.dropna()
+    result.loc[values.index] = values.astype(object)
+
+    if table['default_value'] is not None:
+        result = result.where(result.notna(), table['default_value'])
+    return result
+
+
+def compute_model_features(store: FeatureStore, tables: dict, patient_ids: List[str],
+                           default_time: datetime.datetime) -> dict:
+    """
+    {model name: DataFrame of the model's features, indexed by patient_id}. The features shared by the models are
+    computed only once.
+    """
+    features = dict()
+    models_frame = dict()
+    for model_name, table in tables.items():
+        columns = dict()
+        for feature_name, feature_table in table.items():
+            key = feature_search_key(feature_table)
+            if key not in features:
+                features[key] = compute_feature(store, feature_table, patient_ids, default_time)
+            columns[feature_name] = features[key]
+        models_frame[model_name] = pandas.DataFrame(columns, index=pandas.Index(patient_ids, name='patient_id'))
+    return models_frame
+
+
+def predict_model(model_name: str, frame: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Predict the rows of the model's feature frame. The rows with missing features and the rows that the model failed
+    to predict get an error instead.
+    """
+    from app import return_model_column_results
+
+    result = pandas.DataFrame({"patient_id": frame.index, "model": model_name, "predict_value": None, "error": None})
+    complete = frame.notna().all(axis=1).to_numpy()
+    result.loc[~complete, 'error'] = [
+        "Could not find {}, no enough data for the patient".format(", ".join(frame.columns[row.isna()]))
+        for _, row in frame[~complete].iterrows()]
+
+    rows = frame[complete]
+    if len(rows):
+        try:
+            result.loc[complete, 'predict_value'] = return_model_column_results(
+                {name: rows[name].tolist() for name in rows.columns}, model_name)
+        except Exception:
+            # One row the model can't predict fails the whole batch, find it by predicting the rows one by one
+            predict_values, errors = [], []
+            for _, row in rows.iterrows():
+                try:
+                    predict_values.append(return_model_column_results({name: [row[name]] for name in rows.columns},
+                                                                      model_name)[0])
+                    errors.append(None)
+                except Exception as e:
+                    predict_values.append(None)
+                    errors.append(str(e) or type(e).__name__)
+            result.loc[complete, 'predict_value'] = predict_values
+            result.loc[complete, 'error'] = errors
+    result['predict_value'] = pandas.to_numeric(result['predict_value'], errors='coerce')
+    return result
+
+
+def score_patients(store_path: str, models: List[str], patient_ids: List[str],
+                   default_time: datetime.datetime) -> pandas.DataFrame:
+    """
+    Score one chunk of patients with every model, it runs in a worker process of score_cohort.
+    """
+    from base.feature_table import feature_table
+
+    store = FeatureStore(store_path)
+    tables = {model_name: feature_table.get_model_feature_dict(model_name) for model_name in models}
+    frames = compute_model_features(store, tables, patient_ids, default_time)
+    return pandas.concat([predict_model(model_name, frame) for model_name, frame in frames.items()],
+                         ignore_index=True)
+
+
+def scoring_models() -> List[str]:
+    """
+    The models in the models package that have features in features.csv
+    """
+    import models
+    from base.feature_table import feature_table
+
+    return [model_name for model_name in getattr(models, "__all__", [])
+            if model_name in feature_table.get_exist_model_name()]
+
+
+class _ResultWriter(object):
+    """
+    Append the result frames to a Parquet or CSV file
+    """
+
+    def __init__(self, output: str):
+        self.output = output
+        self.format = os.path.splitext(output)[1].lower()
+        if self.format not in (".parquet", ".csv"):
+            raise ValueError("The output should be a .parquet or .csv file, got '{}'.".format(output))
+        self._parquet_writer = None
+        self._header = True
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+    def write(self, frame: pandas.DataFrame) -> None:
+        frame = frame[RESULT_SCHEMA.names]
+        if self.format == ".parquet":
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.output, RESULT_SCHEMA)
+            self._parquet_writer.write_table(pa.Table.from_pandas(frame, schema=RESULT_SCHEMA, preserve_index=False))
+        else:
+            frame.to_csv(self.output, mode="w" if self._header else "a", header=self._header, index=False)
+            self._header = False
+        self.count += len(frame)
+
+
+def score_cohort(output: str,
+                 store_path: str = None,
+                 export: bool = True,
+                 server: str = None,
+                 models: List[str] = None,
+                 default_time: datetime.datetime = None,
+                 chunk_size: int = None,
+                 processes: int = None) -> int:
+    """
+    Score every patient of the feature store with the models, and write the results to the output file.
+    :param export: sync the feature store with the bulk data server first
+    :param models: default is every model in the models package with features in features.csv
+    :param chunk_size: number of patients scored together, default is config['cohort_scoring']['CHUNK_SIZE']
+    :param processes: number of worker processes, default is config['cohort_scoring']['PROCESSES'] or the number of
+                      CPUs. With processes=1 the chunks are scored in this process.
+    :return: number of result rows
+    """
+    store_path = store_path or config['feature_store']['PATH']
+    default_time = default_time or datetime.datetime.now()
+    chunk_size = chunk_size or config['cohort_scoring']['CHUNK_SIZE']
+    processes = processes or config['cohort_scoring']['PROCESSES'] or os.cpu_count() or 1
+    if export:
+        from base.bulk_sync import sync_feature_store
+        from base.feature_table import feature_table
+
+        sync_feature_store(store_path, server, feature_table, _type="Patient,Observation,Condition")
+    models = models or scoring_models()
+
+    patient_ids = FeatureStore(store_path).patient_ids()
+    chunks = [patient_ids[i:i + chunk_size] for i in range(0, len(patient_ids), chunk_size)]
+    with _ResultWriter(output) as writer:
+        if processes <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                writer.write(score_patients(store_path, models, chunk, default_time))
+            return writer.count
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            # At most two chunks per process are waiting, the results are written in the order of the chunks
+            pending = deque()
+            for chunk in chunks:
+                if len(pending) >= processes * 2:
+                    writer.write(pending.popleft().result())
+                pending.append(executor.submit(score_patients, store_path, models, chunk, default_time))
+            while pending:
+                writer.write(pending.popleft().result())
+        return writer.count
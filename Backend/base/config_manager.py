@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import datetime
+import hashlib
+import os
+import threading
+
+from config import configObject as config
+from base.feature_table import _FeatureTable
+from base.model_feature_table import _ModelFeature
+from base.prefetch import build_prefetch_templates
+
+"""
+    Hot reload of the feature table (features.csv) and the transformation table (transformation.csv).
+    The paths are config['table_path']['FEATURE_TABLE'] and config['table_path']['TRANSFORMATION_TABLE'].
+
+    A TableVersion is the compiled pair of tables, it's never changed after it's built. The watcher thread checks the
+    files every config['table_path']['RELOAD_INTERVAL'] seconds, and when one of them changed, it compiles a new
+    version in the background and swaps it in with a single assignment. A request takes table_manager.current once
+    and uses that version until it ends, so the requests in flight finish on the old version.
+    An invalid new file is not swapped in, the active version stays and the error is reported by status().
+"""
+
+TABLE_NAMES = ("FEATURE_TABLE", "TRANSFORMATION_TABLE")
+
+
+class TableVersion(object):
+    """
+    One immutable, compiled version of the feature and transformation tables
+    """
+
+    __slots__ = ('version', 'digest', 'feature_table', 'transformation_table', 'files', 'loaded_at',
+                 'prefetch_templates')
+
+    def __init__(self, version: int, digest: str, feature_table: _FeatureTable, transformation_table: _ModelFeature,
+                 files: dict, loaded_at: str):
+        self.version = version
+        # sha256 of the tables' content, the same files give the same digest in every worker process
+        self.digest = digest
+        self.feature_table = feature_table
+        self.transformation_table = transformation_table
+        # {table name: (path, mtime_ns, size)}
+        self.files = files
+        self.loaded_at = loaded_at
+        # The CDS Hooks prefetch templates of the feature table
+        self.prefetch_templates = build_prefetch_templates(feature_table)
+
+    def to_dict(self) -> dict:
+        return {"version": self.version, "digest": self.digest, "loaded_at": self.loaded_at,
+                "models": self.feature_table.get_exist_model_name(),
+                "files": {name: {"path": path,
+                                 "modified": datetime.datetime.fromtimestamp(mtime_ns / 1e9).isoformat()}
+                          for name, (path, mtime_ns, size) in self.files.items()}}
+
+
+def _table_paths() -> dict:
+    return {name: config['table_path'][name] for name in TABLE_NAMES}
+
+
+def _fingerprint(paths: dict) -> dict:
+    fingerprint = dict()
+    for name, path in paths.items():
+        stat = os.stat(path)
+        fingerprint[name] = (path, stat.st_mtime_ns, stat.st_size)
+    return fingerprint
+
+
+def compile_tables(paths: dict, version: int = 1) -> TableVersion:
+    """
+    Read, validate and compile the tables, raises the error of an invalid table (e.g. FeatureCodeIsEmpty)
+    """
+    # Taken before reading, a change while the files are read is found by the next check
+    files = _fingerprint(paths)
+    digest = hashlib.sha256()
+    for name in TABLE_NAMES:
+        with open(paths[name], 'rb') as f:
+            digest.update(f.read())
+    return TableVersion(version, digest.hexdigest()[:12], _FeatureTable(paths['FEATURE_TABLE']),
+                        _ModelFeature(paths['TRANSFORMATION_TABLE']), files,
+                        datetime.datetime.now().isoformat(timespec='seconds'))
+
+
+class _ConfigManager:
+    """
+    Keeps the active TableVersion, and swaps in a new one when the table files change.
+    """
+
+    def __init__(self, paths=None, interval: float = None):
+        """
+        :param paths: {table name: path}, default is read from config['table_path'] on every check
+        :param interval: seconds between the checks of the watcher, default is config['table_path']['RELOAD_INTERVAL']
+        """
+        self._paths = paths
+        self.interval = interval
+        self._current = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_error = None
+        self.last_check = None
+
+    @property
+    def paths(self) -> dict:
+        return dict(self._paths) if self._paths is not None else _table_paths()
+
+    @property
+    def current(self) -> TableVersion:
+        current = self._current
+        if current is None:
+            with self._lock:
+                # Another thread may have loaded the tables while we were waiting for the lock
+                if self._current is None:
+                    self._current = compile_tables(self.paths)
+                current = self._current
+        return current
+
+    def reload(self) -> bool:
+        """
+        Compile the tables again and swap them in, return False if they are invalid (the active version stays).
+        """
+        with self._lock:
+            version = 1 if self._current is None else self._current.version + 1
+            try:
+                new = compile_tables(self.paths, version)
+            except Exception as e:
+                self.last_error = "{}: {}".format(type(e).__name__, e)
+                print("The tables are not reloaded, {}".format(self.last_error))
+                return False
+            if self._current is not None and new.digest == self._current.digest:
+                # Only touched, keep the active version and remember the new mtime
+                new.version, new.loaded_at = self._current.version, self._current.loaded_at
+            self.last_error = None
+            # In-flight requests keep the reference of the old version
+            self._current = new
+            return True
+
+    def check(self) -> bool:
+        """
+        Reload the tables if one of the files changed, return True if a new version is active.
+        """
+        self.last_check = datetime.datetime.now().isoformat(timespec='seconds')
+        current = self.current
+        try:
+            if _fingerprint(self.paths) == current.files:
+                return False
+        except OSError as e:
+            # e.g. the file is being replaced
+            self.last_error = "{}: {}".format(type(e).__name__, e)
+            return False
+        return self.reload() and self._current.version != current.version
+
+    def _watch(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.check()
+            except Exception as e:
+                self.last_error = "{}: {}".format(type(e).__name__, e)
+
+    def start(self) -> None:
+        """
+        Start the watcher thread, it does nothing if the watcher is running or the interval is 0
+        """
+        interval = self.interval if self.interval is not None else config['table_path']['RELOAD_INTERVAL']
+        if not interval or (self._thread is not None and self._thread.is_alive()):
+            return
+        self.current
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, args=(interval,), name="table-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def status(self) -> dict:
+        status = self.current.to_dict()
+        status.update({"watching": self._thread is not None and self._thread.is_alive(),
+                       "last_check": self.last_check, "last_error": self.last_error})
+        return status
+
+
+table_manager = _ConfigManager()
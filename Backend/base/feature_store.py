@@ -0,0 +1,438 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from typing import Iterable
+from typing import List
+from urllib.parse import quote
+from urllib.parse import unquote
+
+import pandas
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from base.resource_source import ResourceSourceInterface
+
+"""
+    Columnar feature store on local disk, materialized from the resources of a Bulk Data export.
+
+    Layout (Parquet files partitioned by resource type and code):
+        {path}/_manifest.json
+        {path}/Observation/{code}/part-{generation}-00000.parquet
+        {path}/Condition/{code}/part-{generation}-00000.parquet
+        {path}/Patient/part-{generation}-00000.parquet
+        {path}/_changes/{generation}.parquet
+    Every row is one resource under one of its codes, the rows of a file are sorted by (patient_id, effective), and:
+        patient_id | system | code | effective | value | id | resource (the resource's JSON)
+    An Observation is stored under every code of Observation.code and Observation.component.code, the value is the
+    valueQuantity of that code. The effective of a Patient is the birthDate.
+
+    Every write (FeatureStoreWriter) is a new generation. An incremental write (e.g. the delta of a bulk export with
+    _since) also logs the ids it updated or deleted in _changes, the rows of older generations of these resources are
+    then hidden, so the store is updated without rewriting the files. compact() merges the generations.
+
+    FeatureStore answers the feature searches of base.search_sets (as their `source`) from the files, so the features
+    of features.csv are searched the same way as on the FHIR server, without any request.
+"""
+
+MANIFEST_FILE = "_manifest.json"
+ROW_GROUP_SIZE = 10000
+CHANGES_DIR = "_changes"
+STORED_TYPES = ("Observation", "Condition", "Patient")
+SCHEMA = pa.schema([
+    ("patient_id", pa.string()),
+    ("system", pa.string()),
+    ("code", pa.string()),
+    ("effective", pa.string()),
+    ("value", pa.float64()),
+    ("id", pa.string()),
+    ("resource", pa.string()),
+])
+FRAME_COLUMNS = ["patient_id", "id", "system", "code", "effective", "value"]
+CHANGES_SCHEMA = pa.schema([
+    ("resource_type", pa.string()),
+    ("id", pa.string()),
+    ("deleted", pa.bool_()),
+])
+
+
+def _partition_dir(path: str, resource_type: str, code: str = None) -> str:
+    if resource_type == "Patient":
+        return os.path.join(path, resource_type)
+    # Codes may contain "/" or other characters not allowed in a file name
+    return os.path.join(path, resource_type, quote(code, safe=''))
+
+
+def _reference_id(reference: dict) -> str:
+    return str((reference or {}).get('reference', '')).split('/')[-1]
+
+
+def _codings(codeable_concept) -> list:
+    if not isinstance(codeable_concept, dict):
+        return []
+    return codeable_concept.get('coding', [])
+
+
+def _effective(resource: dict) -> str:
+    if resource['resourceType'] == "Patient":
+        return resource.get('birthDate') or ''
+    if resource['resourceType'] == "Condition":
+        return resource.get('recordedDate') or resource.get('onsetDateTime') or ''
+    return resource.get('effectiveDateTime') or (resource.get('effectivePeriod') or {}).get('start') or ''
+
+
+def _quantity(element: dict) -> float | None:
+    value = (element.get('valueQuantity') or {}).get('value')
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def feature_codes(feature_table) -> set:
+    """
+    The codes (without the code system) used by the features of the feature table, e.g. {"72-314", "8462-4"}
+    """
+    codes = set()
+    for model_name in feature_table.get_exist_model_name():
+        for feature in feature_table.get_model_feature_dict(model_name).values():
+            if str(feature['type_of_data']).lower() == "patient":
+                continue
+            codes.update(token.rpartition('|')[2] for token in str(feature['code']).split(','))
+    return codes
+
+
+def resource_rows(resource: dict) -> List[dict]:
+    """
+    Return the rows of the resource, one for each of its codes. Resources not kept in the store return no row.
+    """
+    resource_type = resource.get('resourceType')
+    if resource_type not in STORED_TYPES:
+        return []
+
+    row = {"effective": _effective(resource), "value": None, "id": resource.get('id'),
+           "resource": json.dumps(resource, ensure_ascii=False)}
+    if resource_type == "Patient":
+        return [dict(row, patient_id=resource.get('id'), system=None, code=None)]
+
+    row['patient_id'] = _reference_id(resource.get('subject'))
+    # (coding, the value of the coding)
+    codings = [(coding, _quantity(resource)) for coding in _codings(resource.get('code'))]
+    for component in resource.get('component', []):
+        codings.extend((coding, _quantity(component)) for coding in _codings(component.get('code')))
+
+    rows, seen = [], set()
+    for coding, value in codings:
+        key = (coding.get('system'), coding.get('code'))
+        if coding.get('code') is None or key in seen:
+            continue
+        seen.add(key)
+        rows.append(dict(row, system=coding.get('system'), code=coding.get('code'), value=value))
+    return rows
+
+
+class FeatureStoreWriter(object):
+    """
+    Buffer the resources by partition and write them to Parquet files of at most rows_per_file rows.
+    Use it as a sink of BulkDataClient.export_to(), or see build_feature_store().
+    """
+
+    def __init__(self, path: str, codes: Iterable[str] = None, rows_per_file: int = 100000, incremental: bool = False):
+        """
+        :param codes: only keep the Observations and Conditions of these codes, None keeps every code
+        :param incremental: the resources are changes to the resources in the store, log their ids so the older
+                            versions are hidden
+        """
+        self.path = path
+        self.codes = None if codes is None else set(codes)
+        self.rows_per_file = rows_per_file
+        self.incremental = incremental
+        self.generation = (read_manifest(path) or {}).get('generation', -1) + 1
+        self._buffers = dict()
+        self._changes = dict()
+        self._lock = threading.Lock()
+        self.count = 0
+        self.deleted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def __call__(self, resource: dict) -> None:
+        self.add(resource)
+
+    def add(self, resource: dict) -> None:
+        rows = [row for row in resource_rows(resource)
+                if row['code'] is None or self.codes is None or row['code'] in self.codes]
+        with self._lock:
+            if self.incremental and resource.get('resourceType') in STORED_TYPES:
+                # Even if the new version is not kept (e.g. its code changed), the older one is outdated
+                self._changes[(resource['resourceType'], resource.get('id'))] = False
+            for row in rows:
+                partition = (resource['resourceType'], row['code'])
+                buffer = self._buffers.setdefault(partition, [])
+                buffer.append(row)
+                if len(buffer) >= self.rows_per_file:
+                    self._flush(partition)
+            self.count += 1 if rows else 0
+
+    def delete(self, resource_type: str, resource_id: str) -> None:
+        if resource_type not in STORED_TYPES:
+            return
+        with self._lock:
+            self._changes[(resource_type, resource_id)] = True
+            self.deleted += 1
+
+    def _flush(self, partition: tuple) -> None:
+        rows = self._buffers.pop(partition, [])
+        if not rows:
+            return
+        rows.sort(key=lambda row: (row['patient_id'], row['effective']))
+        directory = _partition_dir(self.path, *partition)
+        os.makedirs(directory, exist_ok=True)
+        prefix = "part-{:05d}-".format(self.generation)
+        number = len([i for i in os.listdir(directory) if i.startswith(prefix)])
+        table = pa.Table.from_pylist(rows, schema=SCHEMA)
+        # Small row groups let the readers of a few patients skip the others (the rows are sorted by patient_id)
+        pq.write_table(table, os.path.join(directory, "{}{:05d}.parquet".format(prefix, number)),
+                       row_group_size=ROW_GROUP_SIZE)
+
+    def close(self, **manifest) -> None:
+        """
+        Write the remaining rows and the manifest, the extra keyword arguments (e.g. transactionTime) are kept in it.
+        """
+        with self._lock:
+            for partition in list(self._buffers.keys()):
+                self._flush(partition)
+            os.makedirs(self.path, exist_ok=True)
+            if self._changes:
+                os.makedirs(os.path.join(self.path, CHANGES_DIR), exist_ok=True)
+                changes = [{"resource_type": resource_type, "id": resource_id, "deleted": deleted}
+                           for (resource_type, resource_id), deleted in self._changes.items()]
+                pq.write_table(pa.Table.from_pylist(changes, schema=CHANGES_SCHEMA),
+                               os.path.join(self.path, CHANGES_DIR, "{:05d}.parquet".format(self.generation)))
+                self._changes = dict()
+            previous = read_manifest(self.path)
+            if self.codes is None or (previous is not None and previous.get('codes') is None):
+                codes = None
+            else:
+                codes = sorted(self.codes | set((previous or {}).get('codes') or []))
+            with open(os.path.join(self.path, MANIFEST_FILE), "w") as f:
+                json.dump(dict(previous or {}, types=list(STORED_TYPES), codes=codes, generation=self.generation,
+                               **manifest), f)
+
+
+def read_manifest(path: str) -> dict | None:
+    try:
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _generation(file_name: str) -> int:
+    # part-{generation}-{number}.parquet
+    return int(file_name.split('-')[1])
+
+
+def _read_partition(directory: str, files: List[str], columns: List[str] = None, filters=None) -> tuple:
+    """
+    Return the rows of the files as one table, and the generation of each row
+    """
+    tables = [pq.read_table(os.path.join(directory, i), schema=SCHEMA, columns=columns, filters=filters)
+              for i in files]
+    generation = [_generation(file_name) for file_name, table in zip(files, tables) for _ in range(table.num_rows)]
+    if not tables:
+        empty = SCHEMA.empty_table()
+        return (empty if columns is None else empty.select(columns)), generation
+    return pa.concat_tables(tables), generation
+
+
+def build_feature_store(bulk_client, path: str, feature_table=None, max_workers: int = 4) -> int:
+    """
+    Write the resources of a provisioned BulkDataClient into the feature store at path.
+    If the feature table is given, only the codes of its features are kept.
+    :return: number of resources written
+    """
+    codes = None if feature_table is None else feature_codes(feature_table)
+    writer = FeatureStoreWriter(path, codes)
+    bulk_client.export_to(writer, max_workers=max_workers)
+    writer.close()
+    return writer.count
+
+
+class FeatureStore(ResourceSourceInterface):
+    """
+    Read only view of a feature store, pass it as the `source` of the feature searches, e.g.
+        model_feature_search_with_patient_id(patient_id, table, source=FeatureStore(path))
+    The searches push their filters (patient, date, code system) down to the Parquet reader, so only the row groups
+    that may hold the rows are read. Call refresh() after the files are rewritten.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.manifest = read_manifest(path)
+        self._changes = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> None:
+        with self._lock:
+            self.manifest = read_manifest(self.path)
+            self._changes = None
+
+    def _load_changes(self) -> dict:
+        """
+        {(resource_type, id): (generation of the latest change, deleted)}
+        """
+        if self._changes is not None:
+            return self._changes
+        with self._lock:
+            if self._changes is None:
+                changes = dict()
+                directory = os.path.join(self.path, CHANGES_DIR)
+                files = sorted(i for i in os.listdir(directory) if i.endswith(".parquet")) \
+                    if os.path.isdir(directory) else []
+                for file_name in files:
+                    generation = int(file_name.split('.')[0])
+                    columns = pq.read_table(os.path.join(directory, file_name), schema=CHANGES_SCHEMA).to_pydict()
+                    for resource_type, resource_id, deleted in zip(columns['resource_type'], columns['id'],
+                                                                   columns['deleted']):
+                        changes[(resource_type, resource_id)] = (generation, deleted)
+                self._changes = changes
+            return self._changes
+
+    def _is_current(self, resource_type: str, resource_id: str, generation: int) -> bool:
+        change = self._load_changes().get((resource_type, resource_id))
+        if change is None:
+            return True
+        # A row older than the latest change is outdated, and a deleted resource has no current row
+        return generation >= change[0] and not change[1]
+
+    def _holds(self, resource_type: str, code: str = None) -> bool:
+        if self.manifest is None or resource_type not in self.manifest.get('types', []):
+            return False
+        codes = self.manifest.get('codes')
+        return code is None or codes is None or code in codes
+
+    def patient_ids(self) -> List[str]:
+        """
+        Ids of the patients in the store
+        """
+        return sorted(set(self.frame("Patient", columns=["patient_id", "id"])['patient_id']))
+
+    def frame(self, resource_type: str, code: str = None, patient_ids: Iterable[str] = None, since: str = None,
+              system: str = None, columns: List[str] = None) -> pandas.DataFrame:
+        """
+        Current rows of the partition (the latest version of every resource that is not deleted) as a DataFrame of
+        FRAME_COLUMNS, for the vectorized feature computing of many patients, see base.cohort_scoring.
+        :param patient_ids: only read the rows of these patients
+        :param since: only read the rows whose effective is on or after this FHIR date
+        :param system: only read the rows of this code system
+        :param columns: the columns to read, FRAME_COLUMNS by default, "id" is always read
+        """
+        columns = list(FRAME_COLUMNS if columns is None else columns)
+        read_columns = columns if "id" in columns else columns + ["id"]
+        directory = _partition_dir(self.path, resource_type, code)
+        files = sorted(i for i in os.listdir(directory) if i.endswith(".parquet")) if os.path.isdir(directory) else []
+        patient_filters = [] if patient_ids is None else [("patient_id", "in", list(patient_ids))]
+        # effective[:len(since)] >= since is the same as effective >= since for the strings
+        filters = patient_filters + ([] if since is None else [("effective", ">=", since)]) \
+            + ([] if not system else [("system", "=", system)])
+        table, generation = _read_partition(directory, files, read_columns, filters or None)
+        frame = table.to_pandas()
+        frame['generation'] = pandas.Series(generation, index=frame.index, dtype="int64")
+
+        if len({_generation(i) for i in files}) > 1:
+            # The newer version of a resource may have been filtered out (e.g. its date changed), so the latest
+            # generation of every resource is taken from the id column of the patients' rows
+            ids, id_generation = _read_partition(directory, files, ["id"], patient_filters or None)
+            latest = pandas.Series(id_generation, index=ids.column('id').to_pandas(), dtype="int64")
+            latest = latest.groupby(level=0).max()
+            frame = frame[frame['generation'] == frame['id'].map(latest)]
+        changes = {resource_id: change for (changed_type, resource_id), change in self._load_changes().items()
+                   if changed_type == resource_type}
+        if changes:
+            changed = frame['id'].map(lambda i: changes.get(i, (-1, False)))
+            current = [generation >= change[0] and not change[1]
+                       for generation, change in zip(frame['generation'], changed)]
+            frame = frame[pandas.Series(current, index=frame.index, dtype=bool)]
+        return frame[columns].reset_index(drop=True)
+
+    def search(self, type_of_data: str, patient_id: str, code: str = None, since: str = None) -> List[dict] | None:
+        resource_type = str(type_of_data).lower().capitalize()
+        if resource_type == "Patient":
+            if not self._holds(resource_type):
+                return None
+            rows = self.frame(resource_type, patient_ids=[patient_id], columns=["id", "resource"])
+            # A patient missing from the store is searched on the FHIR server
+            return [json.loads(rows['resource'].iloc[-1])] if len(rows) else None
+
+        tokens = [token.rpartition('|') for token in str(code).split(',')]
+        if not all(self._holds(resource_type, value) for _, _, value in tokens):
+            return None
+
+        frames = [self.frame(resource_type, value, [patient_id], since, system, ["id", "effective", "resource"])
+                  for system, _, value in tokens]
+        # A resource may match several codes
+        rows = pandas.concat(frames, ignore_index=True).drop_duplicates('id')
+        rows = rows.sort_values('effective', kind='stable')
+        return [json.loads(resource) for resource in rows['resource']]
+
+
+def _partition_dirs(path: str) -> List[tuple]:
+    partitions = []
+    for resource_type in STORED_TYPES:
+        directory = os.path.join(path, resource_type)
+        if resource_type == "Patient":
+            partitions.append((resource_type, None))
+        elif os.path.isdir(directory):
+            partitions.extend((resource_type, unquote(code)) for code in sorted(os.listdir(directory)))
+    return partitions
+
+
+def compact(path: str) -> None:
+    """
+    Rewrite every partition with only the current version of each resource, and drop the change logs.
+    """
+    store = FeatureStore(path)
+    if store.manifest is None:
+        return
+    generation = store.manifest.get('generation', 0)
+    for resource_type, code in _partition_dirs(path):
+        directory = _partition_dir(path, resource_type, code)
+        if not os.path.isdir(directory):
+            continue
+        old_files = sorted(i for i in os.listdir(directory) if i.endswith(".parquet"))
+        table, generations = _read_partition(directory, old_files)
+        ids = table.column('id').to_pylist()
+        latest = dict()
+        for resource_id, row_generation in zip(ids, generations):
+            latest[resource_id] = max(latest.get(resource_id, row_generation), row_generation)
+        rows = [row for row, (resource_id, row_generation) in enumerate(zip(ids, generations))
+                if row_generation == latest[resource_id] and store._is_current(resource_type, resource_id,
+                                                                               row_generation)]
+        table = table.take(pa.array(rows, type=pa.int64()))
+        if table.num_rows:
+            pq.write_table(table, os.path.join(directory, "compacting.parquet.tmp"))
+        for file_name in old_files:
+            os.remove(os.path.join(directory, file_name))
+        if table.num_rows:
+            os.replace(os.path.join(directory, "compacting.parquet.tmp"),
+                       os.path.join(directory, "part-{:05d}-00000.parquet".format(generation)))
+
+    changes = os.path.join(path, CHANGES_DIR)
+    if os.path.isdir(changes):
+        for file_name in os.listdir(changes):
+            os.remove(os.path.join(changes, file_name))
+        os.rmdir(changes)
+
+
+if __name__ == "__main__":
+    from config import configObject as config
+    from base.bulk_client import BulkDataClient
+    from base.feature_table import feature_table
+
+    with BulkDataClient() as bulk_client:
+        bulk_client.provision(_type="Patient,Observation,Condition")
+        print(build_feature_store(bulk_client, config['feature_store']['PATH'], feature_table), "resources written")
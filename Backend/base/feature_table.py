@@ -1,13 +1,84 @@
 import csv
 import re
-from base.model_feature_table import transform_to_correct_type
+from collections.abc import Mapping
+from types import MappingProxyType
+
+from dateutil.relativedelta import relativedelta
 
+from base.model_feature_table import transform_to_correct_type
 from base.exceptions import FeatureCodeIsEmpty
+from base.search_sets import code_tokens
+from base.search_sets import resource_strategy
+from base.search_sets import search_func
+
+"""
+    The feature table is compiled once at load time:
+        {model name: read-only {feature name: FeatureSpec}}
+    A FeatureSpec is read like the feature's dict (feature['code'], feature['search_type']...), and it also carries
+    the parsed codes, the search strategies and the search key, so the searches don't parse them again per request.
+    The reverse indexes (code -> features, code -> models) are built at the same time.
+"""
+
+
+class FeatureSpec(Mapping):
+    """
+    Immutable, compiled feature of features.csv
+    """
+
+    __slots__ = ('model', 'name', '_fields', 'codes', 'resource_strategy', 'get_func', 'search_key')
+
+    def __init__(self, model: str, name: str, fields: dict):
+        set_attribute = super(FeatureSpec, self).__setattr__
+        set_attribute('model', model)
+        set_attribute('name', name)
+        set_attribute('_fields', MappingProxyType(dict(fields)))
+        # ((system, code), ...)
+        set_attribute('codes', code_tokens(fields['code']))
+        # e.g. search_sets.Observation and search_sets.GetLatest, None if it's not supported
+        set_attribute('resource_strategy', resource_strategy(fields['type_of_data']))
+        set_attribute('get_func', search_func(fields['search_type']))
+        # Features with the same key get the same search result, see base.patient_data_search.feature_search_key
+        set_attribute('search_key', (str(fields['type_of_data']).lower(), fields['code'], fields['data_alive_time'],
+                                     str(fields['search_type']).lower(), fields['default_value']))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("FeatureSpec is read-only")
+
+    def __getitem__(self, key):
+        return self._fields[key]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return "FeatureSpec({!r}, {!r}, {!r})".format(self.model, self.name, dict(self._fields))
 
 
 class _FeatureTable:
     def __init__(self, feature_table_position):
-        self.table = self.__create_table(feature_table_position)
+        self.table = self.__compile_table(self.__create_table(feature_table_position))
+        self.__build_indexes()
+
+    @staticmethod
+    def __compile_table(table: dict) -> dict:
+        return {model_name: MappingProxyType({feature_name: FeatureSpec(model_name, feature_name, fields)
+                                              for feature_name, fields in features.items()})
+                for model_name, features in table.items()}
+
+    def __build_indexes(self):
+        code_index = dict()
+        for model_name, features in self.table.items():
+            for feature in features.values():
+                for _, code in feature.codes:
+                    code_index.setdefault(code, []).append(feature)
+        # {code without the system: (FeatureSpec, ...)}
+        self.code_index = {code: tuple(features) for code, features in code_index.items()}
+        # {code without the system: (model name, ...)}
+        self.model_index = {code: tuple(dict.fromkeys(feature.model for feature in features))
+                            for code, features in code_index.items()}
 
     @classmethod
     def __create_table(cls, feature_table_position):
@@ -62,6 +133,15 @@ class _FeatureTable:
     def get_exist_model_name(self) -> list:
         return [i for i in self.table.keys()]
 
+    def get_features_by_code(self, code: str) -> tuple:
+        """
+        The features of every model that search the code ("code" or "system|code")
+        """
+        return self.code_index.get(str(code).rpartition('|')[2], ())
+
+    def get_models_by_code(self, code: str) -> tuple:
+        return self.model_index.get(str(code).rpartition('|')[2], ())
+
 
 class DataAliveTime:
     def __init__(self, data_alive_time):
@@ -72,6 +152,10 @@ class DataAliveTime:
         self._minutes = 0
         self._seconds = 0
         self.__set_data_alive_time(data_alive_time)
+        # The searches subtract it from the default time, so it's computed once
+        self.delta = relativedelta(years=self._years, months=self._months, days=self._days, hours=self._hours,
+                                   minutes=self._minutes, seconds=self._seconds)
+        self._repr = "DataAliveTime('{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}')".format(*self._as_tuple())
 
     def __set_data_alive_time(self, data_alive_time):
         time_prog = re.compile(
@@ -107,7 +191,34 @@ class DataAliveTime:
     def get_seconds(self):
         return self._seconds
 
-feature_table = _FeatureTable("./config/features.csv")
+    def _as_tuple(self):
+        return self._years, self._months, self._days, self._hours, self._minutes, self._seconds
+
+    def __eq__(self, other):
+        if not isinstance(other, DataAliveTime):
+            return NotImplemented
+        return self._as_tuple() == other._as_tuple()
+
+    def __hash__(self):
+        return hash(self._as_tuple())
+
+    def __repr__(self):
+        return self._repr
+
+
+class _CurrentFeatureTable:
+    """
+    The feature table of the active version of base.config_manager.table_manager, it follows the hot reloads.
+    A request that reads the table more than once should take table_manager.current once instead.
+    """
+
+    def __getattr__(self, name):
+        from base.config_manager import table_manager
+
+        return getattr(table_manager.current.feature_table, name)
+
+
+feature_table = _CurrentFeatureTable()
 
 if __name__ == '__main__':
     from exceptions import FeatureCodeIsEmpty
@@ -0,0 +1,103 @@
+import json
+import threading
+
+import requests
+from config import configObject as config
+from fhirpy import SyncFHIRClient
+from fhirpy.base.exceptions import OperationOutcome
+from fhirpy.base.exceptions import ResourceNotFound
+from fhirpy.base.utils import AttrDict
+from requests.adapters import HTTPAdapter
+
+
+class PooledSyncFHIRClient(SyncFHIRClient):
+    """
+    SyncFHIRClient sends every request with requests.request(), which opens a new connection each time.
+    PooledSyncFHIRClient sends them through one requests.Session instead, so the keep-alive connections are reused,
+    and the number of connections to the FHIR server is limited by pool_maxsize.
+    The clients of the same server with different authorizations can share one session, the Authorization header is
+    sent with each request.
+    """
+
+    def __init__(self, url, authorization=None, extra_headers=None, pool_maxsize: int = 10, timeout: float = None,
+                 session: requests.Session = None):
+        super(PooledSyncFHIRClient, self).__init__(url, authorization, extra_headers)
+        self.timeout = timeout
+        self._owns_session = session is None
+        self.session = new_session(pool_maxsize) if session is None else session
+
+    def _do_request(self, method, path, data=None, params=None):
+        # fhirpy has no way to pass a session, this is SyncClient._do_request of fhirpy 1.2.0 (the version pinned in
+        # requirement.txt and requirement-arm.txt) with the session, test_do_request_follows_fhirpy checks it
+        headers = self._build_request_headers()
+        url = self._build_request_url(path, params)
+        r = self.session.request(method, url, json=data, headers=headers, timeout=self.timeout)
+
+        if 200 <= r.status_code < 300:
+            return json.loads(
+                r.content.decode(), object_hook=AttrDict
+            ) if r.content else None
+
+        if r.status_code == 404 or r.status_code == 410:
+            raise ResourceNotFound(r.content.decode())
+
+        raise OperationOutcome(r.content.decode())
+
+    def close(self):
+        # A shared session is closed by its pool
+        if self._owns_session:
+            self.session.close()
+
+
+def new_session(pool_maxsize: int) -> requests.Session:
+    session = requests.Session()
+    # pool_block: a thread waits for a free connection instead of opening more than pool_maxsize connections
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class _FHIRClientPool:
+    """
+    Shares one persistent HTTP session per FHIR base URL, so every search of the same server reuses its connections.
+    The client without authorization is shared too. A client with authorization (e.g. the bearer token of a CDS Hooks
+    launch) is a light client on the shared session, so a new token doesn't leave a session behind.
+    get_client() is safe to call from several Flask threads at once.
+    """
+
+    def __init__(self, pool_maxsize: int = 10, timeout: float = None):
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        # {base url: PooledSyncFHIRClient without authorization}, the owner of the server's session
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, url: str = None, authorization: str = None) -> PooledSyncFHIRClient:
+        """
+        :param url: FHIR server base URL, default is config['fhir_server']['FHIR_SERVER_URL']
+        :param authorization: value of the Authorization header, e.g. "Bearer <access token>"
+        """
+        if url is None:
+            url = config['fhir_server']['FHIR_SERVER_URL']
+        url = url.rstrip('/')
+
+        client = self._clients.get(url)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(url)
+                if client is None:
+                    client = PooledSyncFHIRClient(url, pool_maxsize=self.pool_maxsize, timeout=self.timeout)
+                    self._clients[url] = client
+        if authorization is None:
+            return client
+        return PooledSyncFHIRClient(url, authorization, timeout=self.timeout, session=client.session)
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+client_pool = _FHIRClientPool(config['fhir_server']['POOL_MAXSIZE'], config['fhir_server']['REQUEST_TIMEOUT'])
@@ -1,6 +1,9 @@
 import csv
 import re
 
+from base.transform_rules import TransformPlan
+from base.transform_rules import compile_rule
+
 """
     data structure of _ModelFeature :
         {
@@ -37,6 +40,18 @@ type_list = [
 class _ModelFeature:
     def __init__(self, model_feature_table_position):
         self.table = self.__create_table(model_feature_table_position)
+        self.plans = self.__compile_table(self.table)
+
+    @staticmethod
+    def __compile_table(table: dict) -> dict:
+        """
+        Compile the rules of every feature (see base.transform_rules) and the TransformPlan of every model, an invalid
+        formula or index fails here instead of in a request.
+        """
+        for model_features in table.values():
+            for style in model_features.values():
+                style['rule'] = compile_rule(style)
+        return {model_name: TransformPlan(model_features) for model_name, model_features in table.items()}
 
     @classmethod
     def __create_table(cls, model_feature_table_position):
@@ -112,6 +127,12 @@ class _ModelFeature:
 
         return self.table[model_name]
 
+    def get_model_plan(self, model_name) -> TransformPlan:
+        if model_name not in self.plans:
+            raise KeyError("Model is not exist in the feature table.")
+
+        return self.plans[model_name]
+
 
 def transform_to_correct_type(input_string: str):
     if input_string.lower() == 'true':
@@ -130,11 +151,22 @@ def transform_to_correct_type(input_string: str):
     return output
 
 
+class _CurrentModelFeature:
+    """
+    The transformation table of the active version of base.config_manager.table_manager, it follows the hot reloads.
+    """
+
+    def __getattr__(self, name):
+        from base.config_manager import table_manager
+
+        return getattr(table_manager.current.transformation_table, name)
+
+
 if __name__ != "__main__":
-    feature_table = _ModelFeature("./config/transformation.csv")
+    feature_table = _CurrentModelFeature()
 
 if __name__ == "__main__":
     import json
 
     model_feature_table = _ModelFeature("../config/transformation.csv")
-    print(json.dumps(model_feature_table.get_model_feature_dict("CHARM"), sort_keys=True, indent=4))
+    print(json.dumps(model_feature_table.get_model_feature_dict("CHARM"), sort_keys=True, indent=4, default=repr))
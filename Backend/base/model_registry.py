@@ -0,0 +1,93 @@
+import os
+import threading
+
+import joblib
+
+
+class _ModelArtifact:
+    """
+    One model artifact on disk (e.g. ./models/diabetes/finalized_model.sav) and the object that was loaded from it.
+    The artifact is loaded on first use, and loaded again whenever its mtime changes.
+    """
+
+    def __init__(self, artifact_path, loader, hot_reload=True):
+        self.artifact_path = artifact_path
+        self.hot_reload = hot_reload
+        self._loader = loader
+        self._model = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._model is not None and not self.hot_reload:
+            return self._model
+
+        mtime = os.stat(self.artifact_path).st_mtime_ns
+        if self._model is None or mtime != self._mtime:
+            with self._lock:
+                # Other threads may have loaded the artifact while we were waiting for the lock
+                if self._model is None or mtime != self._mtime:
+                    self._model = self._loader(self.artifact_path)
+                    self._mtime = mtime
+        return self._model
+
+    def reload(self):
+        with self._lock:
+            self._model = self._loader(self.artifact_path)
+            self._mtime = os.stat(self.artifact_path).st_mtime_ns
+        return self._model
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+
+class _ModelRegistry:
+    """
+    The registry keeps every model artifact in memory, so predict() doesn't unpickle the whole model on each request.
+
+    Each model registers its artifact when the model module is imported:
+        model_registry.register("diabetes", "./models/diabetes/finalized_model.sav")
+    and gets the loaded estimator with:
+        model_registry.get("diabetes")
+    """
+
+    def __init__(self):
+        self._artifacts = {}
+        self._lock = threading.Lock()
+
+    def register(self, model_name: str, artifact_path: str, loader=joblib.load, hot_reload: bool = True) -> None:
+        with self._lock:
+            self._artifacts[model_name] = _ModelArtifact(artifact_path, loader, hot_reload)
+
+    def unregister(self, model_name: str) -> None:
+        with self._lock:
+            self._artifacts.pop(model_name, None)
+
+    def get(self, model_name: str):
+        try:
+            artifact = self._artifacts[model_name]
+        except KeyError:
+            raise KeyError("{} Model is not in the model registry.".format(model_name))
+        return artifact.get()
+
+    def reload(self, model_name: str = None) -> None:
+        names = self.get_registered_model_name() if model_name is None else [model_name]
+        for name in names:
+            self._artifacts[name].reload()
+
+    def preload(self) -> None:
+        """
+        Load every registered artifact now, e.g. at startup, instead of on the first request.
+        """
+        for name in self.get_registered_model_name():
+            self.get(name)
+
+    def is_loaded(self, model_name: str) -> bool:
+        return model_name in self._artifacts and self._artifacts[model_name].loaded
+
+    def get_registered_model_name(self) -> list:
+        return [i for i in self._artifacts.keys()]
+
+
+model_registry = _ModelRegistry()
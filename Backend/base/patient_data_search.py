@@ -1,30 +1,266 @@
+from __future__ import annotations
+
 import datetime
+from concurrent.futures import ALL_COMPLETED
+from concurrent.futures import FIRST_EXCEPTION
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from concurrent.futures import wait
 
+from config import configObject as config
+from fhirpy.lib import SyncFHIRClient
+from base.cache import CacheInterface
+from base.cache import cache_key
+from base.cache import feature_cache
+from base.fhir_client_pool import client_pool
+from base.resource_source import ResourceSourceInterface
 from base.search_sets import get_patient_resources
+from base.search_sets import get_patient_window_resources
 from base.search_sets import get_resource_datetime_and_value
+from base.search_sets import is_window_feature
+
+
+def _search_feature(patient_id: str, feature_table: dict, default_time, data_alive_time, client, source,
+                    cache: CacheInterface = None) -> dict:
+    if cache is not None:
+        key = cache_key(client.url, patient_id, feature_table, getattr(client, 'authorization', None))
+        result = cache.get(key)
+        if result is not None:
+            return dict(result)
+
+    data = get_patient_resources(patient_id, feature_table, default_time, data_alive_time, client, source)
+    result = dict()
+    # get_resource_datetime_and_value returns two values, date & value.
+    # for other purpose, use other functions instead
+    result['date'], result['value'] = get_resource_datetime_and_value(data, default_time)
+
+    if cache is not None:
+        cache.set(key, dict(result))
+    return result
+
+
+def _get_cache(use_cache: bool, default_time, source) -> CacheInterface | None:
+    # Only the searches until now are cached, the searches of the prefetched data don't need the cache
+    if not use_cache or default_time is not None or source is not None:
+        return None
+    return feature_cache
+
+
+def _search_window_features(patient_id: str, feature_tables: dict, default_time, data_alive_time, client, source,
+                            cache: CacheInterface = None) -> dict:
+    """
+    Search the window features (e.g. the mean and the count) of the same Observation code and data_alive_time, the
+    Observations are fetched once for all of them.
+    :return: {feature: {"date": date, "value": value} or the exception of the feature}
+    """
+    result_dict = dict()
+    keys = dict()
+    if cache is not None:
+        for name, feature_table in feature_tables.items():
+            keys[name] = cache_key(client.url, patient_id, feature_table, getattr(client, 'authorization', None))
+            result = cache.get(keys[name])
+            if result is not None:
+                result_dict[name] = dict(result)
+
+    missing = [name for name in feature_tables if name not in result_dict]
+    if len(missing) != 0:
+        datas = get_patient_window_resources(patient_id, [feature_tables[name] for name in missing], default_time,
+                                             data_alive_time, client, source)
+        for name, data in zip(missing, datas):
+            if isinstance(data, Exception):
+                result_dict[name] = data
+                continue
+            result = dict()
+            result['date'], result['value'] = get_resource_datetime_and_value(data, default_time)
+            if cache is not None:
+                cache.set(keys[name], dict(result))
+            result_dict[name] = result
+    return result_dict
+
+
+def _search_task(patient_id: str, table: dict, names: list, default_time, data_alive_time, client, source,
+                 cache: CacheInterface = None) -> dict:
+    if len(names) == 1:
+        return {names[0]: _search_feature(patient_id, table[names[0]], default_time, data_alive_time, client, source,
+                                          cache)}
+    return _search_window_features(patient_id, {name: table[name] for name in names}, default_time, data_alive_time,
+                                   client, source, cache)
+
+
+def _search_tasks(table: dict) -> list:
+    """
+    Group the features into searches, [[feature]]. The window features of the same Observation code and
+    data_alive_time are one search, every other feature is a search by itself.
+    """
+    tasks = []
+    window_tasks = dict()
+    for name, feature_table in table.items():
+        if not is_window_feature(feature_table):
+            tasks.append([name])
+            continue
+        key = (feature_table['code'], feature_table['data_alive_time'])
+        if key not in window_tasks:
+            window_tasks[key] = [name]
+            tasks.append(window_tasks[key])
+        else:
+            window_tasks[key].append(name)
+    return tasks
+
+
+def _search_features(patient_id: str, table: dict, default_time, data_alive_time, max_workers: int, timeout: float,
+                     client: SyncFHIRClient, source: ResourceSourceInterface = None, cache: CacheInterface = None,
+                     return_exceptions: bool = False) -> dict:
+    """
+    Run the searches of every feature of the table, and return {feature: {"date": date, "value": value}}.
+    If return_exceptions is True, the exception of a failed search is put into the result instead of being raised.
+    """
+    tasks = _search_tasks(table)
+    task_results = []
+    if max_workers <= 1 or len(tasks) <= 1:
+        for names in tasks:
+            try:
+                task_results.append(_search_task(patient_id, table, names, default_time, data_alive_time, client,
+                                                 source, cache))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                task_results.append({name: e for name in names})
+    else:
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(tasks)))
+        try:
+            futures = [
+                (names, executor.submit(_search_task, patient_id, table, names, default_time, data_alive_time, client,
+                                        source, cache))
+                for names in tasks
+            ]
+            # One deadline for all the searches, not one timeout for each of them. Without return_exceptions the first
+            # failed search ends the wait.
+            done, _ = wait([future for _, future in futures], timeout=timeout,
+                           return_when=ALL_COMPLETED if return_exceptions else FIRST_EXCEPTION)
+            if not return_exceptions:
+                for _, future in futures:
+                    if future in done and future.exception() is not None:
+                        raise future.exception()
+            for names, future in futures:
+                # Raises the search's exception (e.g. ResourceNotFound) or concurrent.futures.TimeoutError
+                try:
+                    if future not in done:
+                        future.cancel()
+                        raise TimeoutError("The search of {} didn't finish in {} seconds".format(
+                            ", ".join(map(str, names)), timeout))
+                    task_results.append(future.result())
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    task_results.append({name: e for name in names})
+        finally:
+            # Don't wait for the searches that are still running when one of them failed or the deadline passed
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    result_dict = dict()
+    for task_result in task_results:
+        result_dict.update(task_result)
+    for key in table:
+        if isinstance(result_dict[key], Exception) and not return_exceptions:
+            raise result_dict[key]
+    return {key: result_dict[key] for key in table}
 
 
 def model_feature_search_with_patient_id(patient_id: str,
                                          table: dict,
                                          default_time: str = None,
-                                         data_alive_time: str = None):
+                                         data_alive_time: str = None,
+                                         max_workers: int = None,
+                                         timeout: float = None,
+                                         client: SyncFHIRClient = None,
+                                         source: ResourceSourceInterface = None,
+                                         use_cache: bool = True):
+    """
+    Search every feature in the table for the patient, and return {feature: {"date": date, "value": value}}.
+
+    The features are searched concurrently, so the latency follows the slowest single search instead of the sum of all
+    of them.
+    :param max_workers: number of searches running at the same time, default is config['feature_search']['MAX_WORKERS'].
+                        With max_workers=1 the features are searched one by one in the caller's thread.
+    :param timeout: seconds to wait for all the feature searches, default is config['feature_search']['TIMEOUT'].
+    :param client: the FHIR client to search with, default is the pooled client of the configured FHIR server.
+    :param source: local resources (e.g. CDS Hooks prefetch) that are searched before the FHIR server.
+    :param use_cache: use base.cache.feature_cache for the searches until now (default_time is None).
+    """
+    cache = _get_cache(use_cache, default_time, source)
+    if client is None:
+        client = client_pool.get_client()
     if default_time is None:
         default_time = datetime.datetime.now()
+    if max_workers is None:
+        max_workers = config['feature_search']['MAX_WORKERS']
+    if timeout is None:
+        timeout = config['feature_search']['TIMEOUT']
 
-    data = dict()
-    for key in table:
-        data[key] = dict()
-        data[key] = get_patient_resources(patient_id, table[key], default_time, data_alive_time)
+    return _search_features(patient_id, table, default_time, data_alive_time, max_workers, timeout, client, source,
+                            cache)
 
-    result_dict = dict()
-    for data_key in data:
-        result_dict[data_key] = dict()
-        # get_resource_datetime_and_value returns two values, date & value.
-        # for other purpose, use other functions instead
-        result_dict[data_key]['date'], result_dict[data_key]['value'] = get_resource_datetime_and_value(
-            data[data_key], default_time)
 
-    return result_dict
+def feature_search_key(feature_table: dict) -> tuple:
+    """
+    Features with the same key get the same search result, no matter which model or feature name they belong to.
+    """
+    # The compiled features (base.feature_table.FeatureSpec) have computed it at load time
+    if hasattr(feature_table, 'search_key'):
+        return feature_table.search_key
+    return (str(feature_table['type_of_data']).lower(), feature_table['code'], feature_table['data_alive_time'],
+            str(feature_table['search_type']).lower(), feature_table['default_value'])
+
+
+def models_feature_search_with_patient_id(patient_id: str,
+                                          tables: dict,
+                                          default_time: str = None,
+                                          data_alive_time: str = None,
+                                          max_workers: int = None,
+                                          timeout: float = None,
+                                          client: SyncFHIRClient = None,
+                                          source: ResourceSourceInterface = None,
+                                          use_cache: bool = True) -> dict:
+    """
+    Search the features of several models for the patient. The features shared by the models (see feature_search_key)
+    are searched only once, and the results are fanned out to every model that uses them.
+
+    :param tables: {model name: model's feature table}
+    :return: {model name: {feature: {"date": date, "value": value}}}. If one of the model's features failed to be
+             searched, the value of the model is the exception (e.g. ResourceNotFound) instead.
+    """
+    cache = _get_cache(use_cache, default_time, source)
+    if client is None:
+        client = client_pool.get_client()
+    if default_time is None:
+        default_time = datetime.datetime.now()
+    if max_workers is None:
+        max_workers = config['feature_search']['MAX_WORKERS']
+    if timeout is None:
+        timeout = config['feature_search']['TIMEOUT']
+
+    # The union of the distinct searches of all models
+    plan = dict()
+    for model_name, table in tables.items():
+        for feature_name, feature_table in table.items():
+            plan.setdefault(feature_search_key(feature_table), feature_table)
+
+    search_results = _search_features(patient_id, plan, default_time, data_alive_time, max_workers, timeout, client,
+                                      source, cache, return_exceptions=True)
+
+    models_result_dict = dict()
+    for model_name, table in tables.items():
+        result_dict = dict()
+        for feature_name, feature_table in table.items():
+            search_result = search_results[feature_search_key(feature_table)]
+            if isinstance(search_result, Exception):
+                result_dict = search_result
+                break
+            # Each model gets its own copy, models may change the value while predicting (e.g. qcsi's o2_flow_rate)
+            result_dict[feature_name] = dict(search_result)
+        models_result_dict[model_name] = result_dict
+
+    return models_result_dict
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import math
+from typing import List
+from urllib.parse import quote
+
+from base.resource_source import ResourceSourceInterface
+
+PATIENT_ID_TOKEN = "{{context.patientId}}"
+
+
+def prefetch_key(type_of_data: str, code: str = None) -> str:
+    type_of_data = str(type_of_data).lower()
+    if type_of_data == "patient":
+        return "patient"
+    return "{}-{}".format(type_of_data, code)
+
+
+def alive_days(data_alive_time) -> int:
+    """
+    Whole days that cover the data_alive_time, a month is taken as 31 days and a year as 366 days, so the prefetch
+    never misses data that the search keeps.
+    """
+    seconds = data_alive_time.get_hours() * 3600 + data_alive_time.get_minutes() * 60 + data_alive_time.get_seconds()
+    return (data_alive_time.get_years() * 366 + data_alive_time.get_months() * 31 + data_alive_time.get_days()
+            + math.ceil(seconds / 86400))
+
+
+def build_prefetch_templates(feature_table) -> dict:
+    """
+    Build the CDS Hooks prefetch templates of every feature in the feature table, one query per distinct
+    (type_of_data, code). The observations are bounded by the longest data_alive_time of the features of the code,
+    with the FHIRPath token {{today() - n days}}, the exact date range is still filtered by PrefetchBundles.
+    The templates follow the feature table, so they are built again from table_manager.current after a reload.
+    """
+    templates, observation_days = dict(), dict()
+    for model_name in feature_table.get_exist_model_name():
+        for feature in feature_table.get_model_feature_dict(model_name).values():
+            type_of_data = str(feature['type_of_data']).lower()
+            key = prefetch_key(type_of_data, feature['code'])
+            if type_of_data == "observation":
+                observation_days[key] = max(observation_days.get(key, 0), alive_days(feature['data_alive_time']))
+            if key in templates:
+                continue
+
+            code = quote(str(feature['code']), safe=',')
+            if type_of_data == "patient":
+                templates[key] = "Patient/{}".format(PATIENT_ID_TOKEN)
+            elif type_of_data == "observation":
+                # combo-code matches both Observation.code and Observation.component.code
+                templates[key] = "Observation?subject={}&combo-code={}&_sort=-date".format(PATIENT_ID_TOKEN, code)
+            elif type_of_data == "condition":
+                templates[key] = "Condition?subject={}&code={}".format(PATIENT_ID_TOKEN, code)
+    for key, days in observation_days.items():
+        templates[key] += "&date=ge{{{{today() - {} days}}}}".format(days)
+    return templates
+
+
+def _codings(codeable_concept) -> list:
+    if not isinstance(codeable_concept, dict):
+        return []
+    return codeable_concept.get('coding', [])
+
+
+def _match_codings(codings: list, code: str) -> bool:
+    for token in code.split(','):
+        system, _, value = token.rpartition('|')
+        for coding in codings:
+            if coding.get('code') == value and (not system or coding.get('system') == system):
+                return True
+    return False
+
+
+def _match_code(resource: dict, code: str) -> bool:
+    if _match_codings(_codings(resource.get('code')), code):
+        return True
+    return any(_match_codings(_codings(component.get('code')), code) for component in resource.get('component', []))
+
+
+def _effective_date(resource: dict) -> str:
+    effective = resource.get('effectiveDateTime')
+    if effective is None:
+        effective = (resource.get('effectivePeriod') or {}).get('start', '')
+    return effective
+
+
+def _reference_id(reference: dict) -> str:
+    return str((reference or {}).get('reference', '')).split('/')[-1]
+
+
+class PrefetchBundles(ResourceSourceInterface):
+    """
+    Answers the feature searches from the prefetch of a CDS Hooks request, which was built by the templates of
+    build_prefetch_templates(). The resources are searched on the FHIR server instead (search returns None) if:
+        - their prefetch key is missing, or the CDS Client couldn't prefetch them (null)
+        - the Bundle has a next page, it's only the first page of the results, e.g. max or count would be wrong
+        - the prefetched resources are not of the patient
+    """
+
+    def __init__(self, prefetch: dict):
+        self.prefetch = prefetch or {}
+
+    def search(self, type_of_data: str, patient_id: str, code: str = None, since: str = None) -> List[dict] | None:
+        type_of_data = str(type_of_data).lower()
+        data = self.prefetch.get(prefetch_key(type_of_data, code))
+        # The CDS Client sends null if it couldn't prefetch the data
+        if data is None:
+            return None
+
+        if data.get('resourceType') == 'Bundle':
+            if any(link.get('relation') == 'next' for link in data.get('link', [])):
+                return None
+            resources = [entry['resource'] for entry in data.get('entry', []) if 'resource' in entry]
+        else:
+            resources = [data]
+
+        resource_type = type_of_data.capitalize()
+        resources = [i for i in resources if i.get('resourceType') == resource_type]
+        if type_of_data == "patient":
+            return [i for i in resources if i.get('id') == patient_id] or None
+
+        patient_resources = [i for i in resources if _reference_id(i.get('subject')) == patient_id]
+        if resources and not patient_resources:
+            # Prefetched for another patient, it says nothing about this one
+            return None
+        resources = [i for i in patient_resources if _match_code(i, code)]
+        if since is not None and type_of_data == "observation":
+            resources = [i for i in resources if _effective_date(i)[:len(since)] >= since]
+        return resources
@@ -0,0 +1,97 @@
+import importlib.util
+import os
+
+from config import configObject as config
+from base.config_manager import table_manager
+from base.model_registry import model_registry
+
+"""
+    The production server of the API, `python -m Backend serve --production`, or of the CDS Hooks service,
+    `python -m Backend serve --production --app cds-hooks`.
+    gunicorn runs the flask app in config['server']['WORKERS'] worker processes with THREADS threads each. The app, the
+    models, the feature and transformation tables and the qCSI mask mart are loaded once in the master before it forks
+    the workers, so the workers share that memory (copy-on-write) and none of them loads anything at its first request.
+    The table watcher is a thread, threads are not forked, so every worker starts its own watcher.
+"""
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# {app: the key of its address in config['server']}
+APPS = {"api": "BIND", "cds-hooks": "CDS_HOOKS_BIND"}
+
+
+def server_options(bind: str = None, workers: int = None, threads: int = None, timeout: int = None,
+                   app: str = "api") -> dict:
+    """
+    The gunicorn settings, the arguments that are None are read from config['server'].
+    """
+    server_config = config['server']
+    workers = workers or server_config['WORKERS'] or (os.cpu_count() or 1) * 2 + 1
+    return {
+        "bind": bind or server_config[APPS[app]],
+        "workers": workers,
+        "threads": threads or server_config['THREADS'],
+        "worker_class": "gthread",
+        "timeout": server_config['TIMEOUT'] if timeout is None else timeout,
+        "graceful_timeout": server_config['GRACEFUL_TIMEOUT'],
+        "keepalive": server_config['KEEPALIVE'],
+        "preload_app": True,
+        "post_fork": post_fork,
+    }
+
+
+def load_app(app: str = "api"):
+    """
+    The flask app of the API (app.py) or of the CDS Hooks service (cds-hooks.py)
+    """
+    if app == "api":
+        from app import app as flask_app
+        return flask_app
+    if app == "cds-hooks":
+        # The file name is not a module name, it's loaded from its path
+        spec = importlib.util.spec_from_file_location("cds_hooks", os.path.join(BACKEND_DIR, "cds-hooks.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.app.server
+    raise AttributeError("'{}' app is not supported, expect one of {}.".format(app, ", ".join(APPS)))
+
+
+def preload(app: str = "api"):
+    """
+    Load everything the requests need, return the flask app.
+    """
+    from models.qcsi import mask
+
+    flask_app = load_app(app)
+    model_registry.preload()
+    table_manager.current
+    # The mask types are compiled into the matcher
+    mask.mask_mart.snapshot
+    return flask_app
+
+
+def post_fork(server, worker) -> None:
+    table_manager.start()
+
+
+def run(options: dict, app: str = "api") -> None:
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise ImportError("The production server requires gunicorn, install it with `pip install gunicorn`.")
+
+    class ProductionServer(BaseApplication):
+        def __init__(self, application, settings: dict):
+            self.application = application
+            self.settings = settings
+            super(ProductionServer, self).__init__()
+
+        def load_config(self):
+            for key, value in self.settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    # Loaded here, in the master, before the workers are forked
+    ProductionServer(preload(app), options).run()
@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import List
+
+
+class ResourceSourceInterface(ABC):
+    """
+    A local source of FHIR resources (e.g. the prefetch of a CDS Hooks request) that the resource strategies in
+    base.search_sets ask before searching the FHIR server.
+    """
+
+    @abstractmethod
+    def search(self, type_of_data: str, patient_id: str, code: str = None, since: str = None) -> List[dict] | None:
+        """
+        :param type_of_data: "observation", "condition" or "patient", same as the type_of_data column of features.csv
+        :param patient_id: patient's id
+        :param code: the code of the feature, "system|code" or "code", several codes are joined with ","
+        :param since: FHIR date, only resources at or after it are returned
+        :return: list of resources in JSON dict. None if the source doesn't hold the data, then the FHIR server is
+                 searched instead. An empty list means the source knows the patient has no such data.
+        """
+        pass
@@ -3,17 +3,23 @@ from __future__ import annotations
 import configparser
 import re
 from abc import ABC, abstractmethod
+from functools import lru_cache
 from typing import Dict
+from typing import Tuple
 
+import numpy
+import pandas
 from config import configObject as config
-from dateutil.relativedelta import relativedelta
-from fhirpy import SyncFHIRClient
+from fhirpy.base.exceptions import OperationOutcome
 from fhirpy.base.exceptions import ResourceNotFound
 from fhirpy.base.searchset import FHIR_DATE_FORMAT
 from fhirpy.base.searchset import datetime
+from fhirpy.lib import SyncFHIRClient
 from fhirpy.lib import SyncFHIRResource
 
-CLIENT: SyncFHIRClient = SyncFHIRClient(config['fhir_server']['FHIR_SERVER_URL'])
+from base.cache import LRUCache
+from base.fhir_client_pool import client_pool
+from base.resource_source import ResourceSourceInterface
 
 
 # FHIR_DATE_FORMAT='%Y-%m-%d'
@@ -71,34 +77,209 @@ class GetFuncInterface(ABC):
     Strategies.
     """
 
+    # If the strategy only uses the first resource of the sorted search results, the resource strategy asks the server
+    # for one resource (_count=1) instead of fetching the whole searchset.
+    single_result = False
+    # The Aggregation of the Observations' values. The searchset is aggregated page by page in a single pass, the
+    # resources are never collected into a list.
+    aggregation = None
+    # The _sort that puts the aggregation's result first, then the server is asked for that one resource only.
+    # Only Observation.valueQuantity can be sorted: a component sort (e.g. blood pressure) isn't bound to the code.
+    server_sort = None
+
     @abstractmethod
     def execute(self, data: dict) -> dict:
         pass
 
 
+class Aggregation(ABC):
+    """
+    Single pass aggregation of the Observations' values. add() is called with every resource and its value (None if
+    the resource has no numeric value of the code) in the order of the searchset (latest first), then result() returns
+    a resource (e.g. the maximum) or a value (e.g. the mean).
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    @abstractmethod
+    def add(self, resource, value) -> None:
+        pass
+
+    @abstractmethod
+    def result(self):
+        """
+        None if there is no value to aggregate
+        """
+        pass
+
+
+class MaxValue(Aggregation):
+    def __init__(self):
+        super(MaxValue, self).__init__()
+        self.resource = None
+        self.value = None
+
+    def better(self, value) -> bool:
+        return value > self.value
+
+    def add(self, resource, value) -> None:
+        if value is None:
+            return
+        self.count += 1
+        # With the same value, the first one (the latest) is kept
+        if self.value is None or self.better(value):
+            self.resource, self.value = resource, value
+
+    def result(self):
+        return self.resource
+
+
+class MinValue(MaxValue):
+    def better(self, value) -> bool:
+        return value < self.value
+
+
 class GetMax(GetFuncInterface):
+    aggregation = MaxValue
+    server_sort = '-value-quantity'
+
     def execute(self, data: dict) -> dict:
         """
-        For Observation used only, Return the maximum SyncFHIRResources
-        @todo: Complete the code.
-        @param data:
-        @return:
+        For Observation used only, the resource with the maximum value of the code
+        @param data: {"resource": list(SyncFHIRResources) or default value, "component_code": None or str,
+                      "type": "Observation"}
+        @return: data with the maximum SyncFHIRResource
         """
-        pass
+        return _aggregate(data, MaxValue)
 
 
 class GetMin(GetFuncInterface):
+    aggregation = MinValue
+    server_sort = 'value-quantity'
+
     def execute(self, data: dict) -> dict:
         """
-        For Observation used only, Return the minimum SyncFHIRResources
-        @todo: Complete the code.
-        @param data:
-        @return:
+        For Observation used only, the resource with the minimum value of the code
+        @param data: {"resource": list(SyncFHIRResources) or default value, "component_code": None or str,
+                      "type": "Observation"}
+        @return: data with the minimum SyncFHIRResource
+        """
+        return _aggregate(data, MinValue)
+
+
+class ObservationSeries(object):
+    """
+    The values of the code in the Observations of the window, in the order of the searchset (latest first)
+    """
+
+    def __init__(self, resource=None):
+        # The latest resource, it tells whether the code is in Observation.code or in the components
+        self.resource = resource
+        self.dates = []
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+
+class Series(Aggregation):
+    """
+    Collect the values of the window, the window search types (mean, count, delta, slope) are all computed from the
+    same series, so several of them of the same code and data_alive_time share the fetched pages.
+    """
+
+    def __init__(self):
+        super(Series, self).__init__()
+        self.series = ObservationSeries()
+
+    def add(self, resource, value) -> None:
+        if value is None:
+            return
+        self.count += 1
+        if self.series.resource is None:
+            self.series.resource = resource
+        self.series.dates.append(_local_effective_date(resource))
+        self.series.values.append(value)
+
+    def result(self):
+        return self.series if len(self.series) != 0 else None
+
+
+class GetWindowInterface(GetFuncInterface):
+    """
+    The window search types aggregate every value of the code within data_alive_time into one number.
+    """
+
+    aggregation = Series
+    # If True, no resource in the window is a valid result (e.g. count is 0) instead of a missing feature
+    accepts_empty = False
+    # The least number of values the aggregation needs
+    min_values = 1
+
+    @staticmethod
+    @abstractmethod
+    def aggregate(days: numpy.ndarray, values: numpy.ndarray) -> float:
+        """
+        :param days: days of the values since the earliest one, in ascending order
+        :param values: the values of the days
         """
         pass
 
+    def execute(self, data: dict) -> dict:
+        """
+        For Observation used only, the aggregation of the values in the window
+        @param data: {"resource": list(SyncFHIRResources or ObservationSeries) or default value,
+                      "component_code": None or str, "type": "Observation"}
+        @return: data with a SyncFHIRResource of the aggregated value, dated by the latest value
+        """
+        return _aggregate_window(data, self._strategy)
+
+
+class GetMean(GetWindowInterface):
+    @staticmethod
+    def aggregate(days: numpy.ndarray, values: numpy.ndarray) -> float:
+        return float(values.mean())
+
+
+class GetCount(GetWindowInterface):
+    accepts_empty = True
+    min_values = 0
+
+    @staticmethod
+    def aggregate(days: numpy.ndarray, values: numpy.ndarray) -> int:
+        return int(values.size)
+
+
+class GetDelta(GetWindowInterface):
+    """
+    The change since the baseline, the latest value minus the earliest value of the window
+    """
+    min_values = 2
+
+    @staticmethod
+    def aggregate(days: numpy.ndarray, values: numpy.ndarray) -> float:
+        return float(values[-1] - values[0])
+
+
+class GetSlope(GetWindowInterface):
+    """
+    The least squares slope of the values, in value per day
+    """
+    min_values = 2
+
+    @staticmethod
+    def aggregate(days: numpy.ndarray, values: numpy.ndarray) -> float:
+        days = days - days.mean()
+        denominator = (days * days).sum()
+        if denominator == 0:
+            raise ResourceNotFound("The values are all measured at the same time, the slope is undefined")
+        return float((days * (values - values.mean())).sum() / denominator)
+
 
 class GetLatest(GetFuncInterface):
+    single_result = True
+
     def execute(self, data: dict) -> dict:
         """
         GetLatest是每個feature預設的Search Type，所以如果現在是Patient的get_age，也會因為工作流程的關係而需要調用此函式，
@@ -156,10 +337,15 @@ class ResourceMgmt:
         self._strategy = strategy
 
     def get_data_with_resources(self, patient_id: str,
-                                table: Dict, default_time: datetime, data_alive_time=None) -> Dict:
+                                table: Dict, default_time: datetime, data_alive_time=None,
+                                client: SyncFHIRClient = None, source: ResourceSourceInterface = None) -> Dict:
         """
         The Context delegates some work to the Strategy object instead of
         implementing multiple versions of the algorithm on its own.
+
+        The client is given to the Strategy explicitly, if it's None, the shared client of
+        config['fhir_server']['FHIR_SERVER_URL'] is taken from the client pool.
+        If the source is given, the Strategy asks it first and only searches the FHIR server on a miss.
         """
 
         # ...
@@ -167,9 +353,10 @@ class ResourceMgmt:
             raise AttributeError("Strategy was not set yet. Set the strategy with 'foo.strategy = bar()'")
 
         print("Getting patient's data with {} resources".format(self._strategy.__name__))
-        global CLIENT
-        CLIENT = SyncFHIRClient(config['fhir_server']['FHIR_SERVER_URL'])
-        resource_list = self._strategy.search(self, patient_id, table, default_time, data_alive_time)
+        if client is None:
+            client = client_pool.get_client(config['fhir_server']['FHIR_SERVER_URL'])
+        resource_list = self._strategy.search(self, patient_id, table, default_time, data_alive_time, client,
+                                              source)
         return resource_list
 
     def get_datetime_with_resources(self, data_dictionary: Dict, default_time: datetime):
@@ -199,7 +386,8 @@ class ResourcesInterface(ABC):
     """
 
     @abstractmethod
-    def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
+    def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None,
+               client: SyncFHIRClient = None, source: ResourceSourceInterface = None) -> Dict:
         pass
 
 
@@ -249,58 +437,293 @@ def _return_date_time_formatter(datetime_string: str) -> str or None:
     return None
 
 
+def search_func(search_type: str):
+    """
+    The Concrete GetFuncInterface of the search_type (e.g. "max" is GetMax), None if it's not supported
+    """
+    get_func = globals().get("Get" + str(search_type).capitalize())
+    if isinstance(get_func, type) and issubclass(get_func, GetFuncInterface):
+        return get_func
+    return None
+
+
+def resource_strategy(type_of_data: str):
+    """
+    The Concrete ResourcesInterface of the type_of_data (e.g. "observation" is Observation), None if it's not supported
+    """
+    strategy = globals().get(str(type_of_data).capitalize())
+    if isinstance(strategy, type) and issubclass(strategy, ResourcesInterface):
+        return strategy
+    return None
+
+
+def _get_func(table: dict):
+    # The compiled features (base.feature_table.FeatureSpec) have found it at load time
+    if hasattr(table, 'get_func'):
+        return table.get_func
+    return search_func(table['search_type'])
+
+
+def _resource_strategy(table: dict):
+    if hasattr(table, 'resource_strategy') and table.resource_strategy is not None:
+        return table.resource_strategy
+    return globals()[str(table["type_of_data"]).capitalize()]
+
+
+@lru_cache(maxsize=1024)
+def code_tokens(code: str) -> Tuple[Tuple[str, str], ...]:
+    """
+    ((system, code), ...) of the feature's code "system|code,code...", the system is '' if it's not given
+    """
+    return tuple((system, value) for system, _, value in (token.rpartition('|') for token in str(code).split(',')))
+
+
+def _fetch_searchset(search, table: dict, path: str = None) -> list:
+    """
+    Fetch the searchset as a list of resources. When the search_type only needs the first resource (e.g. latest),
+    only one resource is requested from the server with _count=1. When the search_type aggregates the values
+    (e.g. max), the server sorts by the value if it can, otherwise the pages are aggregated one by one and only the
+    result is returned.
+    """
+    get_func = _get_func(table)
+    if get_func is not None and get_func.single_result:
+        resource = search.first()
+        return [] if resource is None else [resource]
+    if get_func is None or get_func.aggregation is None:
+        return search.fetch_all()
+
+    if get_func.server_sort is not None and path == 'code':
+        try:
+            resource = search.sort(get_func.server_sort).first()
+            # The server puts the resources without value last, if the first one has no value, none has
+            if resource is None or _observation_value(resource, table['code']) is not None:
+                return [] if resource is None else [resource]
+        except OperationOutcome:
+            # The server doesn't support sorting by value-quantity
+            pass
+
+    aggregation = get_func.aggregation()
+    for resource in search:
+        aggregation.add(resource, _observation_value(resource, table['code']))
+    result = aggregation.result()
+    return [] if result is None else [result]
+
+
+def _aggregate(data: dict, aggregation_class) -> dict:
+    """
+    Aggregate the Observations in data['resource'], which are either the searchset or the local resources.
+    """
+    resources = data['resource']
+    # The default value
+    if type(resources) != list:
+        return data
+
+    aggregation = aggregation_class()
+    for resource in resources:
+        aggregation.add(resource, _observation_value(resource, data['code']))
+    result = aggregation.result()
+    if result is None:
+        raise ResourceNotFound("Could not find any value of {} in the resources".format(data['code']))
+    data['resource'] = result
+    return data
+
+
+def _window_series(resources: list, code: str) -> ObservationSeries:
+    """
+    The series of data['resource'], which is either [ObservationSeries] of the searchset or the local resources
+    """
+    if len(resources) == 1 and isinstance(resources[0], ObservationSeries):
+        return resources[0]
+    aggregation = Series()
+    for resource in resources:
+        aggregation.add(resource, _observation_value(resource, code))
+    return aggregation.series
+
+
+def effective_days(dates: list) -> numpy.ndarray:
+    """
+    Days since the epoch of the FHIR dates/dateTimes, the dateTimes without time zone are taken as UTC
+    """
+    # Parsed one by one, to_datetime() of pandas < 2.0 can't parse dates and dateTimes of several formats together
+    return numpy.asarray([_utc_timestamp(date).value for date in dates], dtype=float) / 86400e9
+
+
+def _utc_timestamp(date) -> pandas.Timestamp:
+    time = pandas.Timestamp(date)
+    return time.tz_localize('UTC') if time.tzinfo is None else time.tz_convert('UTC')
+
+
+def _aggregate_window(data: dict, window) -> dict:
+    """
+    Aggregate the values of data['resource'] with the window search type in one vectorized pass, and replace the
+    resources with an Observation of the result.
+    """
+    resources = data['resource']
+    # The default value
+    if type(resources) != list:
+        return data
+
+    series = _window_series(resources, data['code'])
+    if len(series) < window.min_values:
+        raise ResourceNotFound("Could not find {count} values of {code} in the resources, {name} needs at least "
+                               "{count}".format(count=window.min_values, code=data['code'],
+                                                name=window.__name__[3:].lower()))
+    if len(series) == 0:
+        data['resource'] = window.aggregate(numpy.array([]), numpy.array([]))
+        data['component_code'] = None
+        return data
+
+    days = effective_days(series.dates)
+    order = numpy.argsort(days, kind='stable')
+    days = days[order] - days[order][0]
+    values = numpy.asarray(series.values, dtype=float)[order]
+    latest = series.dates[order[-1]]
+
+    codings = [{'system': system, 'code': value} if system else {'code': value}
+               for system, value in code_tokens(data['code'])]
+    data['resource'] = SyncFHIRResource(None, 'Observation', code={'coding': codings}, effectiveDateTime=latest,
+                                        valueQuantity={'value': window.aggregate(days, values)})
+    data['component_code'] = None
+    return data
+
+
+def _observation_value(resource, code: str) -> int or float or None:
+    """
+    The valueQuantity of the code in the Observation, either Observation.valueQuantity if the code is in
+    Observation.code, or the valueQuantity of the component with the code
+    """
+    tokens = code_tokens(code)
+
+    def match(codeable_concept) -> bool:
+        for coding in (codeable_concept or {}).get('coding', []):
+            for system, value in tokens:
+                if coding.get('code') == value and (not system or coding.get('system') == system):
+                    return True
+        return False
+
+    if match(resource.get('code')):
+        elements = [resource]
+    else:
+        elements = [component for component in resource.get('component', []) if match(component.get('code'))]
+    for element in elements:
+        value = (element.get('valueQuantity') or {}).get('value')
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+    return None
+
+
+# Remembers where each Observation code of a FHIR server was found last time, "code" for Observation.code or
+# "component_code" for Observation.component.code, so later searches of the code go straight to the right search
+# parameter. The key is (fhir base url, code), the least recently used codes are dropped.
+OBSERVATION_CODE_PATHS = 1024
+_observation_code_path = LRUCache(OBSERVATION_CODE_PATHS, ttl=float('inf'))
+OTHER_CODE_PATH = {'code': 'component_code', 'component_code': 'code'}
+
+
+def _is_in_component(resource: SyncFHIRResource, code: str) -> bool:
+    """
+    Return True if the code is not in Observation.code of the resource, that means the resource was found by one of
+    its components.
+    """
+    if isinstance(resource, ObservationSeries):
+        resource = resource.resource
+    codes = [value for _, value in code_tokens(code)]
+    try:
+        return not any(coding.code in codes for coding in resource.code.coding)
+    except (AttributeError, KeyError):
+        return True
+
+
+def _local_effective_date(resource: dict) -> str:
+    return resource.get('effectiveDateTime') or (resource.get('effectivePeriod') or {}).get('start', '')
+
+
+def get_data_time_since(table: dict, default_time: datetime) -> str:
+    """
+    The FHIR date of the oldest data that is still alive, default_time - the feature's data_alive_time
+    """
+    return (default_time - table['data_alive_time'].delta).strftime(FHIR_DATE_FORMAT)
+
+
+def _search_observation_by_path(resources, patient_id: str, data_time_since: str, code: str, path: str, table: dict):
+    search = resources.search(
+        subject=patient_id,
+        date__ge=data_time_since,
+        **{path: code}
+    ).sort('-date')
+    return _fetch_searchset(search, table, path)
+
+
 class Observation(ResourcesInterface, GetValueAndDatetimeInterface):
-    def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
-        data_time_since = (default_time - relativedelta(
-            years=table['data_alive_time'].get_years(),
-            months=table['data_alive_time'].get_months(),
-            days=table['data_alive_time'].get_days(),
-            hours=table['data_alive_time'].get_hours(),
-            minutes=table['data_alive_time'].get_minutes(),
-            seconds=table['data_alive_time'].get_seconds()
-        )).strftime(FHIR_DATE_FORMAT)
+    def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None,
+               client: SyncFHIRClient = None, source: ResourceSourceInterface = None) -> Dict:
+        data_time_since = get_data_time_since(table, default_time)
         code = table['code']
         default_value = table['default_value']
 
-        resources = CLIENT.resources('Observation')
-        search = resources.search(
-            subject=patient_id,
-            date__ge=data_time_since,
-            code=code
-        ).sort('-date')
-        results = search.fetch()
-        is_in_component = False
-
-        if len(results) == 0:
+        resources = client.resources('Observation')
+        path_key = (getattr(client, 'url', None), code)
+        path = _observation_code_path.get(path_key)
+        local_results = None if source is None else source.search('observation', patient_id, code, data_time_since)
+        if local_results is not None:
+            results = [client.resource('Observation', **i) for i in
+                       sorted(local_results, key=_local_effective_date, reverse=True)]
+            if len(results) != 0:
+                path = 'component_code' if _is_in_component(results[0], code) else 'code'
+        elif path is not None:
+            results = _search_observation_by_path(resources, patient_id, data_time_since, code, path, table)
+            if len(results) == 0:
+                # The code may be in the other path for this patient, e.g. another kind of device
+                other_results = _search_observation_by_path(resources, patient_id, data_time_since, code,
+                                                            OTHER_CODE_PATH[path], table)
+                if len(other_results) != 0:
+                    results, path = other_results, OTHER_CODE_PATH[path]
+                    _observation_code_path.set(path_key, path)
+        else:
             """
-            如果resources的長度為0，代表Server裡面沒有這個病患的code data，
-            可能是在component-code之中，所以再透過component-code去搜尋
+            還不知道code是在code還是component-code之中，所以使用combo-code一次搜尋兩者，
+            再根據搜尋結果記錄下該code的位置
             """
-
-            search = resources.search(
-                subject=patient_id,
-                date__ge=data_time_since,
-                component_code=code
-            ).sort('-date')
-            results = search.fetch()
-            is_in_component = True
-
-            if len(results) == 0:
+            try:
+                results = _search_observation_by_path(resources, patient_id, data_time_since, code, 'combo_code',
+                                                      table)
+                if len(results) != 0:
+                    path = 'component_code' if _is_in_component(results[0], code) else 'code'
+            except OperationOutcome:
                 """
-                如果再次搜尋後的結果依舊為0，代表資料庫中沒有此數據，回傳錯誤到前端(可能還可以想一些其他的解決方案)
+                Server不支援combo-code，先透過code搜尋，如果resources的長度為0，
+                代表Server裡面沒有這個病患的code data，可能是在component-code之中，所以再透過component-code去搜尋
                 """
-                if default_value is None:
-                    raise ResourceNotFound(
-                        'Could not find the resources {code} under time {time}, no enough data for the patient'.format(
-                            code=code,
-                            time=data_time_since
-                        )
+                results = _search_observation_by_path(resources, patient_id, data_time_since, code, 'code', table)
+                path = 'code'
+                if len(results) == 0:
+                    results = _search_observation_by_path(resources, patient_id, data_time_since, code,
+                                                          'component_code', table)
+                    path = 'component_code' if len(results) != 0 else None
+
+            if path is not None:
+                _observation_code_path.set(path_key, path)
+
+        get_func = _get_func(table)
+        if len(results) == 0 and getattr(get_func, 'accepts_empty', False):
+            # e.g. count, no resource in the window is a count of 0
+            pass
+        elif len(results) == 0:
+            """
+            如果搜尋後的結果為0，代表資料庫中沒有此數據，回傳錯誤到前端(可能還可以想一些其他的解決方案)
+            """
+            if default_value is None:
+                raise ResourceNotFound(
+                    'Could not find the resources {code} under time {time}, no enough data for the patient'.format(
+                        code=code,
+                        time=data_time_since
                     )
-                else:
-                    results = default_value
+                )
+            else:
+                results = default_value
 
-        return {'resource': results, 'component_code': code if is_in_component else None,
-                'type': 'Observation'}
+        return {'resource': results, 'component_code': code if path == 'component_code' else None,
+                'type': 'Observation', 'code': code}
 
     def get_datetime(self, dictionary: dict, default_time) -> str | None:
         try:
@@ -317,10 +740,7 @@ class Observation(ResourcesInterface, GetValueAndDatetimeInterface):
             return dictionary['resource']
 
         if dictionary['component_code'] is not None:
-            for component in dictionary['resource'].component:
-                for coding in component.code.coding:
-                    if coding.code == dictionary['component_code']:
-                        return component.valueQuantity.value
+            return _observation_value(dictionary['resource'], dictionary['component_code'])
         else:
             try:
                 return dictionary['resource'].valueQuantity.value
@@ -329,16 +749,22 @@ class Observation(ResourcesInterface, GetValueAndDatetimeInterface):
 
 
 class Condition(ResourcesInterface, GetValueAndDatetimeInterface):
-    def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
+    def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None,
+               client: SyncFHIRClient = None, source: ResourceSourceInterface = None) -> Dict:
         code = table['code']
 
-        resources = CLIENT.resources('Condition')
-        # FIXME: 等等，date__ge呢?
-        search = resources.search(
-            subject=patient_id,
-            code=code
-        ).sort('recorded-date')
-        results = search.fetch()
+        local_results = None if source is None else source.search('condition', patient_id, code)
+        if local_results is not None:
+            results = [client.resource('Condition', **i) for i in
+                       sorted(local_results, key=lambda i: i.get('recordedDate', ''))]
+        else:
+            resources = client.resources('Condition')
+            # FIXME: 等等，date__ge呢?
+            search = resources.search(
+                subject=patient_id,
+                code=code
+            ).sort('recorded-date')
+            results = _fetch_searchset(search, table)
 
         # 如果result的長度為0，代表病人沒有這個症狀，那就回傳None, 否則回傳結果
         # Consider: 如果這裡不回傳result, 而是回傳true or false，又會如何？
@@ -357,10 +783,15 @@ class Condition(ResourcesInterface, GetValueAndDatetimeInterface):
 
 
 class Patient(ResourcesInterface, GetValueAndDatetimeInterface):
-    def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
-        resources = CLIENT.resources('Patient')
-        search = resources.search(_id=patient_id).limit(1)
-        patient = search.get()
+    def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None,
+               client: SyncFHIRClient = None, source: ResourceSourceInterface = None) -> Dict:
+        local_results = None if source is None else source.search('patient', patient_id)
+        if local_results:
+            patient = client.resource('Patient', **local_results[0])
+        else:
+            resources = client.resources('Patient')
+            search = resources.search(_id=patient_id).limit(1)
+            patient = search.get()
 
         result = None
         if table['code'] == 'age':
@@ -397,7 +828,8 @@ class Patient(ResourcesInterface, GetValueAndDatetimeInterface):
             return dictionary['resource']
 
 
-def get_patient_resources(patient_id, table, default_time: datetime, data_alive_time=None) -> dict:
+def get_patient_resources(patient_id, table, default_time: datetime, data_alive_time=None,
+                          client: SyncFHIRClient = None, source: ResourceSourceInterface = None) -> dict:
     """
     The function will get the patient's resources from the database and return
     :param patient_id: patient's id
@@ -407,6 +839,8 @@ def get_patient_resources(patient_id, table, default_time: datetime, data_alive_
     :param data_alive_time: the time range, start from the default_time.
                             e.g. if the data_alive_time is 2 years, and the default_time is not, the server will search
                                  the data that is between now and two years ago
+    :param client: the FHIR client to search with, default is the pooled client of the configured FHIR server
+    :param source: local resources (e.g. CDS Hooks prefetch) that are searched before the FHIR server
     :return: Dict, {"resource": SyncFHIRResources, "component-code": str or None,
                     "type": str(Resource name with capitalized)}
     """
@@ -421,8 +855,9 @@ def get_patient_resources(patient_id, table, default_time: datetime, data_alive_
     Condition目前相對單純，就是使用時間大於等於條件與code等於多少就好了
     """
     patient_resources_mgmt = ResourceMgmt()
-    patient_resources_mgmt.strategy = globals()[str(table["type_of_data"]).capitalize()]
-    patient_data_dict = patient_resources_mgmt.get_data_with_resources(patient_id, table, default_time, data_alive_time)
+    patient_resources_mgmt.strategy = _resource_strategy(table)
+    patient_data_dict = patient_resources_mgmt.get_data_with_resources(patient_id, table, default_time, data_alive_time,
+                                                                       client, source)
 
     # 然後再根據不同的欲取得的資料設定(如最新的資料, 最大的資料, 最小的資料...)來從data_list中取得符合設定的data
     # 該設定可以在features.csv中的search_type column設定
@@ -432,17 +867,18 @@ def get_patient_resources(patient_id, table, default_time: datetime, data_alive_
     latest為取得最新的資料, min為取得資料集中，數值最小的資料, max為取得資料集中，數字最大的資料, 
     NULL就是不做任何處置，會使用這個設定的數值有Patient age，
     因為在Patient resources中，age會直接計算出年齡並回傳結果，所以不用再取得數值了
+    另外還有data_alive_time之內的window aggregation: mean, count, delta (最新的數值 - 最早的數值), slope (每天的變化量)
     """
     search_type = str(table['search_type']).capitalize()
 
     # 沒有輸入search_type的狀況: 如Patient的get_age
     if search_type == "":
         patient_resource_result = patient_data_dict
-    # 如果有輸入search_type，檢查是不是latest, min or max
+    # 如果有輸入search_type，檢查是不是latest, min, max 或其他的Concrete GetFuncInterface
     # XXX: 希望能是寫活的，可以自動判別目前已經開發出來的Concrete getFuncInterface
-    elif search_type in ('Latest', 'Min', 'Max'):
+    elif _get_func(table) is not None:
         patient_get_setting_mgmt = GetFuncMgmt()
-        patient_get_setting_mgmt.strategy = globals()["Get" + search_type]
+        patient_get_setting_mgmt.strategy = _get_func(table)
         patient_resource_result = patient_get_setting_mgmt.get_data_with_func(patient_data_dict)
     else:
         raise AttributeError("'{}' search_type is not supported now, check it again.".format(table['search_type']))
@@ -450,6 +886,48 @@ def get_patient_resources(patient_id, table, default_time: datetime, data_alive_
     return patient_resource_result
 
 
+def is_window_feature(table: dict) -> bool:
+    return str(table.get('type_of_data')).lower() == 'observation' and \
+        isinstance(_get_func(table), type) and issubclass(_get_func(table), GetWindowInterface)
+
+
+def get_patient_window_resources(patient_id, tables: list, default_time: datetime, data_alive_time=None,
+                                 client: SyncFHIRClient = None, source: ResourceSourceInterface = None) -> list:
+    """
+    get_patient_resources of several window features (see is_window_feature) with the same Observation code and
+    data_alive_time. The Observations are searched only once, and every feature's aggregation is computed from the
+    same series.
+    :return: [the result of get_patient_resources, or the exception raised for the feature] in the order of the tables
+    """
+    # Count accepts an empty window, so the search doesn't raise nor fill the default value of a single feature
+    shared_table = dict(tables[0], search_type='count', default_value=None)
+    patient_resources_mgmt = ResourceMgmt()
+    patient_resources_mgmt.strategy = Observation
+    shared_data = patient_resources_mgmt.get_data_with_resources(patient_id, shared_table, default_time,
+                                                                 data_alive_time, client, source)
+
+    results = []
+    for table in tables:
+        data = dict(shared_data, resource=list(shared_data['resource']))
+        get_func = _get_func(table)
+        try:
+            if len(data['resource']) == 0 and not get_func.accepts_empty:
+                if table['default_value'] is None:
+                    raise ResourceNotFound(
+                        'Could not find the resources {code} under time {time}, no enough data for the patient'.format(
+                            code=table['code'],
+                            time=get_data_time_since(table, default_time)
+                        )
+                    )
+                data['resource'] = table['default_value']
+            patient_get_setting_mgmt = GetFuncMgmt()
+            patient_get_setting_mgmt.strategy = get_func
+            results.append(patient_get_setting_mgmt.get_data_with_func(data))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
 def get_resource_datetime(data: Dict, default_time: datetime) -> str | None:
     patient_resources_mgmt = ResourceMgmt()
     patient_resources_mgmt.strategy = globals()[str(data['type']).capitalize()]
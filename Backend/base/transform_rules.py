@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import ast
+import operator
+import re
+from bisect import bisect_left
+from typing import List
+
+import numpy
+
+"""
+    The rules of transformation.csv compiled once at load time, see base.model_feature_table:
+        numeric  -> NumericRule, the value as it is
+        category -> only the first condition of each case is checked, the first case whose first condition holds
+                    decides the category.
+                    CategoryTable if every condition compares with a number: the thresholds of all the cases are
+                    sorted, and the category of each interval between them (and of each threshold itself) is decided
+                    when it's compiled, so a value is transformed with one bisect.
+                    CategoryLookup if every condition is "eq" (e.g. 1=true), a dict lookup.
+                    CategoryCases otherwise, the cases are checked in order.
+        formula  -> Formula, the expression is parsed and checked once, then evaluated without any name but the
+                    features of the formula.
+    Every rule is called with one value, and rule.batch() transforms a column of values at once.
+"""
+
+NOT_SUITABLE = 'Value is not suitable in the configuration.'
+FORMULA_FEATURE = re.compile(r"\[(\w*)\]")
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class NumericRule(object):
+    __slots__ = ()
+
+    def __call__(self, value):
+        return value
+
+    def batch(self, values) -> numpy.ndarray:
+        return numpy.asarray(values)
+
+
+class CategoryCases(object):
+    """
+    The cases in order, the first case whose first condition holds decides the category. The other conditions of a
+    case (e.g. "ge|89" of "2=le|92&ge|89") are not checked, as the transformer has always done, and a case without
+    any condition never matches.
+    """
+
+    __slots__ = ('cases',)
+
+    def __init__(self, cases: list):
+        # ((category, ((operator function, condition),)), ...)
+        self.cases = tuple((case['category'], tuple((getattr(operator, condition['prefix']), condition['condition'])
+                                                    for condition in case['conditions'][:1]))
+                           for case in cases if case['conditions'])
+
+    def __call__(self, value):
+        for category, conditions in self.cases:
+            if all(compare(value, condition) for compare, condition in conditions):
+                return category
+        raise ValueError(NOT_SUITABLE)
+
+    def batch(self, values) -> numpy.ndarray:
+        values = numpy.asarray(values)
+        masks = []
+        for _, conditions in self.cases:
+            mask = numpy.ones(values.shape, dtype=bool)
+            for compare, condition in conditions:
+                mask &= numpy.asarray(compare(values, condition), dtype=bool)
+            masks.append(mask)
+
+        if not numpy.logical_or.reduce(masks).all():
+            raise ValueError(NOT_SUITABLE)
+        return numpy.select(masks, [category for category, _ in self.cases])
+
+
+class CategoryLookup(object):
+    """
+    Cases whose first condition is "eq", {condition: category}
+    """
+
+    __slots__ = ('categories',)
+
+    def __init__(self, cases: list):
+        self.categories = dict()
+        for case in cases:
+            # The first case wins and only its first condition is checked, as in CategoryCases
+            if case['conditions']:
+                self.categories.setdefault(case['conditions'][0]['condition'], case['category'])
+
+    def __call__(self, value):
+        try:
+            return self.categories[value]
+        except (KeyError, TypeError):
+            raise ValueError(NOT_SUITABLE)
+
+    def batch(self, values) -> numpy.ndarray:
+        return numpy.asarray([self(value) for value in numpy.asarray(values).tolist()])
+
+
+class CategoryTable(object):
+    """
+    Decision table of the numeric cases. The k sorted thresholds split the numbers into 2k + 1 regions:
+        (-inf, t0), [t0], (t0, t1), [t1], ..., [tk-1], (tk-1, inf)
+    every condition is either true or false in the whole region, so the category of each region is decided once.
+    NaN is one more region after them, it meets only the "ne" conditions.
+    """
+
+    __slots__ = ('thresholds', 'categories', 'matched', '_category_array')
+
+    def __init__(self, cases: list):
+        rule = CategoryCases(cases)
+        self.thresholds = sorted({conditions[0][1] for _, conditions in rule.cases})
+        categories, matched = [], []
+        for value in self._representatives():
+            try:
+                categories.append(rule(value))
+                matched.append(True)
+            except ValueError:
+                categories.append(None)
+                matched.append(False)
+        self.categories = categories
+        self.matched = numpy.asarray(matched)
+        # The regions without a category are never read, they raise ValueError first
+        fill = next((category for category in categories if category is not None), None)
+        self._category_array = numpy.asarray([fill if category is None else category for category in categories])
+
+    def _representatives(self) -> List[float]:
+        thresholds = self.thresholds
+        values = [thresholds[0] - 1]
+        for i, threshold in enumerate(thresholds):
+            values.append(threshold)
+            values.append((threshold + thresholds[i + 1]) / 2 if i + 1 < len(thresholds) else threshold + 1)
+        values.append(float('nan'))
+        return values
+
+    def __call__(self, value):
+        if value != value:
+            region = 2 * len(self.thresholds) + 1
+        else:
+            i = bisect_left(self.thresholds, value)
+            region = 2 * i + 1 if i < len(self.thresholds) and self.thresholds[i] == value else 2 * i
+        if not self.matched[region]:
+            raise ValueError(NOT_SUITABLE)
+        return self.categories[region]
+
+    def batch(self, values) -> numpy.ndarray:
+        values = numpy.asarray(values)
+        if values.dtype == object:
+            return numpy.asarray([self(value) for value in values.tolist()])
+        thresholds = numpy.asarray(self.thresholds)
+        i = numpy.searchsorted(thresholds, values, side='left')
+        on_threshold = thresholds[numpy.minimum(i, len(thresholds) - 1)] == values
+        region = 2 * i + (on_threshold & (i < len(thresholds)))
+        region[numpy.isnan(values.astype(float))] = 2 * len(thresholds) + 1
+        if not self.matched[region].all():
+            raise ValueError(NOT_SUITABLE)
+        return self._category_array[region]
+
+
+def compile_category(cases: list):
+    # Only the first condition of a case is checked, see CategoryCases
+    conditions = [case['conditions'][0] for case in cases if case['conditions']]
+    if conditions and all(_is_number(condition['condition']) for condition in conditions):
+        return CategoryTable(cases)
+    if all(condition['prefix'] == 'eq' for condition in conditions):
+        try:
+            return CategoryLookup(cases)
+        except TypeError:
+            # An unhashable condition
+            pass
+    return CategoryCases(cases)
+
+
+class Formula(object):
+    """
+    Arithmetic of the features, e.g. "[weight]/([height]/100)/([height]/100)". Only numbers, the features and the
+    operators + - * / // % ** are allowed, anything else (names, calls, attributes...) fails when it's compiled.
+    """
+
+    __slots__ = ('formula', 'features', '_code')
+
+    BINARY_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+    UNARY_OPERATORS = (ast.UAdd, ast.USub)
+
+    def __init__(self, formula: str):
+        self.formula = formula
+        # The features in the order of their first appearance
+        self.features = tuple(dict.fromkeys(FORMULA_FEATURE.findall(formula)))
+        variables = {feature: "_{}".format(i) for i, feature in enumerate(self.features)}
+        expression = FORMULA_FEATURE.sub(lambda m: variables[m.group(1)], formula)
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise AttributeError("{} is not a valid formula, {}".format(formula, e.msg))
+        self._check(tree.body, set(variables.values()))
+        self._code = compile(tree, '<formula {}>'.format(formula), 'eval')
+
+    def _check(self, node, names: set) -> None:
+        if isinstance(node, ast.BinOp) and isinstance(node.op, self.BINARY_OPERATORS):
+            self._check(node.left, names)
+            self._check(node.right, names)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, self.UNARY_OPERATORS):
+            self._check(node.operand, names)
+        elif isinstance(node, ast.Constant) and _is_number(node.value):
+            pass
+        elif isinstance(node, ast.Name) and node.id in names:
+            pass
+        else:
+            raise AttributeError("{} is not allowed in the formula {}".format(type(node).__name__, self.formula))
+
+    def __call__(self, model_data_dict: dict):
+        """
+        The features' values (or columns) are taken from model_data_dict
+        """
+        variables = {"_{}".format(i): model_data_dict[feature] for i, feature in enumerate(self.features)}
+        return eval(self._code, {'__builtins__': {}}, variables)
+
+    def batch(self, model_data_columns: dict) -> numpy.ndarray:
+        # The operators of the formula work on the whole arrays
+        return numpy.asarray(self(model_data_columns))
+
+
+def compile_rule(style: dict):
+    """
+    The rule of one feature of transformation.csv, style is {"type", "case" or "formula", "index"}
+    """
+    if style['type'] == 'numeric':
+        return NumericRule()
+    if style['type'] == 'formula':
+        return Formula(style['formula'])
+    return compile_category(style['case'])
+
+
+class TransformPlan(object):
+    """
+    The compiled transformation of one model
+    """
+
+    __slots__ = ('rules', 'formulas', 'order', 'required')
+
+    def __init__(self, transform_style: dict):
+        # ((feature, rule), ...) of the numeric and category features, then the formulas that use them
+        self.rules = tuple((name, style['rule']) for name, style in transform_style.items()
+                           if style['type'] != 'formula')
+        self.formulas = tuple((name, style['rule']) for name, style in transform_style.items()
+                              if style['type'] == 'formula')
+        self.order = pack_order(transform_style)
+        # The patient data the model input needs: the packed features and the features of the formulas
+        formula_names = {name for name, _ in self.formulas}
+        self.required = tuple(dict.fromkeys(
+            [name for name in self.order if name not in formula_names]
+            + [feature for _, formula in self.formulas for feature in formula.features]))
+
+
+def pack_order(transform_style) -> list:
+    """
+    Names of the features that are packed into the model input, sorted by their index.
+    """
+    order = sorted((style['index'], name) for name, style in transform_style.items() if style['index'] is not None)
+    if [index for index, _ in order] != list(range(1, len(order) + 1)):
+        raise IndexError("Index are not sequence. Check the configuration of transformation index.")
+    return [name for _, name in order]
@@ -5,42 +5,56 @@ from time import sleep
 import fhirpy.base.exceptions
 # XXX: 重寫！！太爛了
 
-from base.patient_data_search import model_feature_search_with_patient_id
+from base.patient_data_search import models_feature_search_with_patient_id
 from config import configObject as config
-from base.feature_table import feature_table
+from base.config_manager import table_manager
+from base.fhir_client_pool import client_pool
+from base.prefetch import PrefetchBundles
 from fhirpy.base.exceptions import ResourceNotFound
 from app import return_model_result
+from base.model_registry import model_registry
 from models import *
 
 
 app = cds.App()
 
 
-@app.patient_view("MoCab-CDS-Service", "The patient greeting service greets a patient!", title="Patient Greeter")
+@app.patient_view("MoCab-CDS-Service", "The patient greeting service greets a patient!", title="Patient Greeter",
+                  # Built from the active tables, so the discovery follows a reload
+                  prefetch=lambda: table_manager.current.prefetch_templates)
 def greeting(r: cds.PatientViewRequest, response: cds.Response):
     # TODO: authorize whether the server's url is real or not
     r.context.patientId = 'test-03121002'
     r.fhirServer = 'http://ming-desktop.ddns.net:8192/fhir'
-    try:
-        config["fhir_server"]["FHIR_SERVER_URL"] = r.fhirServer
-    except Exception as e:
-        print(e)
-    for model_name in feature_table.get_exist_model_name():
+    # Every hook of the same FHIR server (and access token) shares one pooled client
+    authorization = None
+    if r.fhirAuthorization is not None:
+        authorization = "{} {}".format(r.fhirAuthorization.token_type, r.fhirAuthorization.access_token)
+    client = client_pool.get_client(r.fhirServer, authorization)
+    # One version of the tables for the whole hook, even if they are reloaded meanwhile
+    tables = table_manager.current
+    # The features shared by the models are searched only once for all the models
+    models_patient_data = models_feature_search_with_patient_id(
+        r.context.patientId,
+        {model_name: tables.feature_table.get_model_feature_dict(model_name)
+         for model_name in tables.feature_table.get_exist_model_name()},
+        client=client,
+        # Answer the feature searches from the prefetched data first
+        source=None if r.prefetch is None else PrefetchBundles(r.prefetch))
+    for model_name, patient_data_dictionary in models_patient_data.items():
         """
             1. 首先是要確認病患ID在資料庫中的資料集是否足夠，所以這時候會去試探Server看是否有數據
             2. 確認有資料後，就會將數據丟入Model中進行預測
             3. 預測完成後，根據Model Score去判斷應該要回傳info card 或是 warning card (TODO: 需要一個表格去填寫何時使用warning card)
             4. 回傳Warning Card
         """
-        try:
-            patient_data_dictionary = model_feature_search_with_patient_id(r.context.patientId,
-                                                                           feature_table.get_model_feature_dict(
-                                                                               model_name))
-        except (ResourceNotFound, KeyError) as e:
+        if isinstance(patient_data_dictionary, (ResourceNotFound, KeyError)):
             continue
+        elif isinstance(patient_data_dictionary, Exception):
+            raise patient_data_dictionary
 
         try:
-            patient_data_dictionary["predict_value"] = return_model_result(patient_data_dictionary, model_name)
+            patient_data_dictionary["predict_value"] = return_model_result(patient_data_dictionary, model_name, tables)
         except KeyError as e:
             continue
 
@@ -79,6 +93,9 @@ def greeting(r: cds.PatientViewRequest, response: cds.Response):
 
 
 if __name__ == '__main__':
-    debug = os.environ.get('DEBUG', True)
+    # DEBUG=false (or 0) turns the debug server's reloader off, it's on by default
+    debug = str(os.environ.get('DEBUG', True)).lower() not in ("false", "0", "no")
     port = os.environ.get("PORT", 5001)
+    model_registry.preload()
+    table_manager.start()
     app.serve(host="0.0.0.0", debug=debug, port=port)
@@ -4,13 +4,75 @@ _config = {
     },
     "table_path": {
         "FEATURE_TABLE": "./config/features.csv",
+        "TRANSFORMATION_TABLE": "./config/transformation.csv",
+        # Seconds between the checks of the tables' changes, a changed table is reloaded without restarting.
+        # 0 disables the reload, see base/config_manager.py
+        "RELOAD_INTERVAL": 5,
     },
     "fhir_server": {
         "FHIR_SERVER_URL_": "http://localhost:8090/fhir",
         "FHIR_SERVER_URL": "http://ming-desktop.ddns.net:8192/fhir",
+        # Max number of connections kept to one FHIR server.
+        "POOL_MAXSIZE": 10,
+        # Seconds to wait for the FHIR server's response.
+        "REQUEST_TIMEOUT": 30,
+    },
+    "feature_search": {
+        # Number of FHIR searches running at the same time for one patient, 1 means searching features one by one.
+        "MAX_WORKERS": 8,
+        # Seconds to wait for all the feature searches of a patient.
+        "TIMEOUT": 30,
+    },
+    "batch": {
+        # Max number of rows a model predicts in one call of POST /batch, the rows ready together share the call.
+        "PREDICT_ROWS": 256,
+    },
+    "cache": {
+        # "lru" for the in-process cache, "redis" for a Redis server at REDIS_URL (needs the redis package), or "none".
+        "BACKEND": "lru",
+        "MAXSIZE": 4096,
+        # Seconds a patient's feature stays in the cache.
+        "TTL": 60,
+        "REDIS_URL": "redis://localhost:6379/0",
     },
     "bulk_server": {
-        "BULK_SERVER_URL": "http://localhost:8082/fhir"
+        "BULK_SERVER_URL": "http://localhost:8082/fhir",
+        # Seconds between the status polls of an export job, doubled after every poll until POLL_MAX_DELAY.
+        # The server's Retry-After takes precedence.
+        "POLL_INITIAL_DELAY": 1,
+        "POLL_MAX_DELAY": 60,
+        # Seconds an export job may take before it is cancelled.
+        "EXPORT_TIMEOUT": 3600,
+    },
+    "feature_store": {
+        # Directory of the columnar feature store built from the bulk exports, see base/feature_store.py
+        "PATH": "./feature_store",
+    },
+    "cohort_scoring": {
+        # Number of patients scored together in one worker process.
+        "CHUNK_SIZE": 5000,
+        # Number of worker processes, None means the number of CPUs.
+        "PROCESSES": None,
+    },
+    "server": {
+        # Address of the production server (python -m Backend serve --production), see base/production_server.py
+        "BIND": "0.0.0.0:5000",
+        # Address of the production CDS Hooks service (serve --production --app cds-hooks)
+        "CDS_HOOKS_BIND": "0.0.0.0:5001",
+        # Number of worker processes, None means 2 * the number of CPUs + 1.
+        "WORKERS": None,
+        # Threads of each worker, the requests of a worker are served by its threads.
+        "THREADS": 4,
+        # Seconds a request may take before its worker is restarted.
+        "TIMEOUT": 120,
+        # Seconds the workers have to finish their requests when they are stopped or restarted.
+        "GRACEFUL_TIMEOUT": 30,
+        # Seconds a connection is kept alive waiting for the next request.
+        "KEEPALIVE": 5,
+    },
+    "qcsi": {
+        # Number of normalized treatment texts whose mining results are kept, 0 disables the memo.
+        "MINING_CACHE_SIZE": 4096,
     },
 }
 
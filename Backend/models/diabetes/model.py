@@ -1,4 +1,6 @@
-import joblib
+from base.model_registry import model_registry
+
+model_registry.register("diabetes", "./models/diabetes/finalized_model.sav")
 
 
 def predict(data: list):
@@ -11,9 +13,18 @@ def predict(data: list):
     # controlled variable: glucose, diastolic blood pressure, insulin, height, weight, age
 
     temp = data
-    loaded_model = joblib.load("./models/diabetes/finalized_model.sav")
+    loaded_model = model_registry.get("diabetes")
     x.append(temp)
     result = loaded_model.predict_proba(x)
     # result = [no's probability, yes's probability]
     # return negative's probability
     return result[:, 1][0]
+
+
+def predict_batch(data: list) -> list:
+    """
+    Predict many patients at once, @data is a list of the lists that predict() gets, stacked into one 2-D input.
+    """
+    loaded_model = model_registry.get("diabetes")
+    result = loaded_model.predict_proba(data)
+    return result[:, 1].tolist()
@@ -1,4 +1,7 @@
-import joblib
+from base.model_registry import model_registry
+
+# Fixme: 路徑問題，待解決
+model_registry.register("nsti", "./models/nsti/LR_model_NSTI_5fea")
 
 
 def predict(data: dict):
@@ -15,13 +18,23 @@ def predict(data: dict):
     """
     x = list()
     temp = data
-    # Fixme: 路徑問題，待解決
-    loaded_model = joblib.load("./models/nsti/LR_model_NSTI_5fea")
+    loaded_model = model_registry.get("nsti")
     x.append(temp)
     result = loaded_model.predict_proba(x)
     return result[:, 1][0]
 
 
+def predict_batch(data: list) -> list:
+    """
+    Batch version of predict(), the model scores all the patients with one predict_proba() call.
+    :param data: list of patient rows, each row is in the same order as the list predict() gets
+    :return: list of float, Model Score of each patient
+    """
+    loaded_model = model_registry.get("nsti")
+    result = loaded_model.predict_proba(data)
+    return result[:, 1].tolist()
+
+
 if __name__ == "__main__":
     patient_data = {
         "sea": {
@@ -1,6 +1,7 @@
 from models.qcsi.mask_module import ConcreteMaskMart
 from models.qcsi.mask_module import ConcreteMaskType
 from models.qcsi.mask_module import ConcreteRegexSearch
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 
 unit_type = ("o2_flow_rate", "fio2")
@@ -73,18 +74,62 @@ def mask():
 
 mask_mart = globals()['mask']()
 
+BATCH_COLUMNS = ("mask_name", "unit_type", "value", "o2_flow_rate")
+
+
+def _mining_row(treatment_medication_text: str) -> tuple:
+    """
+    (mask_name, unit_type, value, o2_flow_rate) of one text, o2_flow_rate is the value converted by unit_conversion
+    as models.qcsi.model.predict does. A text that can't be identified is all None.
+    """
+    from models.qcsi.model import unit_conversion
+
+    try:
+        result = mask_mart.treatment_mining(treatment_medication_text)
+    except ValueError:
+        # e.g. "5->", the empty segment after "->" matches r"(^[0-9]*$)" without a value to mine
+        result = None
+    if result is None:
+        return None, None, None, None
+    flow_rate = result['value'] if result['unit_type'] == unit_type[0] else unit_conversion(result)
+    return result['mask_name'], result['unit_type'], result['value'], flow_rate
+
+
+def treatment_mining_batch(texts, processes: int = 1, chunk_size: int = 1000) -> pd.DataFrame:
+    """
+    treatment_mining of a column of treatment texts, e.g. the treatment column of the ED records.
+    Free-text O2 notes repeat a lot, each distinct text is mined once and the result is shared by its duplicates.
+    :param texts: pandas Series (or list) of the treatment texts, the values that are not string are not mined
+    :param processes: number of worker processes for the distinct texts, 1 mines them in this process
+    :param chunk_size: number of texts sent to a worker at a time
+    :return: DataFrame with the index of texts and the columns mask_name, unit_type, value and o2_flow_rate,
+             the row of a text that can't be identified is NaN.
+    """
+    texts = pd.Series(texts)
+    distinct = [text for text in pd.unique(texts) if isinstance(text, str)]
+    if processes <= 1 or len(distinct) <= chunk_size:
+        rows = [_mining_row(text) for text in distinct]
+    else:
+        # The workers mine with their own copy of mask_mart
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            rows = list(executor.map(_mining_row, distinct, chunksize=chunk_size))
+
+    results = pd.DataFrame.from_records(rows, index=pd.Index(distinct, dtype=object), columns=list(BATCH_COLUMNS))
+    results = results.reindex(texts.where(texts.map(lambda text: isinstance(text, str))).values)
+    results.index = texts.index
+    return results
+
+
 if __name__ == '__main__':
     # here put your inpatient treatment text
     # mask()
     with open("./csv/A053_急診處置.csv", newline='') as csv_file:
         df = pd.read_csv(csv_file, encoding="utf-8")
-        for row in df.iterrows():
-            row = row[1]
-            txt = str(row.treatment_mining)
-            # txt = "MASK 10L/MIN->N/C 3L/MIN"
-
-            result = mask_mart.treatment_mining(txt)
-            if result:
-                print('txt= {}, \nresult= {}'.format(txt, result))
-                print("---------------------------")
+        txt = df.treatment_mining.astype(str)
+        # txt = pd.Series(["MASK 10L/MIN->N/C 3L/MIN"])
+
+        result = treatment_mining_batch(txt)
+        for text, row in zip(txt[result.mask_name.notna()], result[result.mask_name.notna()].itertuples()):
+            print('txt= {}, \nresult= {}'.format(text, row._asdict()))
+            print("---------------------------")
     print("Done")
@@ -1,9 +1,17 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
-from typing import List
+import threading
 from typing import Dict
+from typing import Tuple
 from typing import TYPE_CHECKING
 
+from base.cache import LRUCache
+from config import configObject as config
+from .mask_type import ConcreteMaskType
+from .matcher import MaskMatcher
+from .regex import ConcreteRegexSearch
+from .matcher import rules_revision
+
 if TYPE_CHECKING:
     from mask_type import MaskType
 
@@ -41,26 +49,74 @@ class ConcreteMaskMart(MaskMart):
     subscribers, is stored in this variable.
     """
 
-    _types: List[MaskType] = []
-    """
-    List of subscribers. In real life, the list of subscribers can be stored
-    more comprehensively (categorized by event type, etc.).
-    """
+    def __init__(self, cache_size: int = None):
+        """
+        :param cache_size: number of normalized texts memoized by treatment_mining, default is
+                           config['qcsi']['MINING_CACHE_SIZE'], 0 disables the memo
+        """
+        # The subscribers of this mart in order. It's a tuple that is never changed, attach() and detach() publish a
+        # new one, so the readers use it without the lock.
+        self._types: Tuple[MaskType, ...] = ()
+        self._lock = threading.Lock()
+        # (rules revision, mask types, compiled matcher) of the latest publish
+        self._snapshot = (rules_revision.value, (), MaskMatcher(()))
+        cache_size = config['qcsi']['MINING_CACHE_SIZE'] if cache_size is None else cache_size
+        # The results never expire, they are cleared when the masks' regexes change
+        self.mining_cache = LRUCache(cache_size, ttl=float('inf')) if cache_size else None
+        self._cache_revision = rules_revision.value
 
     def attach(self, observer: MaskType, index: int = 0) -> None:
         print("Subject: Attached an observer.")
-        if observer in self._types:
-            print('Observer was already attached.')
-        elif index > 0 and (index - 1) < len(self._types):
-            self._types.insert(index - 1, observer)
-        else:
-            self._types.append(observer)
+        with self._lock:
+            types = list(self._types)
+            if observer in types:
+                print('Observer was already attached.')
+                return
+            elif index > 0 and (index - 1) < len(types):
+                types.insert(index - 1, observer)
+            else:
+                types.append(observer)
+            rules_revision.bump()
+            self._publish(tuple(types))
 
     def detach(self, observer: MaskType) -> None:
-        if observer in self._types:
-            self._types.remove(observer)
-        else:
-            print("The observer is not in the Subject.")
+        with self._lock:
+            if observer not in self._types:
+                print("The observer is not in the Subject.")
+                return
+            rules_revision.bump()
+            self._publish(tuple(mask_type for mask_type in self._types if mask_type is not observer))
+
+    def _publish(self, types: Tuple[MaskType, ...]) -> None:
+        """
+        Compile the mask types and swap the snapshot in with a single assignment, called with the lock held.
+        The matcher is None if one of the observers (or their regex searches) is not the concrete one, it can't be
+        compiled.
+        """
+        revision = rules_revision.value
+        compilable = all(isinstance(observer, ConcreteMaskType) and
+                         all(isinstance(search, ConcreteRegexSearch) for search in observer.regex_search_sets)
+                         for observer in types)
+        self._types = types
+        self._snapshot = (revision, types, MaskMatcher(types) if compilable else None)
+
+    @property
+    def snapshot(self) -> Tuple[int, Tuple[MaskType, ...], MaskMatcher | None]:
+        """
+        The published (revision, mask types, matcher). A regex attached to a mask type after the mask type was
+        attached changes the revision, then the mask types are compiled again.
+        """
+        snapshot = self._snapshot
+        if snapshot[0] != rules_revision.value:
+            with self._lock:
+                if self._snapshot[0] != rules_revision.value:
+                    self._publish(self._types)
+                snapshot = self._snapshot
+        return snapshot
+
+    @property
+    def matcher(self) -> MaskMatcher | None:
+        return self.snapshot[2]
 
     """
     The subscription management methods.
@@ -69,9 +125,14 @@ class ConcreteMaskMart(MaskMart):
     def notify(self, treatment_medication_request: str) -> Dict or None:
         """
         Trigger an update in each subscriber.
+        The compiled matcher gives the same response in one pass, the observers are updated one by one only if
+        they can't be compiled.
         """
+        _, types, matcher = self.snapshot
+        if matcher is not None:
+            return matcher.match(treatment_medication_request)
 
-        for observer in self._types:
+        for observer in types:
             observer_response = observer.update(treatment_medication_request)
             if observer_response:
                 return {
@@ -91,4 +152,41 @@ class ConcreteMaskMart(MaskMart):
         happen (or after it).
         """
 
-        return self.notify(treatment_medication_text)
+        if not treatment_medication_text.strip():
+            # Nothing to mine, e.g. "" or a text of spaces
+            return None
+        if self.mining_cache is None:
+            return self.notify(treatment_medication_text)
+
+        revision = rules_revision.value
+        if revision != self._cache_revision:
+            # The results of the old regexes can't be read any more (the revision is in the key), drop them
+            self._cache_revision = revision
+            self.mining_cache.invalidate()
+        key = (revision, normalize_text(treatment_medication_text))
+        cached = self.mining_cache.get(key)
+        if cached is None:
+            # Wrapped in a tuple, so a text that is not identified (None) is memoized too
+            cached = (self.notify(treatment_medication_text),)
+            self.mining_cache.set(key, cached)
+        # A copy, the caller may change the result
+        return None if cached[0] is None else dict(cached[0])
+
+    def cache_stats(self) -> Dict:
+        """
+        size, hits, misses, evictions and hit_rate of the treatment_mining memo
+        """
+        if self.mining_cache is None:
+            return {"size": 0, "hits": 0, "misses": 0, "evictions": 0, "hit_rate": 0.0}
+        stats = self.mining_cache.stats()
+        stats["size"] = len(self.mining_cache)
+        return stats
+
+
+def normalize_text(treatment_medication_text: str) -> str:
+    """
+    The memo key of a text. The regexes ignore case, so the texts that differ only in the case of ASCII letters are one
+    key, e.g. "O2 Nasal 3L/min" -> "o2 nasal 3l/min". The spacing is kept, a space or a line break changes what the
+    regexes match (e.g. "." doesn't match a line break).
+    """
+    return treatment_medication_text.lower() if treatment_medication_text.isascii() else treatment_medication_text
@@ -2,9 +2,11 @@ from __future__ import annotations
 from abc import ABC, abstractmethod
 from typing import TYPE_CHECKING
 
+from .matcher import rules_revision
+from .regex import RegexSearch
+
 if TYPE_CHECKING:
     from mask_mart import MaskMart
-    from regex import RegexSearch
 
 
 class MaskType(ABC):
@@ -73,3 +75,4 @@ class ConcreteMaskType(MaskType):
     def attach_search_regex(self, *regex_searches: RegexSearch):
         for regex_search in regex_searches:
             self.regex_search_sets.append(regex_search)
+        rules_revision.bump()
@@ -0,0 +1,162 @@
+from __future__ import annotations
+import re
+import threading
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from mask_type import MaskType
+
+r"""
+    The compiled matcher of the mask mart. It gives the same result as the cascade of the observers
+    (MaskMart.notify -> MaskType.update -> RegexSearch.search), but the text is checked only once:
+        1. Every regex is compiled once (re.IGNORECASE), with the keyword that it must contain, e.g. "nasal" of
+           r"nasal.*?(\d{1,2}) *([l1]\/m|lpm)".
+        2. The text is case-folded once and the keywords of all the mask types are looked up, a regex is tried
+           only when its keyword is in the text. Most of the treatment texts have no keyword of any mask, so they
+           are done without running a regex.
+    The order of the cascade stays: mask types in the order of the mart, regexes in the order they are attached,
+    the whole text first, then the segments split by "->" from the last one.
+"""
+
+SPLIT_WORD = "->"
+# Characters of a pattern that match themselves
+_LITERAL_CHARACTERS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 -_'%")
+_ESCAPED_LITERALS = set("/-'% .()[]{}*+?|^$\\")
+_QUANTIFIERS = ("?", "*", "{")
+
+
+class ChangeCounter(object):
+    """
+    Counts the changes of the masks' regexes, the compiled matcher is built again after a change.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def bump(self) -> None:
+        # The marts of several threads may bump it at once
+        with self._lock:
+            self.value += 1
+
+
+rules_revision = ChangeCounter()
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    depth, i, in_class = 0, 0, False
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            i += 2
+            continue
+        if in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def required_keyword(pattern: str) -> str:
+    """
+    The case-folded literal at the beginning of the pattern, every match of the pattern contains it.
+    It's "" when the pattern doesn't begin with a literal, e.g. r"(^[0-9]*$)", then the pattern is always tried.
+    """
+    if _has_top_level_alternation(pattern):
+        return ""
+    keyword, i = [], 0
+    while i < len(pattern):
+        if pattern[i] == "\\" and pattern[i + 1:i + 2] in _ESCAPED_LITERALS:
+            char, step = pattern[i + 1], 2
+        elif pattern[i] in _LITERAL_CHARACTERS:
+            char, step = pattern[i], 1
+        else:
+            break
+        following = pattern[i + step:i + step + 1]
+        if following in _QUANTIFIERS:
+            # The character is optional
+            break
+        keyword.append(char)
+        if following == "+":
+            break
+        i += step
+    return fold("".join(keyword))
+
+
+def fold(text: str) -> str:
+    # re.IGNORECASE matches "i" with the dotless "ı" too, the others are covered by casefold()
+    return text.casefold().replace("\u0131", "i")
+
+
+def mining_value(group: str) -> int:
+    # e.g. "3 l" -> 3, "40%" -> 40
+    return int(group.replace(" ", "").replace("l", "").replace("L", "").replace("%", ""))
+
+
+class CompiledPattern(object):
+    __slots__ = ('regex', 'keyword')
+
+    def __init__(self, pattern: str):
+        self.regex = re.compile(pattern, re.IGNORECASE)
+        self.keyword = required_keyword(pattern)
+
+
+def compile_patterns(patterns: List[str]) -> Tuple[CompiledPattern, ...]:
+    return tuple(CompiledPattern(pattern) for pattern in patterns)
+
+
+class MaskMatcher(object):
+    """
+    Snapshot of the mask types of the mart, ((mask name, ((unit type, compiled patterns), ...)), ...).
+    A mask type without any regex search matches nothing, as MaskType.update.
+    """
+
+    __slots__ = ('masks', 'keywords')
+
+    def __init__(self, mask_types: List[MaskType]):
+        self.masks = tuple((mask.name, tuple((search.name, search.compiled) for search in mask.regex_search_sets))
+                           for mask in mask_types)
+        self.keywords = tuple({compiled.keyword for _, searches in self.masks for _, patterns in searches
+                               for compiled in patterns if compiled.keyword})
+
+    @staticmethod
+    def _search(searches, text: str, lowered: str, present: set) -> Dict | None:
+        for unit_type, patterns in searches:
+            for compiled in patterns:
+                if compiled.keyword and (compiled.keyword not in present or compiled.keyword not in lowered):
+                    continue
+                regex = compiled.regex.search(text)
+                if regex:
+                    return {"type": unit_type, "value": mining_value(regex.group(1))}
+        return None
+
+    def match(self, treatment_medication_text: str) -> Dict | None:
+        lowered = fold(treatment_medication_text)
+        # The segments are parts of the text, a keyword that's not in the text is not in any segment either
+        present = {keyword for keyword in self.keywords if keyword in lowered}
+        segments = treatment_medication_text.split(SPLIT_WORD)
+        segments.reverse()
+        if len(segments) != 1:
+            segments = [(segment, fold(segment)) for segment in segments]
+
+        for mask_name, searches in self.masks:
+            response = self._search(searches, treatment_medication_text, lowered, present)
+            if len(segments) != 1:
+                for segment, lowered_segment in segments:
+                    temp = self._search(searches, segment, lowered_segment, present)
+                    if temp is not None:
+                        response = temp
+                        break
+            if response:
+                return {"mask_name": mask_name, "unit_type": response["type"], "value": response["value"]}
+        return None
@@ -1,5 +1,9 @@
 from abc import ABC, abstractmethod
-import re
+
+from .matcher import compile_patterns
+from .matcher import fold
+from .matcher import mining_value
+from .matcher import rules_revision
 
 
 class RegexSearch(ABC):
@@ -23,22 +27,33 @@ class ConcreteRegexSearch(RegexSearch):
             self._regex_patterns += regex_patterns
         else:
             print("Regex patterns must be String or List[str]")
+        self._compiled = None
+
+    @property
+    def compiled(self):
+        """
+        The patterns compiled with re.IGNORECASE, compiled again after the patterns are changed.
+        """
+        if self._compiled is None:
+            self._compiled = compile_patterns(self._regex_patterns)
+        return self._compiled
+
+    def _changed(self) -> None:
+        self._compiled = None
+        rules_revision.bump()
 
     def search(self, string: str) -> int or None:
-        if len(self._regex_patterns) > 0:
-            for pattern in self._regex_patterns:
-
-                regex = re.search(pattern, string, re.IGNORECASE)
-                if regex:
-                    result = regex.group(1)
-                    result = result \
-                        .replace(" ", "") \
-                        .replace("l", "") \
-                        .replace("L", "") \
-                        .replace("%", "")
-                    return int(result)
-        else:
-            return None
+        lowered = None
+        for compiled in self.compiled:
+            if compiled.keyword:
+                # A pattern is not tried if the text doesn't contain its keyword
+                lowered = fold(string) if lowered is None else lowered
+                if compiled.keyword not in lowered:
+                    continue
+            regex = compiled.regex.search(string)
+            if regex:
+                return mining_value(regex.group(1))
+        return None
 
     @property
     def pattern(self):
@@ -47,14 +62,17 @@ class ConcreteRegexSearch(RegexSearch):
     @pattern.setter
     def pattern(self, pattern_string: str):
         self._regex_patterns.append(pattern_string)
+        self._changed()
 
     @pattern.setter
     def pattern(self, pattern_list: list):
         self._regex_patterns.append(pattern_list)
+        self._changed()
 
     def delete(self, pattern_string: str):
         if pattern_string in self._regex_patterns:
             self._regex_patterns.remove(pattern_string)
+            self._changed()
             print(pattern_string + " deleted successfully")
         else:
             print(pattern_string + " is not in the list, please check again.")
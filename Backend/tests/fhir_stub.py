@@ -0,0 +1,106 @@
+from urllib.parse import urlencode
+
+from fhirpy.base.exceptions import OperationOutcome
+from fhirpy.lib import SyncFHIRClient
+
+
+def _codings(codeable_concept) -> list:
+    return (codeable_concept or {}).get('coding', [])
+
+
+def _match_codings(codings, tokens) -> bool:
+    for coding in codings:
+        for token in tokens:
+            system, _, code = token.rpartition('|')
+            if coding.get('code') == code and (not system or coding.get('system') == system):
+                return True
+    return False
+
+
+def _effective(resource) -> str:
+    return resource.get('effectiveDateTime') or resource.get('recordedDate') or \
+        (resource.get('effectivePeriod') or {}).get('start') or ''
+
+
+def _value(resource, tokens) -> float or None:
+    if 'valueQuantity' in resource:
+        return resource['valueQuantity']['value']
+    for component in resource.get('component', []):
+        if _match_codings(_codings(component.get('code')), tokens):
+            return component['valueQuantity']['value']
+    return None
+
+
+class StubFHIRClient(SyncFHIRClient):
+    """
+    SyncFHIRClient that answers the searches from an in-memory list of resources instead of a FHIR server.
+    It supports the search parameters used by base.search_sets, and records every request in self.requests.
+    """
+
+    def __init__(self, resources, page_size=50, unsupported_params=()):
+        super(StubFHIRClient, self).__init__('http://stub/fhir')
+        self.stub_resources = resources
+        self.page_size = page_size
+        self.unsupported_params = unsupported_params
+        self.requests = []
+
+    def _fetch_resource(self, path, params=None):
+        resource_type = path.strip('/')
+        params = {k: [str(v) for v in (value if isinstance(value, list) else [value])]
+                  for k, value in (params or {}).items()}
+        self.requests.append((resource_type, params))
+        for name in params:
+            if name in self.unsupported_params or (name == '_sort' and params[name][0] in self.unsupported_params):
+                raise OperationOutcome("Unsupported search parameter {}".format(name))
+
+        resources = [r for r in self.stub_resources if r['resourceType'] == resource_type]
+        for name, values in params.items():
+            value = values[0]
+            if name in ('subject', 'patient'):
+                resources = [r for r in resources if r.get('subject', {}).get('reference', '').split('/')[-1] == value]
+            elif name == '_id':
+                resources = [r for r in resources if r.get('id') == value]
+            elif name == 'code':
+                resources = [r for r in resources if _match_codings(_codings(r.get('code')), value.split(','))]
+            elif name == 'component-code':
+                resources = [r for r in resources if any(
+                    _match_codings(_codings(c.get('code')), value.split(',')) for c in r.get('component', []))]
+            elif name == 'combo-code':
+                resources = [r for r in resources if _match_codings(_codings(r.get('code')), value.split(',')) or any(
+                    _match_codings(_codings(c.get('code')), value.split(',')) for c in r.get('component', []))]
+            elif name == 'date':
+                resources = [r for r in resources if _effective(r) >= value[2:]]
+
+        sort = params.get('_sort', [None])[0]
+        if sort is not None:
+            descending = sort.startswith('-')
+            if sort.lstrip('-') in ('value-quantity', 'component-value-quantity'):
+                tokens = (params.get('code') or params.get('component-code') or params.get('combo-code'))[0].split(',')
+                resources = [r for r in resources if _value(r, tokens) is not None]
+                resources = sorted(resources, key=lambda r: _value(r, tokens), reverse=descending)
+            else:
+                resources = sorted(resources, key=_effective, reverse=descending)
+
+        count = int(params.get('_count', [self.page_size])[0])
+        offset = int(params.pop('_offset', ['0'])[0])
+        page = resources[offset:offset + count]
+        bundle = {'resourceType': 'Bundle', 'total': len(resources), 'entry': [{'resource': r} for r in page]}
+        if offset + count < len(resources) and count > 0:
+            next_params = {k: v[0] for k, v in params.items()}
+            next_params['_count'] = count
+            next_params['_offset'] = offset + count
+            bundle['link'] = [{'relation': 'next', 'url': '/{}?{}'.format(resource_type, urlencode(next_params))}]
+        return bundle
+
+
+def observation(resource_id, patient_id, code, effective, value, system=None, component_code=None):
+    coding = {'code': code} if system is None else {'system': system, 'code': code}
+    resource = {'resourceType': 'Observation', 'id': resource_id,
+                'subject': {'reference': 'Patient/{}'.format(patient_id)}, 'effectiveDateTime': effective}
+    if component_code is None:
+        resource['code'] = {'coding': [coding]}
+        resource['valueQuantity'] = {'value': value}
+    else:
+        resource['code'] = {'coding': [{'code': component_code}]}
+        resource['component'] = [{'code': {'coding': [coding]}, 'valueQuantity': {'value': value}}]
+    return resource
@@ -0,0 +1,86 @@
+import base64
+import json
+import threading
+
+import pytest
+
+from base.bulk_client import BulkDataClient
+from base.bulk_client import NDJSONStreamDecoder
+
+RESOURCES = [{"resourceType": "Patient", "id": "p{}".format(i), "name": [{"text": "病患 {}".format(i)}]}
+             for i in range(20)]
+NDJSON = "\n".join(json.dumps(r, ensure_ascii=False) for r in RESOURCES).encode() + b"\n"
+
+
+def chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def decode(decoder: NDJSONStreamDecoder, data: bytes, size: int) -> list:
+    resources = []
+    for chunk in chunks(data, size):
+        resources.extend(decoder.feed(chunk))
+    resources.extend(decoder.close())
+    return resources
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, 100000])
+def test_ndjson_stream_decoder_plain(size):
+    assert decode(NDJSONStreamDecoder(base64_encoded=False), NDJSON, size) == RESOURCES
+
+
+@pytest.mark.parametrize("size", [1, 5, 33, 100000])
+@pytest.mark.parametrize("escape", [False, True])
+def test_ndjson_stream_decoder_binary(size, escape):
+    data = base64.b64encode(NDJSON)
+    if escape:
+        # JSON encoders may escape "/" and wrap the base64 string
+        data = data.replace(b"/", b"\\/")
+        data = b"\\n".join(chunks(data, 76))
+    binary = b'{"resourceType": "Binary", "contentType": "application/fhir+ndjson", "data": "' + data + b'"}'
+    assert decode(NDJSONStreamDecoder(base64_encoded=True), binary, size) == RESOURCES
+
+
+def test_ndjson_stream_decoder_yields_complete_lines():
+    decoder = NDJSONStreamDecoder(base64_encoded=False)
+    first, second = json.dumps(RESOURCES[0]).encode(), json.dumps(RESOURCES[1]).encode()
+    # The resources of the complete lines come out as soon as their bytes arrive, only the partial line is kept
+    assert list(decoder.feed(first + b"\n" + second[:10])) == [RESOURCES[0]]
+    assert bytes(decoder._lines) == second[:10]
+    assert list(decoder.feed(second[10:] + b"\r\n\n")) == [RESOURCES[1]]
+    assert bytes(decoder._lines) == b""
+    assert list(decoder.close()) == []
+
+
+def test_iter_resources(monkeypatch):
+    files = {"http://bulk/{}.ndjson".format(i): RESOURCES[i * 5:(i + 1) * 5] for i in range(4)}
+    client = BulkDataClient("http://bulk")
+    client.manifest = list(files.keys())
+    sessions = dict()
+
+    def iter_manifest_file(url, session=None):
+        sessions[url] = (session, threading.get_ident())
+        return iter(files[url])
+
+    monkeypatch.setattr(client, "iter_manifest_file", iter_manifest_file)
+
+    resources = list(client.iter_resources(max_workers=3, queue_size=2))
+    assert sorted(resources, key=lambda r: int(r["id"][1:])) == RESOURCES
+    # Every thread downloads with its own session, not the client's
+    threads = {session: thread for session, thread in sessions.values()}
+    assert client.session not in threads and None not in threads
+    assert len(set(threads.values())) == len(threads)
+    assert len(client.iter_ndjson_dict()["Patient"]) == len(RESOURCES)
+
+
+def test_iter_resources_raises_download_error(monkeypatch):
+    client = BulkDataClient("http://bulk")
+    client.manifest = ["http://bulk/0.ndjson"]
+
+    def broken(url, session=None):
+        yield RESOURCES[0]
+        raise ConnectionError(url)
+
+    monkeypatch.setattr(client, "iter_manifest_file", broken)
+    with pytest.raises(ConnectionError):
+        list(client.iter_resources())
@@ -0,0 +1,153 @@
+import asyncio
+import datetime
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from base.bulk_export import BulkExportManager
+from base.bulk_export import ExportJob
+from base.bulk_export import export_path
+from base.bulk_export import parse_retry_after
+
+
+@pytest.mark.parametrize("compartment, path", [
+    (None, "/Patient/$export"),
+    ("Patient", "/Patient/$export"),
+    ("Group/g1", "/Group/g1/$export"),
+    ("system", "/$export"),
+])
+def test_export_path(compartment, path):
+    assert export_path(compartment) == path
+
+
+def test_export_path_unknown():
+    with pytest.raises(AttributeError):
+        export_path("Group/")
+
+
+@pytest.mark.parametrize("value, seconds", [
+    (None, None),
+    ("", None),
+    ("120", 120.0),
+    ("Wed, 21 Oct 2015 07:28:30 GMT", 30.0),
+    ("Wed, 21 Oct 2015 07:27:00 GMT", 0.0),
+    ("soon", None),
+])
+def test_parse_retry_after(value, seconds):
+    now = datetime.datetime(2015, 10, 21, 7, 28, tzinfo=datetime.timezone.utc)
+    assert parse_retry_after(value, now) == seconds
+
+
+class FakeBulkServer:
+    """
+    Each export job is in progress for `polls` status polls, then completes with one output file.
+    """
+
+    def __init__(self, polls=2, retry_after=None, busy=0):
+        self.polls = polls
+        self.retry_after = retry_after
+        self.busy = busy
+        self.kick_offs = []
+        self.status_polls = {}
+        self.deleted = []
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/fhir/Patient/$export", self.kick_off)
+        app.router.add_get("/fhir/Group/{id}/$export", self.kick_off)
+        app.router.add_get("/fhir/$export", self.kick_off)
+        app.router.add_get("/status/{job}", self.status)
+        app.router.add_delete("/status/{job}", self.delete)
+        return app
+
+    async def kick_off(self, request):
+        job = str(len(self.kick_offs))
+        self.kick_offs.append((request.path, dict(request.query)))
+        return web.Response(status=202, headers={"Content-Location": "/status/" + job})
+
+    async def status(self, request):
+        job = request.match_info["job"]
+        count = self.status_polls[job] = self.status_polls.get(job, 0) + 1
+        headers = {} if self.retry_after is None else {"Retry-After": str(self.retry_after)}
+        if count <= self.busy:
+            return web.Response(status=429, headers=headers)
+        if count <= self.polls:
+            headers["X-Progress"] = "{}% complete".format(count * 100 // (self.polls + 1))
+            return web.Response(status=202, headers=headers)
+        return web.json_response({"transactionTime": "2022-01-01T00:00:00Z", "request": request.path,
+                                  "output": [{"type": "Patient", "url": "http://bulk/{}.ndjson".format(job)}]})
+
+    async def delete(self, request):
+        self.deleted.append(request.match_info["job"])
+        return web.Response(status=202)
+
+
+def run_export(bulk_server, jobs, **manager_kwargs):
+    async def export():
+        async with TestServer(bulk_server.app()) as server:
+            manager = BulkExportManager(str(server.make_url("/fhir")), **manager_kwargs)
+            return manager, await manager.export(*jobs)
+
+    return asyncio.run(export())
+
+
+def test_export_jobs_run_together():
+    bulk_server = FakeBulkServer(polls=2)
+    manager, jobs = run_export(bulk_server, [ExportJob(), ExportJob("Group/g1", _type="Patient", bad="x"),
+                                             ExportJob("system")],
+                               initial_delay=0.01, max_delay=0.05)
+
+    assert [job.status for job in jobs] == [ExportJob.COMPLETED] * 3
+    assert sorted(path for path, _ in bulk_server.kick_offs) == ["/fhir/$export", "/fhir/Group/g1/$export",
+                                                                 "/fhir/Patient/$export"]
+    assert {"_type": "Patient"} in [query for _, query in bulk_server.kick_offs]
+    assert all(job.polls == 3 for job in jobs)
+    assert sorted(url for job in jobs for url in job.output_urls) == ["http://bulk/{}.ndjson".format(i)
+                                                                      for i in range(3)]
+    assert [job["status"] for job in manager.progress()] == [ExportJob.COMPLETED] * 3
+    assert jobs[0].progress == "66% complete"
+
+
+def test_export_job_honors_retry_after(monkeypatch):
+    delays = []
+    sleep = asyncio.sleep
+
+    async def record_sleep(delay, *args):
+        # aiohttp also yields with sleep(0)
+        if delay:
+            delays.append(delay)
+        await sleep(0, *args)
+
+    monkeypatch.setattr("base.bulk_export.asyncio.sleep", record_sleep)
+    _, jobs = run_export(FakeBulkServer(polls=3, retry_after=7, busy=1), [ExportJob()],
+                         initial_delay=1, max_delay=60)
+
+    assert jobs[0].status == ExportJob.COMPLETED
+    assert delays == [7.0, 7.0, 7.0]
+
+
+def test_export_job_backs_off(monkeypatch):
+    delays = []
+    sleep = asyncio.sleep
+
+    async def record_sleep(delay, *args):
+        # aiohttp also yields with sleep(0)
+        if delay:
+            delays.append(delay)
+        await sleep(0, *args)
+
+    monkeypatch.setattr("base.bulk_export.asyncio.sleep", record_sleep)
+    _, jobs = run_export(FakeBulkServer(polls=5), [ExportJob()], initial_delay=1, max_delay=4, jitter=0)
+
+    assert jobs[0].status == ExportJob.COMPLETED
+    assert delays == [1, 2, 4, 4, 4]
+
+
+def test_export_job_timeout_cancels_job():
+    bulk_server = FakeBulkServer(polls=100, retry_after=10)
+    _, jobs = run_export(bulk_server, [ExportJob()], timeout=1)
+
+    assert jobs[0].status == ExportJob.CANCELLED
+    assert "did not complete" in str(jobs[0].error)
+    assert bulk_server.deleted == ["0"]
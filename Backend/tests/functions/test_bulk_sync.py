@@ -0,0 +1,101 @@
+import pytest
+
+from base import bulk_sync
+from base.bulk_export import ExportJob
+from base.bulk_sync import WatermarkStore
+from base.bulk_sync import deleted_resources
+from base.bulk_sync import sync_feature_store
+from base.feature_store import FeatureStore
+from tests.fhir_stub import observation
+
+
+class FakeExportManager:
+    """
+    Completes every export job at once with the manifest of the next run.
+    """
+    runs = []
+    kick_offs = []
+
+    def __init__(self, server):
+        self.server = server
+
+    async def export(self, *jobs):
+        for job in jobs:
+            FakeExportManager.kick_offs.append(dict(job.query_params))
+            job.manifest = FakeExportManager.runs.pop(0)
+            job.status = ExportJob.COMPLETED
+        return list(jobs)
+
+
+FILES = {
+    "http://bulk/1/Observation.ndjson": [
+        observation("bp-1", "p1", "8462-4", "2022-01-01T08:00:00", 71),
+        observation("bp-2", "p1", "8462-4", "2022-01-02T08:00:00", 72),
+    ],
+    "http://bulk/1/Patient.ndjson": [{"resourceType": "Patient", "id": "p1", "birthDate": "2000-01-01"}],
+    "http://bulk/2/Observation.ndjson": [observation("bp-2", "p1", "8462-4", "2022-01-02T08:00:00", 75)],
+    "http://bulk/2/deleted.ndjson": [{"resourceType": "Bundle", "type": "transaction", "entry": [
+        {"request": {"method": "DELETE", "url": "Observation/bp-1"}}]}],
+}
+
+
+@pytest.fixture
+def fake_bulk_server(monkeypatch):
+    monkeypatch.setattr(bulk_sync, "BulkExportManager", FakeExportManager)
+    monkeypatch.setattr(bulk_sync.BulkDataClient, "iter_manifest_file", lambda self, url, session=None: iter(FILES[url]))
+    FakeExportManager.kick_offs = []
+    FakeExportManager.runs = [
+        {"transactionTime": "2022-01-01T00:00:00Z", "output": [
+            {"type": "Observation", "url": "http://bulk/1/Observation.ndjson"},
+            {"type": "Patient", "url": "http://bulk/1/Patient.ndjson"}]},
+        {"transactionTime": "2022-01-02T00:00:00Z", "output": [
+            {"type": "Observation", "url": "http://bulk/2/Observation.ndjson"}],
+         "deleted": [{"type": "Bundle", "url": "http://bulk/2/deleted.ndjson"}]},
+    ]
+    return FakeExportManager
+
+
+def test_watermark_store(tmp_path):
+    watermarks = WatermarkStore(str(tmp_path / "watermarks.json"))
+    assert watermarks.get("http://bulk/fhir") is None
+    watermarks.set("http://bulk/fhir/", "2022-01-01T00:00:00Z")
+    assert WatermarkStore(str(tmp_path / "watermarks.json")).get("http://bulk/fhir") == "2022-01-01T00:00:00Z"
+    watermarks.reset("http://bulk/fhir")
+    assert watermarks.get("http://bulk/fhir") is None
+
+
+def test_deleted_resources():
+    assert deleted_resources({"resourceType": "Bundle", "entry": [
+        {"request": {"method": "DELETE", "url": "Observation/1"}},
+        {"request": {"method": "DELETE", "url": "http://bulk/fhir/Patient/2"}},
+        {"request": {"method": "PUT", "url": "Patient/3"}},
+    ]}) == [("Observation", "1"), ("Patient", "2")]
+
+
+def test_sync_feature_store(tmp_path, fake_bulk_server):
+    path = str(tmp_path)
+    summary = sync_feature_store(path, "http://bulk/fhir")
+    assert summary["since"] is None and summary["updated"] == 3
+    assert [i['id'] for i in FeatureStore(path).search("observation", "p1", "8462-4")] == ["bp-1", "bp-2"]
+
+    summary = sync_feature_store(path, "http://bulk/fhir")
+    assert summary["since"] == "2022-01-01T00:00:00Z"
+    assert summary["updated"] == 1 and summary["deleted"] == 1
+    assert fake_bulk_server.kick_offs == [{}, {"_since": "2022-01-01T00:00:00Z"}]
+    store = FeatureStore(path)
+    assert [i['valueQuantity']['value'] for i in store.search("observation", "p1", "8462-4")] == [75]
+    assert store.search("patient", "p1")[0]['id'] == "p1"
+    assert WatermarkStore(str(tmp_path / "_watermarks.json")).get("http://bulk/fhir") == "2022-01-02T00:00:00Z"
+
+
+def test_sync_feature_store_failed_keeps_watermark(tmp_path, fake_bulk_server, monkeypatch):
+    path = str(tmp_path)
+    sync_feature_store(path, "http://bulk/fhir")
+
+    def broken(self, url, session=None):
+        raise ConnectionError(url)
+
+    monkeypatch.setattr(bulk_sync.BulkDataClient, "iter_manifest_file", broken)
+    with pytest.raises(ConnectionError):
+        sync_feature_store(path, "http://bulk/fhir")
+    assert WatermarkStore(str(tmp_path / "_watermarks.json")).get("http://bulk/fhir") == "2022-01-01T00:00:00Z"
@@ -0,0 +1,93 @@
+import fnmatch
+import sys
+import time
+
+import pytest
+
+from base.cache import LRUCache
+from base.cache import cache_key
+from base.cache import create_cache
+from base.cache import RedisCache
+
+
+class FakeRedis:
+    """
+    Local stand-in of redis.Redis with the commands used by RedisCache.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name):
+        value = self.data.get(name)
+        if value is None or value[0] < time.monotonic():
+            return None
+        return value[1]
+
+    def set(self, name, value, ex=None):
+        self.data[name] = (time.monotonic() + ex if ex else float("inf"), value.encode())
+
+    def delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+    def scan_iter(self, match="*"):
+        return [name for name in self.data if fnmatch.fnmatchcase(name, match)]
+
+
+KEY_P1 = ("http://localhost:8090/fhir", "p1", "observation", "http://loinc.org|8302-2", "0005", "latest")
+KEY_P2 = ("http://localhost:8090/fhir", "p2", "observation", "http://loinc.org|8302-2", "0005", "latest")
+
+
+def test_lru_cache_ttl_and_eviction():
+    cache = LRUCache(maxsize=1, ttl=0.05)
+    cache.set(KEY_P1, {"date": None, "value": 1})
+    assert cache.get(KEY_P1) == {"date": None, "value": 1}
+    cache.set(KEY_P2, {"date": None, "value": 2})
+    assert cache.get(KEY_P1) is None
+    time.sleep(0.06)
+    assert cache.get(KEY_P2) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "evictions": 1, "hit_rate": 1 / 3}
+
+
+def test_redis_cache_invalidate():
+    cache = RedisCache(FakeRedis(), ttl=60)
+    cache.set(KEY_P1, {"date": "2022-01-19T00:00", "value": 176})
+    cache.set(KEY_P2, {"date": "2022-01-19T00:00", "value": 180})
+    assert cache.get(KEY_P1) == {"date": "2022-01-19T00:00", "value": 176}
+
+    cache.invalidate(patient_id="p1")
+    assert cache.get(KEY_P1) is None
+    assert cache.get(KEY_P2)["value"] == 180
+
+    cache.invalidate()
+    assert cache.get(KEY_P2) is None
+    assert cache.stats()["hits"] == 2
+
+
+def test_cache_key_has_every_search_field():
+    table = {'type_of_data': 'observation', 'code': '3151-8', 'data_alive_time': '0000-00-01T00:00:00',
+             'search_type': 'latest', 'default_value': None}
+    keys = {cache_key("http://fhir", "p1", dict(table, **change)) for change in (
+        {}, {'default_value': 21}, {'default_value': '21'}, {'search_type': 'max'}, {'code': 'http://loinc.org|3151-8'},
+        {'data_alive_time': '0000-00-02T00:00:00'}, {'type_of_data': 'condition'})}
+    assert len(keys) == 7
+    # The model and the feature's name don't change the search
+    assert cache_key("http://fhir", "p1", dict(table, model='qcsi', feature='fio2')) == \
+        cache_key("http://fhir", "p1", table)
+
+
+def test_cache_key_has_authorization_digest():
+    table = {'type_of_data': 'observation', 'code': '3151-8', 'data_alive_time': '0000-00-01T00:00:00',
+             'search_type': 'latest', 'default_value': None}
+    keys = [cache_key("http://fhir", "p1", table, authorization) for authorization in (None, "Bearer a", "Bearer b")]
+    assert len(set(keys)) == 3
+    assert cache_key("http://fhir", "p1", table, "Bearer a") == keys[1]
+    assert all("Bearer" not in key[-1] for key in keys)
+
+
+def test_redis_backend_without_redis(monkeypatch):
+    # None in sys.modules makes `import redis` raise ImportError
+    monkeypatch.setitem(sys.modules, "redis", None)
+    with pytest.raises(ImportError, match="pip install redis"):
+        create_cache({"BACKEND": "redis", "REDIS_URL": "redis://localhost:6379/0"})
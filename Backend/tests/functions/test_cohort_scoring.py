@@ -0,0 +1,102 @@
+import datetime
+
+import pandas
+import pytest
+
+from base.cohort_scoring import compute_feature
+from base.cohort_scoring import score_cohort
+from base.feature_store import FeatureStore
+from base.feature_store import build_feature_store
+from base.model_registry import model_registry
+from base.search_sets import get_patient_resources
+from base.search_sets import get_resource_datetime_and_value
+from tests.fhir_stub import StubFHIRClient
+from tests.fhir_stub import observation
+from tests.functions.test_feature_store import FakeBulkClient
+from tests.functions.test_feature_store import RESOURCES
+from tests.functions.test_prefetch import feature
+from tests.test_app import FakeEstimator
+
+DEFAULT_TIME = datetime.datetime(2022, 1, 20)
+CGMH = "https://www.cgmh.org.tw"
+
+
+def nsti_resources(patient_id, sea, crp=True):
+    resources = [
+        {"resourceType": "Patient", "id": patient_id, "birthDate": "1980-01-01"},
+        observation(patient_id + "-wbc", patient_id, "72A001", "2022-01-01T08:00:00", 4400, system=CGMH),
+        observation(patient_id + "-seg", patient_id, "72A015", "2022-01-01T08:00:00", 50.7, system=CGMH),
+        observation(patient_id + "-band", patient_id, "72B015", "2022-01-01T08:00:00", 0, system=CGMH),
+    ]
+    if crp:
+        resources.append(observation(patient_id + "-crp", patient_id, "72-547", "2022-01-01T08:00:00", 0.5,
+                                     system=CGMH))
+    if sea:
+        resources.append({"resourceType": "Condition", "id": patient_id + "-sea",
+                          "subject": {"reference": "Patient/" + patient_id}, "code": {"coding": [{"code": "0"}]},
+                          "recordedDate": "2021-05-01"})
+    return resources
+
+
+@pytest.fixture
+def store(tmp_path):
+    resources = RESOURCES + [
+        observation("bp-5", "p2", "8462-4", "2022-01-04T08:00:00", 65, component_code="85354-9"),
+        observation("bp-6", "p2", "8462-4", "2015-01-04T08:00:00", 99, component_code="85354-9"),
+    ]
+    build_feature_store(FakeBulkClient(resources), str(tmp_path))
+    return FeatureStore(str(tmp_path))
+
+
+@pytest.mark.parametrize("table, expected", [
+    (feature("8462-4", "observation"), {"p1": 72, "p2": 65, "p3": None}),
+    (feature("8462-4", "observation", "max"), {"p1": 72, "p2": 80, "p3": None}),
+    (feature("8462-4", "observation", "min"), {"p1": 71, "p2": 65, "p3": None}),
+    (feature("8462-4", "observation", "mean"), {"p1": 71.5, "p2": 72.5, "p3": None}),
+    (feature("8462-4", "observation", "count"), {"p1": 2, "p2": 2, "p3": 0}),
+    (feature("8462-4", "observation", "delta"), {"p1": 1, "p2": -15, "p3": None}),
+    (feature("8462-4", "observation", "slope"), {"p1": 1, "p2": -15, "p3": None}),
+    (feature("I10", "condition"), {"p1": False, "p2": True, "p3": False}),
+    (feature("age", "patient", ""), {"p1": 22, "p2": 32, "p3": None}),
+    (dict(feature("9999-9", "observation"), default_value=21), {"p1": 21, "p2": 21, "p3": 21}),
+])
+def test_compute_feature(store, table, expected):
+    result = compute_feature(store, table, ["p1", "p2", "p3"], DEFAULT_TIME)
+    assert {patient_id: (None if pandas.isna(value) else value) for patient_id, value in result.items()} == expected
+
+
+def test_compute_feature_latest_row_without_value(tmp_path):
+    resources = [observation("bp-1", "p1", "8462-4", "2022-01-01T08:00:00", 71),
+                 observation("bp-2", "p1", "8462-4", "2022-01-02T08:00:00", None),
+                 observation("bp-3", "p2", "8462-4", "2022-01-02T08:00:00", 80)]
+    build_feature_store(FakeBulkClient(resources), str(tmp_path))
+    table = dict(feature("8462-4", "observation"), default_value=0)
+    # The latest observation of p1 has no value, the older value is not taken instead
+    assert compute_feature(FeatureStore(str(tmp_path)), table, ["p1", "p2"], DEFAULT_TIME).tolist() == [0, 80]
+
+
+@pytest.mark.parametrize("search_type", ["latest", "mean", "slope"])
+def test_compute_feature_matches_search(store, search_type):
+    client = StubFHIRClient(RESOURCES)
+    table = feature("8462-4", "observation", search_type)
+    result = compute_feature(store, table, ["p1", "p2"], DEFAULT_TIME)
+    data = get_patient_resources("p1", table, DEFAULT_TIME, client=client)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == pytest.approx(result["p1"])
+
+
+@pytest.mark.parametrize("output, processes", [("scores.csv", 1), ("scores.parquet", 2)])
+def test_score_cohort(tmp_path, monkeypatch, output, processes):
+    estimator = FakeEstimator()
+    monkeypatch.setitem(model_registry._artifacts, "nsti", None)
+    model_registry.register("nsti", "./models/nsti/LR_model_NSTI_5fea", loader=lambda path: estimator)
+    resources = nsti_resources("p1", True) + nsti_resources("p2", False) + nsti_resources("p3", True, crp=False)
+    build_feature_store(FakeBulkClient(resources), str(tmp_path / "store"))
+
+    count = score_cohort(str(tmp_path / output), str(tmp_path / "store"), export=False, models=["nsti"],
+                         default_time=DEFAULT_TIME, chunk_size=2, processes=processes)
+    assert count == 3
+    result = pandas.read_csv(tmp_path / output) if output.endswith(".csv") else pandas.read_parquet(tmp_path / output)
+    result = result.set_index("patient_id")
+    assert result.loc["p1", "predict_value"] == pytest.approx(0.1)
+    assert result.loc["p2", "predict_value"] == pytest.approx(0.0)
+    assert pandas.isna(result.loc["p3", "predict_value"]) and "crp" in result.loc["p3", "error"]
@@ -0,0 +1,99 @@
+import os
+import shutil
+import time
+
+import pytest
+
+import app as mocab_app
+from base.config_manager import _ConfigManager
+from base.exceptions import FeatureCodeIsEmpty
+
+NEW_FEATURE = "\ndiabetes,hba1c,4548-4,,observation,0001-00-00T00:00:00,,latest"
+EMPTY_CODE = "\ndiabetes,hba1c,,,observation,0001-00-00T00:00:00,,latest"
+
+
+@pytest.fixture
+def paths(tmp_path):
+    paths = {"FEATURE_TABLE": str(tmp_path / "features.csv"),
+             "TRANSFORMATION_TABLE": str(tmp_path / "transformation.csv")}
+    shutil.copy("./config/features.csv", paths["FEATURE_TABLE"])
+    shutil.copy("./config/transformation.csv", paths["TRANSFORMATION_TABLE"])
+    return paths
+
+
+def append(path, line):
+    with open(path, "a") as f:
+        f.write(line)
+    # Make sure the change is seen even on file systems with a coarse mtime
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_reload_swaps_new_version(paths):
+    manager = _ConfigManager(paths)
+    old = manager.current
+    assert manager.check() is False
+
+    append(paths["FEATURE_TABLE"], NEW_FEATURE)
+    assert manager.check() is True
+    assert manager.current.version == old.version + 1 and manager.current.digest != old.digest
+    assert "hba1c" in manager.current.feature_table.get_model_feature_dict("diabetes")
+    # The requests in flight keep the old version
+    assert "hba1c" not in old.feature_table.get_model_feature_dict("diabetes")
+
+
+def test_reload_builds_prefetch_templates(paths):
+    manager = _ConfigManager(paths)
+    old = manager.current
+    assert "observation-4548-4" not in old.prefetch_templates
+
+    append(paths["FEATURE_TABLE"], NEW_FEATURE)
+    assert manager.check() is True
+    assert manager.current.prefetch_templates["observation-4548-4"].endswith("&date=ge{{today() - 366 days}}")
+    assert "observation-4548-4" not in old.prefetch_templates
+
+
+def test_invalid_table_keeps_active_version(paths):
+    manager = _ConfigManager(paths)
+    old = manager.current
+
+    append(paths["FEATURE_TABLE"], EMPTY_CODE)
+    assert manager.check() is False
+    assert manager.current is old
+    assert FeatureCodeIsEmpty.__name__ in manager.status()["last_error"]
+
+
+def test_touched_table_keeps_version(paths):
+    manager = _ConfigManager(paths)
+    old = manager.current
+
+    append(paths["TRANSFORMATION_TABLE"], "")
+    assert manager.check() is False
+    assert manager.current.version == old.version and manager.current.digest == old.digest
+
+
+def test_watcher_reloads_in_background(paths):
+    manager = _ConfigManager(paths, interval=0.05)
+    manager.start()
+    try:
+        version = manager.current.version
+        append(paths["FEATURE_TABLE"], NEW_FEATURE)
+        deadline = time.monotonic() + 5
+        while manager.current.version == version and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert manager.current.version == version + 1
+        assert manager.status()["watching"] is True
+    finally:
+        manager.stop()
+    assert manager.status()["watching"] is False
+
+
+def test_admin_config(monkeypatch, paths):
+    monkeypatch.setattr(mocab_app, "table_manager", _ConfigManager(paths))
+    response = mocab_app.app.test_client().get("/admin/config")
+
+    assert response.status_code == 200
+    status = response.get_json()
+    assert status["version"] == 1 and "diabetes" in status["models"]
+    assert status["files"]["FEATURE_TABLE"]["path"] == paths["FEATURE_TABLE"]
+    assert status["last_error"] is None
@@ -0,0 +1,132 @@
+import datetime
+import os
+
+from base.feature_store import FeatureStore
+from base.feature_store import FeatureStoreWriter
+from base.feature_store import build_feature_store
+from base.feature_store import compact
+from base.feature_store import feature_codes
+from base.search_sets import get_patient_resources
+from base.search_sets import get_resource_datetime_and_value
+from tests.fhir_stub import StubFHIRClient
+from tests.fhir_stub import observation
+from tests.functions.test_prefetch import _FeatureTable
+from tests.functions.test_prefetch import feature
+
+DEFAULT_TIME = datetime.datetime(2022, 1, 20)
+RESOURCES = [
+    {"resourceType": "Patient", "id": "p1", "birthDate": "2000-01-01"},
+    {"resourceType": "Patient", "id": "p2", "birthDate": "1990-01-01"},
+    observation("bp-1", "p1", "8462-4", "2022-01-01T08:00:00", 71, component_code="85354-9"),
+    observation("bp-2", "p1", "8462-4", "2022-01-02T08:00:00", 72, component_code="85354-9"),
+    observation("bp-3", "p1", "8462-4", "2010-01-02T08:00:00", 60, component_code="85354-9"),
+    observation("bp-4", "p2", "8462-4", "2022-01-03T08:00:00", 80, component_code="85354-9"),
+    observation("glu-1", "p1", "72-314", "2022-01-01T08:00:00", 101, system="https://www.cgmh.org.tw"),
+    observation("hr-1", "p1", "8867-4", "2022-01-01T08:00:00", 66),
+    {"resourceType": "Condition", "id": "c-1", "subject": {"reference": "Patient/p2"},
+     "code": {"coding": [{"code": "I10"}]}, "recordedDate": "2021-05-01"},
+    {"resourceType": "Encounter", "id": "e-1", "subject": {"reference": "Patient/p1"}},
+]
+
+
+class FakeBulkClient:
+    def __init__(self, resources):
+        self.resources = resources
+
+    def export_to(self, sink, max_workers=4):
+        for resource in self.resources:
+            sink(resource)
+        return len(self.resources)
+
+
+def test_feature_codes():
+    assert feature_codes(_FeatureTable()) == {"8462-4", "I10"}
+
+
+def test_build_feature_store(tmp_path):
+    assert build_feature_store(FakeBulkClient(RESOURCES), str(tmp_path), _FeatureTable()) == 7
+    store = FeatureStore(str(tmp_path))
+
+    assert [i['id'] for i in store.search("observation", "p1", "8462-4", "2017-01-20")] == ["bp-1", "bp-2"]
+    assert [i['id'] for i in store.search("observation", "p2", "8462-4")] == ["bp-4"]
+    assert store.search("observation", "p3", "8462-4") == []
+    assert [i['id'] for i in store.search("condition", "p2", "I10")] == ["c-1"]
+    assert store.search("condition", "p1", "I10") == []
+    assert store.search("patient", "p2")[0]['birthDate'] == "1990-01-01"
+    # Not kept in the store
+    assert store.search("patient", "p3") is None
+    assert store.search("observation", "p1", "8867-4") is None
+
+
+def test_feature_store_codes_with_system(tmp_path):
+    with FeatureStoreWriter(str(tmp_path), rows_per_file=2) as writer:
+        for resource in RESOURCES:
+            writer.add(resource)
+    store = FeatureStore(str(tmp_path))
+
+    assert [i['id'] for i in store.search("observation", "p1", "https://www.cgmh.org.tw|72-314")] == ["glu-1"]
+    assert store.search("observation", "p1", "http://loinc.org|72-314") == []
+    assert [i['id'] for i in store.search("observation", "p1", "85354-9,8867-4", "2022")] == ["bp-1", "hr-1", "bp-2"]
+
+
+def test_feature_store_keeps_newer_version(tmp_path):
+    with FeatureStoreWriter(str(tmp_path)) as writer:
+        writer.add(observation("bp-1", "p1", "8462-4", "2022-01-01T08:00:00", 71))
+    with FeatureStoreWriter(str(tmp_path)) as writer:
+        writer.add(observation("bp-1", "p1", "8462-4", "2022-01-01T08:00:00", 75))
+
+    assert [i['valueQuantity']['value'] for i in FeatureStore(str(tmp_path)).search("observation", "p1", "8462-4")] \
+        == [75]
+
+
+def test_feature_store_filters_newer_version_out(tmp_path):
+    with FeatureStoreWriter(str(tmp_path)) as writer:
+        writer.add(observation("bp-1", "p1", "8462-4", "2022-01-01T08:00:00", 71))
+        writer.add(observation("bp-2", "p1", "8462-4", "2022-01-02T08:00:00", 72))
+    with FeatureStoreWriter(str(tmp_path)) as writer:
+        # The newer version is before the date filter, the older one must not be read instead
+        writer.add(observation("bp-1", "p1", "8462-4", "2010-01-01T08:00:00", 75))
+    store = FeatureStore(str(tmp_path))
+
+    assert [i['id'] for i in store.search("observation", "p1", "8462-4", "2017-01-20")] == ["bp-2"]
+    assert store.frame("Observation", "8462-4", ["p1"], "2017-01-20")['id'].tolist() == ["bp-2"]
+    assert store.frame("Observation", "8462-4", ["p1"])['value'].tolist() == [72, 75]
+    assert store.frame("Observation", "8462-4", ["p2"]).empty
+
+
+def test_search_with_feature_store(tmp_path):
+    build_feature_store(FakeBulkClient(RESOURCES), str(tmp_path))
+    client = StubFHIRClient([])
+    store = FeatureStore(str(tmp_path))
+
+    data = get_patient_resources("p1", feature("8462-4", "observation"), DEFAULT_TIME, client=client, source=store)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == ("2022-01-02T00:00", 72)
+    data = get_patient_resources("p2", feature("I10", "condition"), DEFAULT_TIME, client=client, source=store)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] is True
+    data = get_patient_resources("p1", feature("age", "patient", ""), DEFAULT_TIME, client=client, source=store)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == 22
+    assert client.requests == []
+
+
+def test_feature_store_incremental_changes(tmp_path):
+    path = str(tmp_path)
+    build_feature_store(FakeBulkClient(RESOURCES), path)
+    with FeatureStoreWriter(path, incremental=True) as writer:
+        # bp-2 is updated with another code, bp-1 and p2 are deleted
+        writer.add(observation("bp-2", "p1", "8480-6", "2022-01-02T08:00:00", 120))
+        writer.delete("Observation", "bp-1")
+        writer.delete("Patient", "p2")
+    store = FeatureStore(path)
+
+    assert [i['id'] for i in store.search("observation", "p1", "8462-4")] == ["bp-3"]
+    assert [i['id'] for i in store.search("observation", "p1", "8480-6")] == ["bp-2"]
+    assert store.search("patient", "p2") is None
+
+    compact(path)
+    assert not os.path.exists(os.path.join(path, "_changes"))
+    compacted = FeatureStore(path)
+    assert [i['id'] for i in compacted.search("observation", "p1", "8462-4")] == ["bp-3"]
+    assert [i['id'] for i in compacted.search("observation", "p1", "8480-6")] == ["bp-2"]
+    assert compacted.search("patient", "p2") is None
+    assert compacted.search("patient", "p1")[0]['id'] == "p1"
+    assert len(os.listdir(os.path.join(path, "Observation", "8462-4"))) == 1
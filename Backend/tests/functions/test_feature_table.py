@@ -0,0 +1,66 @@
+import datetime
+
+import pytest
+from dateutil.relativedelta import relativedelta
+
+from base.feature_table import DataAliveTime
+from base.feature_table import _FeatureTable
+from base.patient_data_search import feature_search_key
+from base.search_sets import GetMean
+from base.search_sets import Observation
+from base.search_sets import get_data_time_since
+
+FEATURES = """model,feature,code,code_system,type_of_data,data_alive_time,default_value,search_type
+diabetes,glucose,72-314,https://www.cgmh.org.tw,observation,0005-00-00T00:00:00,,mean
+diabetes,insulin,72-496,https://www.cgmh.org.tw,observation,0005-00-00T00:00:00,,latest
+diabetes,insulin,72-49B,https://www.cgmh.org.tw,observation,0005-00-00T00:00:00,,latest
+diabetes,age,age,,patient,0000-00-00T00:00:00,,
+nsti,glucose,72-314,https://www.cgmh.org.tw,observation,0005-00-00T00:00:00,,mean
+nsti,crp,72-547,https://www.cgmh.org.tw,observation,0000-00-01T00:00:00,0.5,latest
+"""
+
+
+@pytest.fixture
+def table(tmp_path):
+    path = tmp_path / "features.csv"
+    path.write_text(FEATURES)
+    return _FeatureTable(str(path))
+
+
+def test_compiled_feature(table):
+    glucose = table.get_model_feature_dict("diabetes")["glucose"]
+    assert dict(glucose) == {"code": "https://www.cgmh.org.tw|72-314",
+                             "data_alive_time": DataAliveTime("0005-00-00T00:00:00"), "default_value": None,
+                             "type_of_data": "observation", "search_type": "mean"}
+    assert glucose.codes == (("https://www.cgmh.org.tw", "72-314"),)
+    assert glucose.resource_strategy is Observation and glucose.get_func is GetMean
+    assert glucose.search_key == feature_search_key(dict(glucose))
+    assert table.get_model_feature_dict("nsti")["crp"]["default_value"] == 0.5
+
+    insulin = table.get_model_feature_dict("diabetes")["insulin"]
+    assert [code for _, code in insulin.codes] == ["72-496", "72-49B"]
+
+
+def test_compiled_feature_is_read_only(table):
+    features = table.get_model_feature_dict("diabetes")
+    with pytest.raises(TypeError):
+        features["glucose"]["code"] = "72-315"
+    with pytest.raises(TypeError):
+        features["weight"] = {}
+    with pytest.raises(AttributeError):
+        features["glucose"].codes = ()
+
+
+def test_feature_table_indexes(table):
+    assert [(f.model, f.name) for f in table.get_features_by_code("72-314")] == [("diabetes", "glucose"),
+                                                                                ("nsti", "glucose")]
+    assert table.get_models_by_code("https://www.cgmh.org.tw|72-314") == ("diabetes", "nsti")
+    assert table.get_models_by_code("72-49B") == ("diabetes",)
+    assert table.get_features_by_code("8462-4") == ()
+
+
+def test_data_alive_time_delta():
+    data_alive_time = DataAliveTime("0001-02-03T04:05:06")
+    assert data_alive_time.delta == relativedelta(years=1, months=2, days=3, hours=4, minutes=5, seconds=6)
+    table = {"data_alive_time": data_alive_time}
+    assert get_data_time_since(table, datetime.datetime(2022, 5, 10)) == "2021-03-06"
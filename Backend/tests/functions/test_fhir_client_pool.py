@@ -0,0 +1,50 @@
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+
+import fhirpy
+from fhirpy.base.lib import SyncClient
+
+from base.fhir_client_pool import PooledSyncFHIRClient
+from base.fhir_client_pool import _FHIRClientPool
+
+
+def test_client_pool_shares_client():
+    pool = _FHIRClientPool(pool_maxsize=2, timeout=5)
+    client = pool.get_client("http://localhost:8090/fhir")
+    assert pool.get_client("http://localhost:8090/fhir/") is client
+    assert client.timeout == 5
+
+
+def test_client_pool_shares_session_between_tokens():
+    pool = _FHIRClientPool(pool_maxsize=2, timeout=5)
+    client = pool.get_client("http://localhost:8090/fhir")
+    first = pool.get_client("http://localhost:8090/fhir", "Bearer first")
+    second = pool.get_client("http://localhost:8090/fhir", "Bearer second")
+    assert first is not client and first.session is second.session is client.session
+    assert first._build_request_headers()["Authorization"] == "Bearer first"
+    assert second._build_request_headers()["Authorization"] == "Bearer second"
+    assert first.timeout == 5
+    # The session belongs to the pool, a client of a token doesn't close it
+    first.close()
+    assert len(pool._clients) == 1 and not first._owns_session and client._owns_session
+
+
+def test_client_pool_thread_safe_checkout():
+    pool = _FHIRClientPool()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: pool.get_client("http://localhost:8090/fhir"), range(32)))
+    assert len(set(id(client) for client in clients)) == 1
+
+
+def test_do_request_follows_fhirpy():
+    # PooledSyncFHIRClient._do_request is a copy of fhirpy's, only the request is sent through the session.
+    # If fhirpy is upgraded, check the override again before changing the pins.
+    upstream = inspect.getsource(SyncClient._do_request).splitlines()
+    override = [line for line in inspect.getsource(PooledSyncFHIRClient._do_request).splitlines()
+                if not line.strip().startswith("#")]
+    assert inspect.signature(PooledSyncFHIRClient._do_request) == inspect.signature(SyncClient._do_request)
+    assert [line for line in override if "self.session.request(" not in line] == \
+        [line for line in upstream if "requests.request(" not in line]
+    for requirement in ("./requirement.txt", "./requirement-arm.txt"):
+        with open(requirement) as f:
+            assert "fhirpy=={}".format(fhirpy.__version__) in f.read().split()
@@ -0,0 +1,241 @@
+import re
+import threading
+
+import pandas
+import pytest
+
+from models.qcsi import mask
+from models.qcsi.mask_module import ConcreteMaskMart
+from models.qcsi.mask_module import ConcreteMaskType
+from models.qcsi.mask_module import ConcreteRegexSearch
+from models.qcsi.mask_module.matcher import ChangeCounter
+from models.qcsi.mask_module.matcher import required_keyword
+from models.qcsi.model import unit_conversion
+
+TEXTS = [
+    "O2 nasal 3l/min use",
+    "O2 NASAL 3L/MIN USE",
+    "MASK 10L/MIN->N/C 3L/MIN",
+    "N/C 3L/MIN->MASK 10L/MIN",
+    "simple mask 8l/min",
+    "Simple Mask 40%",
+    "s/m 6 lpm",
+    "S-M 6 L",
+    "s'm 8l/ min",
+    "non-rebreathing mask 15 l/m",
+    "Nonrebreather 90 %",
+    "tracheal mask 35%",
+    "tracheal 5 l",
+    "nc 2l/min",
+    "nasal cannula 3 lpm",
+    "cannula 4 l/min",
+    "Nasal 40 %",
+    "5",
+    "5 ",
+    "mask\n 40%",
+    "nasal\n3 l/min",
+    "Nasal cannula\t3 l/min",
+    "room air",
+    "O2 ı nasal 3l/min",
+    "N/C 2L/MIN -> mask 40% -> non-rebreath 12 l/m",
+    "IV fluid 500ml -> check vital sign",
+]
+
+
+def cascade(mask_types, text):
+    """
+    The detection of treatment_mining before it was compiled
+    """
+    def regex_search(searches, string):
+        for search in searches:
+            for pattern in search.pattern:
+                regex = re.search(pattern, string, re.IGNORECASE)
+                if regex:
+                    value = regex.group(1).replace(" ", "").replace("l", "").replace("L", "").replace("%", "")
+                    return {"type": search.name, "value": int(value)}
+        return None
+
+    for mask_type in mask_types:
+        response = regex_search(mask_type.regex_search_sets, text)
+        segments = text.split("->")
+        segments.reverse()
+        if len(segments) != 1:
+            for segment in segments:
+                temp = regex_search(mask_type.regex_search_sets, segment)
+                if temp is not None:
+                    response = temp
+                    break
+        if response:
+            return {"mask_name": mask_type.name, "unit_type": response["type"], "value": response["value"]}
+    return None
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_treatment_mining_matches_cascade(text):
+    mask_mart = mask.mask_mart
+    try:
+        expected = cascade(mask_mart._types, text)
+    except ValueError:
+        with pytest.raises(ValueError):
+            mask_mart.treatment_mining(text)
+        return
+    assert mask_mart.treatment_mining(text) == expected
+
+
+@pytest.mark.parametrize("text", ["", "  ", "\n"])
+def test_treatment_mining_of_empty_text(text):
+    assert mask.mask_mart.treatment_mining(text) is None
+
+
+def test_treatment_mining_memo_keeps_spacing():
+    mask_mart = mask_mart_of(mask.mask_mart._types)
+    # The spacing changes the result of the cascade, the texts are not one key
+    assert mask_mart.treatment_mining("5") == cascade(mask_mart._types, "5")
+    assert mask_mart.treatment_mining("5 ") is None
+    assert mask_mart.treatment_mining("nasal 3 l/min")["value"] == 3
+    assert mask_mart.treatment_mining("nasal\n3 l/min") == cascade(mask_mart._types, "nasal\n3 l/min")
+    assert mask_mart.cache_stats()["size"] == 4
+
+
+@pytest.mark.parametrize("pattern, keyword", [
+    (r"nasal.*?(\d{1,2}) *([l1]\/m|lpm)", "nasal"),
+    (r"non-?rebreath.*(\d{1,2}) *(l\/m|lpm)", "non"),
+    (r"s\/m.*(\d{1,2})", "s/m"),
+    (r"S'M.*?(\d{1,2})", "s'm"),
+    (r"(^[0-9]*$)", ""),
+    (r"mask|nc", ""),
+    (r"ma+sk", "ma"),
+])
+def test_required_keyword(pattern, keyword):
+    assert required_keyword(pattern) == keyword
+
+
+def test_matcher_is_compiled_again_after_change():
+    mask_mart = ConcreteMaskMart()
+    mask_type = ConcreteMaskType("V-Mask")
+    search = ConcreteRegexSearch("o2_flow_rate", [r"venturi (\d{1,2}) *l"])
+    mask_type.attach_search_regex(search)
+    mask_mart.attach(mask_type)
+    try:
+        assert mask_mart.treatment_mining("Venturi 6L") == {"mask_name": "V-Mask", "unit_type": "o2_flow_rate",
+                                                           "value": 6}
+        assert mask_mart.treatment_mining("venturi at 6L") is None
+        search.pattern = r"venturi at (\d{1,2}) *l"
+        assert mask_mart.treatment_mining("venturi at 6L")["value"] == 6
+    finally:
+        mask_mart.detach(mask_type)
+    assert mask_mart.treatment_mining("venturi at 6L") is None
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_treatment_mining_batch(processes):
+    texts = pandas.Series(["O2 nasal 3l/min use", "Simple Mask 40%", None, "", "room air", "O2 nasal 3l/min use"],
+                          index=[10, 11, 12, 13, 14, 15])
+    result = mask.treatment_mining_batch(texts, processes=processes, chunk_size=1)
+    assert list(result.index) == [10, 11, 12, 13, 14, 15]
+    assert list(result.columns) == ["mask_name", "unit_type", "value", "o2_flow_rate"]
+    assert result.loc[10].tolist() == ["Nasal Cannula", "o2_flow_rate", 3, 3]
+    assert result.loc[15].tolist() == result.loc[10].tolist()
+    # The FiO2 is converted to the flow rate as qcsi predict does
+    assert result.loc[11].tolist() == ["Simple Mask", "fio2", 40, unit_conversion(mask.mask_mart.treatment_mining(
+        "Simple Mask 40%"))]
+    assert result.loc[[12, 13, 14]].isna().all(axis=None)
+
+
+def test_treatment_mining_batch_empty():
+    result = mask.treatment_mining_batch([])
+    assert result.empty and list(result.columns) == ["mask_name", "unit_type", "value", "o2_flow_rate"]
+
+
+def mask_mart_of(mask_types, cache_size=None):
+    mask_mart = ConcreteMaskMart(cache_size)
+    for mask_type in mask_types:
+        mask_mart.attach(mask_type)
+    return mask_mart
+
+
+def test_treatment_mining_memo():
+    mask_mart = mask_mart_of(mask.mask_mart._types, cache_size=2)
+    first = mask_mart.treatment_mining("O2 nasal 3l/min use")
+    first["value"] = 99
+    # Another case of the same order is a hit, and the cached result was not changed by the caller
+    assert mask_mart.treatment_mining("o2 NASAL 3L/MIN USE")["value"] == 3
+    assert mask_mart.treatment_mining("room air") is None
+    assert mask_mart.treatment_mining("Room Air") is None
+    mask_mart.treatment_mining("Simple Mask 40%")
+    stats = mask_mart.cache_stats()
+    assert (stats["size"], stats["hits"], stats["misses"], stats["evictions"]) == (2, 2, 3, 1)
+    assert stats["hit_rate"] == pytest.approx(0.4)
+
+
+def test_treatment_mining_memo_is_cleared_after_change():
+    mask_mart = ConcreteMaskMart()
+    mask_type = ConcreteMaskType("V-Mask", ConcreteRegexSearch("o2_flow_rate", [r"venturi (\d{1,2}) *l"]))
+    assert mask_mart.treatment_mining("venturi 6L") is None
+    mask_mart.attach(mask_type)
+    try:
+        assert mask_mart.treatment_mining("venturi 6L")["mask_name"] == "V-Mask"
+        assert mask_mart.cache_stats()["size"] == 1
+    finally:
+        mask_mart.detach(mask_type)
+    assert mask_mart.treatment_mining("venturi 6L") is None
+
+
+def test_mask_marts_do_not_share_mask_types():
+    mask_types = mask.mask_mart._types
+    mask_mart = mask_mart_of(mask_types)
+    assert mask_mart._types == mask_types
+    # Building the masks again doesn't add observers to the other marts
+    assert len(mask.mask()._types) == len(mask_types) == 4
+    assert mask.mask_mart is not mask_mart and mask_mart._types == mask_types
+    assert ConcreteMaskMart()._types == ()
+
+
+def test_attach_publishes_a_new_snapshot():
+    mask_mart = mask_mart_of(mask.mask_mart._types)
+    revision, types, matcher = mask_mart.snapshot
+    assert mask_mart.snapshot[2] is matcher
+    mask_type = ConcreteMaskType("V-Mask", ConcreteRegexSearch("o2_flow_rate", [r"venturi (\d{1,2}) *l"]))
+    mask_mart.attach(mask_type, 1)
+    assert mask_mart._types[0] is mask_type and types == mask.mask_mart._types
+    assert mask_mart.snapshot[2] is not matcher
+    assert mask_mart.treatment_mining("venturi 6L")["mask_name"] == "V-Mask"
+    # The other marts are not changed
+    assert mask.mask_mart.treatment_mining("venturi 6L") is None
+
+
+def test_mining_while_attaching():
+    mask_mart = mask_mart_of(mask.mask_mart._types)
+    mask_type = ConcreteMaskType("V-Mask", ConcreteRegexSearch("o2_flow_rate", [r"venturi (\d{1,2}) *l"]))
+    results, stop = [], threading.Event()
+
+    def mining():
+        while not stop.is_set():
+            results.append(mask_mart.notify("O2 nasal 3l/min use"))
+
+    readers = [threading.Thread(target=mining) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for _ in range(200):
+        mask_mart.attach(mask_type, 1)
+        mask_mart.detach(mask_type)
+    stop.set()
+    for reader in readers:
+        reader.join()
+    assert results and all(result["mask_name"] == "Nasal Cannula" for result in results)
+    assert mask_mart._types == mask.mask_mart._types
+
+
+def test_rules_revision_bump_is_atomic():
+    counter = ChangeCounter()
+
+    def bump():
+        for _ in range(10000):
+            counter.bump()
+
+    threads = [threading.Thread(target=bump) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.value == 40000
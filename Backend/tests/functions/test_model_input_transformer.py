@@ -1,5 +1,7 @@
+import numpy
 import pytest
 from base.model_input_transformer import transformer
+from base.model_input_transformer import transformer_batch
 
 test_list = [({
                   "sea": {
@@ -86,3 +88,32 @@ test_list = [({
 def test_transformer(test_input, test_model, expected):
     assert transformer(test_input, test_model) == expected
 
+
+def test_transformer_checks_first_condition():
+    # Only the first condition of a case is checked, e.g. spo2 85 meets "le|92" of "2=le|92&ge|89"
+    patient_data_dict = {"respiratory_rate": {"value": 20}, "o2_flow_rate": {"value": 10}, "spo2": {"value": 85}}
+    assert transformer(patient_data_dict, "qcsi") == [0, 2, 4]
+
+
+def test_transformer_batch():
+    columns = {"respiratory_rate": [25, 20, 30], "o2_flow_rate": [3, 1, 5], "spo2": [90, 85, 95]}
+    matrix = transformer_batch(columns, "qcsi")
+
+    assert matrix.tolist() == [[1, 2, 4], [0, 2, 0], [1, 0, 4]]
+    for i in range(3):
+        row = {name: {"value": values[i]} for name, values in columns.items()}
+        assert transformer(row, "qcsi") == matrix[i].tolist()
+
+
+def test_transformer_batch_formula():
+    diabetes = test_list[2][0]
+    columns = {name: [diabetes[name]["value"]] * 2 for name in diabetes if name != "predict_value"}
+    matrix = transformer_batch(columns, "diabetes")
+
+    assert matrix.shape == (2, 8)
+    assert matrix[0].tolist() == pytest.approx(test_list[2][2])
+
+
+def test_transformer_batch_value_not_suitable():
+    with pytest.raises(ValueError):
+        transformer_batch({"sea": numpy.array(["unknown"], dtype=object)}, "nsti")
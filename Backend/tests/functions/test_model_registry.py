@@ -0,0 +1,41 @@
+import os
+
+import joblib
+import pytest
+from base.model_registry import _ModelRegistry
+
+
+def test_model_registry_loads_once(tmp_path):
+    artifact = tmp_path / "model.sav"
+    joblib.dump({"version": 1}, artifact)
+    load_count = []
+
+    def loader(path):
+        load_count.append(path)
+        return joblib.load(path)
+
+    registry = _ModelRegistry()
+    registry.register("test", str(artifact), loader=loader)
+    assert not registry.is_loaded("test")
+    assert registry.get("test") == {"version": 1}
+    assert registry.get("test") is registry.get("test")
+    assert len(load_count) == 1
+
+
+def test_model_registry_hot_reload(tmp_path):
+    artifact = tmp_path / "model.sav"
+    joblib.dump({"version": 1}, artifact)
+    registry = _ModelRegistry()
+    registry.register("test", str(artifact))
+    assert registry.get("test") == {"version": 1}
+
+    joblib.dump({"version": 2}, artifact)
+    stat = os.stat(artifact)
+    os.utime(artifact, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert registry.get("test") == {"version": 2}
+
+
+def test_model_registry_unknown_model():
+    registry = _ModelRegistry()
+    with pytest.raises(KeyError):
+        registry.get("unknown")
@@ -0,0 +1,112 @@
+import datetime
+
+from base.cds_hooks_work.service import Service
+from base.feature_table import DataAliveTime
+from base.prefetch import PrefetchBundles
+from base.prefetch import alive_days
+from base.prefetch import build_prefetch_templates
+from base.search_sets import get_patient_resources
+from base.search_sets import get_resource_datetime_and_value
+from tests.fhir_stub import StubFHIRClient
+from tests.fhir_stub import observation
+
+DEFAULT_TIME = datetime.datetime(2022, 1, 20)
+PREFETCH = {
+    "observation-8462-4": {"resourceType": "Bundle", "entry": [
+        {"resource": observation("bp-1", "p1", "8462-4", "2022-01-01T08:00:00", 71, component_code="85354-9")},
+        {"resource": observation("bp-2", "p1", "8462-4", "2022-01-02T08:00:00", 72, component_code="85354-9")},
+        {"resource": observation("bp-3", "p1", "8462-4", "2010-01-02T08:00:00", 60, component_code="85354-9")},
+    ]},
+    "condition-I10": {"resourceType": "Bundle", "entry": []},
+    "patient": {"resourceType": "Patient", "id": "p1", "birthDate": "2000-01-01"},
+}
+
+
+class _FeatureTable:
+    table = {
+        "diabetes": {
+            "diastolic_blood_pressure": {"code": "8462-4", "type_of_data": "observation",
+                                         "data_alive_time": DataAliveTime("0001-00-00T00:00:00")},
+            "hypertension": {"code": "I10", "type_of_data": "condition",
+                             "data_alive_time": DataAliveTime("0005-00-00T00:00:00")},
+            "age": {"code": "age", "type_of_data": "patient", "data_alive_time": DataAliveTime("0000-00-00T00:00:00")},
+        },
+        "stroke": {
+            "diastolic_blood_pressure": {"code": "8462-4", "type_of_data": "observation",
+                                         "data_alive_time": DataAliveTime("0000-02-03T01:00:00")},
+        },
+    }
+
+    def get_exist_model_name(self):
+        return list(self.table)
+
+    def get_model_feature_dict(self, model_name):
+        return self.table[model_name]
+
+
+def feature(code, type_of_data, search_type="latest"):
+    return {'code': code, 'data_alive_time': DataAliveTime("0005-00-00T00:00:00"), 'type_of_data': type_of_data,
+            'default_value': None, 'search_type': search_type}
+
+
+def test_build_prefetch_templates():
+    assert build_prefetch_templates(_FeatureTable()) == {
+        # The longest data_alive_time of the code, 1 year
+        "observation-8462-4": "Observation?subject={{context.patientId}}&combo-code=8462-4&_sort=-date"
+                              "&date=ge{{today() - 366 days}}",
+        "condition-I10": "Condition?subject={{context.patientId}}&code=I10",
+        "patient": "Patient/{{context.patientId}}",
+    }
+
+
+def test_alive_days():
+    assert alive_days(DataAliveTime("0000-02-03T01:00:00")) == 2 * 31 + 3 + 1
+    assert alive_days(DataAliveTime("0005-00-00T00:00:00")) == 5 * 366
+    assert alive_days(DataAliveTime("0000-00-00T00:00:00")) == 0
+
+
+def test_prefetch_bundles_search():
+    prefetch = PrefetchBundles(PREFETCH)
+    assert [i['id'] for i in prefetch.search("observation", "p1", "8462-4", "2017-01-20")] == ["bp-1", "bp-2"]
+    assert prefetch.search("condition", "p1", "I10") == []
+    assert prefetch.search("observation", "p1", "72-314", "2017-01-20") is None
+
+
+def test_prefetch_bundles_fall_back_to_server():
+    next_page = dict(PREFETCH["observation-8462-4"], link=[
+        {"relation": "self", "url": "http://fhir/Observation?combo-code=8462-4"},
+        {"relation": "next", "url": "http://fhir/Observation?combo-code=8462-4&page=2"}])
+    # Only the first page was prefetched
+    assert PrefetchBundles({"observation-8462-4": next_page}).search("observation", "p1", "8462-4") is None
+    # The prefetched data are of another patient
+    prefetch = PrefetchBundles(PREFETCH)
+    assert prefetch.search("observation", "p2", "8462-4", "2017-01-20") is None
+    assert prefetch.search("patient", "p2") is None
+    assert prefetch.search("patient", "p1")[0]["id"] == "p1"
+
+
+def test_search_with_prefetch_source():
+    client = StubFHIRClient([observation("glu-1", "p1", "72-314", "2022-01-01T08:00:00", 101)])
+    source = PrefetchBundles(PREFETCH)
+
+    data = get_patient_resources("p1", feature("8462-4", "observation"), DEFAULT_TIME, client=client, source=source)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == ("2022-01-02T00:00", 72)
+    data = get_patient_resources("p1", feature("I10", "condition"), DEFAULT_TIME, client=client, source=source)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] is False
+    data = get_patient_resources("p1", feature("age", "patient", ""), DEFAULT_TIME, client=client, source=source)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == 22
+    assert client.requests == []
+
+    # Not prefetched, search the FHIR server
+    data = get_patient_resources("p1", feature("72-314", "observation"), DEFAULT_TIME, client=client, source=source)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == 101
+    assert len(client.requests) == 1
+
+
+def test_service_prefetch_follows_tables():
+    tables = {"prefetch": {"patient": "Patient/{{context.patientId}}"}}
+    service = Service("patient-view", "service", "", prefetch=lambda: tables["prefetch"])
+    assert service.to_dict()["prefetch"] == {"patient": "Patient/{{context.patientId}}"}
+    # e.g. the tables were reloaded
+    tables["prefetch"] = build_prefetch_templates(_FeatureTable())
+    assert service.to_dict()["prefetch"] == tables["prefetch"]
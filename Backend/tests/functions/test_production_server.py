@@ -0,0 +1,39 @@
+import sys
+
+import pytest
+
+from base import production_server
+from config import configObject as config
+
+
+def test_server_options(monkeypatch):
+    monkeypatch.setitem(config, "server", dict(config["server"], WORKERS=None, THREADS=4, TIMEOUT=120))
+    monkeypatch.setattr(production_server.os, "cpu_count", lambda: 4)
+    options = production_server.server_options()
+    assert (options["bind"], options["workers"], options["threads"], options["timeout"]) == \
+           (config["server"]["BIND"], 9, 4, 120)
+    # The app is loaded in the master, the workers are forked with it
+    assert options["preload_app"] and options["worker_class"] == "gthread"
+    assert options["post_fork"] is production_server.post_fork
+
+
+def test_server_options_arguments():
+    options = production_server.server_options("127.0.0.1:8000", workers=2, threads=8, timeout=0)
+    assert (options["bind"], options["workers"], options["threads"], options["timeout"]) == \
+           ("127.0.0.1:8000", 2, 8, 0)
+
+
+def test_run_without_gunicorn(monkeypatch):
+    monkeypatch.setitem(sys.modules, "gunicorn.app.base", None)
+    with pytest.raises(ImportError, match="pip install gunicorn"):
+        production_server.run(production_server.server_options())
+
+
+def test_cds_hooks_app():
+    assert production_server.server_options(app="cds-hooks")["bind"] == config["server"]["CDS_HOOKS_BIND"]
+    cds_hooks = production_server.load_app("cds-hooks")
+    response = cds_hooks.test_client().get("/cds-services")
+    assert response.status_code == 200
+    assert [service["id"] for service in response.get_json()["services"]] == ["MoCab-CDS-Service"]
+    with pytest.raises(AttributeError):
+        production_server.load_app("unknown")
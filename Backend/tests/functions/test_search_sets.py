@@ -0,0 +1,215 @@
+import datetime
+
+import pytest
+from fhirpy.base.exceptions import ResourceNotFound
+
+from base.cache import LRUCache
+from base.feature_table import DataAliveTime
+from base.search_sets import get_patient_resources
+from base.search_sets import get_patient_window_resources
+from base.search_sets import effective_days
+from base.search_sets import get_resource_datetime_and_value
+from tests.fhir_stub import StubFHIRClient
+from tests.fhir_stub import observation
+
+DEFAULT_TIME = datetime.datetime(2022, 1, 20)
+GLUCOSE = [observation("glu-{}".format(day), "p1", "72-314", "2022-01-{:02d}T08:00:00".format(day), 100 + day,
+                       system="https://www.cgmh.org.tw") for day in range(1, 20)]
+BLOOD_PRESSURE = [observation("bp-{}".format(day), "p1", "8462-4", "2022-01-{:02d}T08:00:00".format(day), 70 + day,
+                              component_code="85354-9") for day in range(1, 10)]
+
+
+def feature(code, search_type="latest", type_of_data="observation", default_value=None):
+    return {'code': code, 'data_alive_time': DataAliveTime("0005-00-00T00:00:00"), 'type_of_data': type_of_data,
+            'default_value': default_value, 'search_type': search_type}
+
+
+def test_latest_observation_asks_for_one_resource():
+    client = StubFHIRClient(GLUCOSE)
+    data = get_patient_resources("p1", feature("https://www.cgmh.org.tw|72-314"), DEFAULT_TIME, client=client)
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == ("2022-01-19T00:00", 119)
+    assert all(params['_count'] == ['1'] for _, params in client.requests)
+
+
+def test_latest_component_observation():
+    client = StubFHIRClient(BLOOD_PRESSURE)
+    data = get_patient_resources("p1", feature("8462-4"), DEFAULT_TIME, client=client)
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == ("2022-01-09T00:00", 79)
+
+
+def code_paths(*paths, base_url="http://stub/fhir", maxsize=1024):
+    memo = LRUCache(maxsize, ttl=float('inf'))
+    for code, path in paths:
+        memo.set((base_url, code), path)
+    return memo
+
+
+def test_missing_observation_uses_default_value():
+    client = StubFHIRClient([])
+    data = get_patient_resources("p1", feature("3151-8", default_value=21), DEFAULT_TIME, client=client)
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == 21
+
+
+def test_component_code_path_is_remembered(monkeypatch):
+    monkeypatch.setattr("base.search_sets._observation_code_path", code_paths())
+    client = StubFHIRClient(BLOOD_PRESSURE)
+    get_patient_resources("p1", feature("8462-4"), DEFAULT_TIME, client=client)
+    data = get_patient_resources("p1", feature("8462-4"), DEFAULT_TIME, client=client)
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == 79
+    assert [list(params)[2] for _, params in client.requests] == ['combo-code', 'component-code']
+
+
+def test_combo_code_not_supported(monkeypatch):
+    monkeypatch.setattr("base.search_sets._observation_code_path", code_paths())
+    client = StubFHIRClient(BLOOD_PRESSURE, unsupported_params=('combo-code',))
+    data = get_patient_resources("p1", feature("8462-4"), DEFAULT_TIME, client=client)
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == 79
+    assert [list(params)[2] for _, params in client.requests] == ['combo-code', 'code', 'component-code']
+
+
+def test_remembered_code_path_falls_back(monkeypatch):
+    # The code was remembered as Observation.code, but this patient's blood pressure is in the components
+    memo = code_paths(("8462-4", "code"))
+    monkeypatch.setattr("base.search_sets._observation_code_path", memo)
+    client = StubFHIRClient(BLOOD_PRESSURE)
+    data = get_patient_resources("p1", feature("8462-4"), DEFAULT_TIME, client=client)
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == 79
+    assert [list(params)[2] for _, params in client.requests] == ['code', 'component-code']
+    assert memo.get(("http://stub/fhir", "8462-4")) == "component_code"
+
+
+def test_code_path_is_remembered_per_server(monkeypatch):
+    # Another server keeps the code in Observation.code, it doesn't change how this server is searched
+    monkeypatch.setattr("base.search_sets._observation_code_path",
+                        code_paths(("8462-4", "code"), base_url="http://other/fhir", maxsize=1))
+    client = StubFHIRClient(BLOOD_PRESSURE)
+    get_patient_resources("p1", feature("8462-4"), DEFAULT_TIME, client=client)
+
+    assert [list(params)[2] for _, params in client.requests] == ['combo-code']
+
+
+def with_systolic(resource, value):
+    resource = dict(resource, component=resource['component'] + [
+        {'code': {'coding': [{'code': '8480-6'}]}, 'valueQuantity': {'value': value}}])
+    return resource
+
+
+@pytest.mark.parametrize("search_type, date, value", [("max", "2022-01-19T00:00", 119), ("min", "2022-01-01T00:00", 101)])
+def test_max_min_observation_sorted_by_server(monkeypatch, search_type, date, value):
+    monkeypatch.setattr("base.search_sets._observation_code_path",
+                        code_paths(("https://www.cgmh.org.tw|72-314", "code")))
+    client = StubFHIRClient(GLUCOSE)
+    data = get_patient_resources("p1", feature("https://www.cgmh.org.tw|72-314", search_type), DEFAULT_TIME,
+                                 client=client)
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == (date, value)
+    assert [(params['_sort'], params['_count']) for _, params in client.requests] == \
+        [(['-value-quantity' if search_type == "max" else 'value-quantity'], ['1'])]
+
+
+@pytest.mark.parametrize("search_type, value", [("max", 119), ("min", 101)])
+def test_max_min_observation_value_sort_not_supported(monkeypatch, search_type, value):
+    monkeypatch.setattr("base.search_sets._observation_code_path", code_paths(("72-314", "code")))
+    client = StubFHIRClient(GLUCOSE, page_size=5, unsupported_params=('-value-quantity', 'value-quantity'))
+    data = get_patient_resources("p1", feature("72-314", search_type), DEFAULT_TIME, client=client)
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == value
+    # One failed sort, then the 19 resources page by page
+    assert len(client.requests) == 1 + 4
+
+
+@pytest.mark.parametrize("search_type, date, value", [("max", "2022-01-09T00:00", 79), ("min", "2022-01-01T00:00", 71)])
+def test_max_min_component_observation(monkeypatch, search_type, date, value):
+    monkeypatch.setattr("base.search_sets._observation_code_path", code_paths())
+    # The systolic pressure goes down while the diastolic pressure goes up, sorting by the components is not enough
+    client = StubFHIRClient([with_systolic(resource, 200 - day) for day, resource in enumerate(BLOOD_PRESSURE)],
+                            page_size=4)
+    data = get_patient_resources("p1", feature("8462-4", search_type), DEFAULT_TIME, client=client)
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == (date, value)
+    assert all('_sort' not in params or params['_sort'] == ['-date'] for _, params in client.requests)
+
+
+def test_max_observation_from_source():
+    class Source:
+        def search(self, type_of_data, patient_id, code=None, since=None):
+            return GLUCOSE
+
+    client = StubFHIRClient([])
+    data = get_patient_resources("p1", feature("72-314", "max"), DEFAULT_TIME, client=client, source=Source())
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == 119
+    assert client.requests == []
+
+
+def test_unknown_search_type():
+    with pytest.raises(AttributeError):
+        get_patient_resources("p1", feature("72-314", "median"), DEFAULT_TIME, client=StubFHIRClient(GLUCOSE))
+
+
+@pytest.mark.parametrize("search_type, glucose, blood_pressure", [
+    ("mean", 110, 75), ("count", 19, 9), ("delta", 18, 8), ("slope", 1, 1),
+])
+def test_window_observation(search_type, glucose, blood_pressure):
+    client = StubFHIRClient(GLUCOSE + BLOOD_PRESSURE, page_size=5)
+    data = get_patient_resources("p1", feature("72-314", search_type), DEFAULT_TIME, client=client)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == ("2022-01-19T00:00", pytest.approx(glucose))
+
+    data = get_patient_resources("p1", feature("8462-4", search_type), DEFAULT_TIME, client=client)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == ("2022-01-09T00:00", pytest.approx(blood_pressure))
+
+
+def test_window_observation_from_source():
+    class Source:
+        def search(self, type_of_data, patient_id, code=None, since=None):
+            return GLUCOSE[:3]
+
+    client = StubFHIRClient([])
+    data = get_patient_resources("p1", feature("72-314", "slope"), DEFAULT_TIME, client=client, source=Source())
+
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == ("2022-01-03T00:00", pytest.approx(1))
+    assert client.requests == []
+
+
+def test_empty_window():
+    client = StubFHIRClient(GLUCOSE[:1])
+    data = get_patient_resources("p1", feature("3151-8", "count"), DEFAULT_TIME, client=client)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME) == (None, 0)
+
+    data = get_patient_resources("p1", feature("3151-8", "mean", default_value=21), DEFAULT_TIME, client=client)
+    assert get_resource_datetime_and_value(data, DEFAULT_TIME)[1] == 21
+    with pytest.raises(ResourceNotFound):
+        get_patient_resources("p1", feature("3151-8", "mean"), DEFAULT_TIME, client=client)
+    # The delta and the slope need two values at least
+    with pytest.raises(ResourceNotFound):
+        get_patient_resources("p1", feature("72-314", "delta"), DEFAULT_TIME, client=client)
+
+
+def test_window_features_share_the_search():
+    client = StubFHIRClient(GLUCOSE, page_size=5)
+    tables = [feature("72-314", "mean"), feature("72-314", "count"), feature("72-314", "slope"),
+              feature("72-314", "delta", default_value=0)]
+    results = get_patient_window_resources("p1", tables, DEFAULT_TIME, client=client)
+
+    assert [get_resource_datetime_and_value(data, DEFAULT_TIME)[1] for data in results] == \
+        [pytest.approx(110), 19, pytest.approx(1), pytest.approx(18)]
+    # One searchset of 19 resources in pages of 5
+    assert len(client.requests) == 4
+
+    results = get_patient_window_resources("p1", [feature("3151-8", "count"), feature("3151-8", "mean"),
+                                                  feature("3151-8", "mean", default_value=21)],
+                                           DEFAULT_TIME, client=StubFHIRClient([]))
+    assert get_resource_datetime_and_value(results[0], DEFAULT_TIME)[1] == 0
+    assert isinstance(results[1], ResourceNotFound)
+    assert get_resource_datetime_and_value(results[2], DEFAULT_TIME)[1] == 21
+
+
+def test_effective_days_of_mixed_formats():
+    days = effective_days(["2021-03-06", "2021-03-06T12:00:00+08:00", "2021-03-07T00:00:00Z", "2021-03-07T06:00:00"])
+    assert days.tolist() == pytest.approx([18692, 18692 + 4 / 24, 18693, 18693.25])
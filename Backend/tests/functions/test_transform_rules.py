@@ -0,0 +1,124 @@
+import operator
+
+import numpy
+import pytest
+
+from base.transform_rules import CategoryCases
+from base.transform_rules import CategoryLookup
+from base.transform_rules import CategoryTable
+from base.transform_rules import Formula
+from base.transform_rules import TransformPlan
+from base.transform_rules import compile_category
+
+
+def case(category, *conditions):
+    return {'category': category, 'conditions': [{'prefix': prefix, 'condition': condition}
+                                                 for prefix, condition in conditions]}
+
+
+SPO2 = [case(0, ('gt', 92)), case(2, ('le', 92), ('ge', 89)), case(5, ('lt', 88))]
+RESPIRATORY_RATE = [case(0, ('le', 22)), case(1, ('gt', 22), ('le', 28)), case(2, ('gt', 28))]
+SEA = [case(1, ('eq', True)), case(0, ('eq', False))]
+O2_FLOW_RATE = [case(0, ('le', 2)), case(4, ('gt', 2), ('le', 4)), case(5, ('gt', 4), ('le', 6))]
+
+
+def baseline_category(value, cases):
+    """
+    The category matching of the transformer before the rules were compiled
+    """
+    for transfer_dict in cases:
+        for condition in transfer_dict['conditions']:
+            if not getattr(operator, condition['prefix'])(value, condition['condition']):
+                break
+            return transfer_dict['category']
+    raise ValueError('Value is not suitable in the configuration.')
+
+
+@pytest.mark.parametrize("cases, value, category", [
+    (O2_FLOW_RATE, 10, 4),
+    (O2_FLOW_RATE, 2, 0),
+    (SPO2, 88, 2),
+    (SPO2, 88.5, 2),
+    (SPO2, 80, 2),
+    (SPO2, 92.5, 0),
+])
+def test_category_boundaries(cases, value, category):
+    assert baseline_category(value, cases) == category
+    assert CategoryCases(cases)(value) == category
+    assert compile_category(cases)(value) == category
+    assert compile_category(cases).batch(numpy.array([value])).tolist() == [category]
+
+
+@pytest.mark.parametrize("cases", [SPO2, RESPIRATORY_RATE, O2_FLOW_RATE, SEA,
+                                   [case(1, ('ne', 3)), case(2, ('eq', 3))], [case(1), case(2, ('lt', 5))]])
+def test_category_matches_baseline(cases):
+    rule = compile_category(cases)
+    for value in [v / 2 for v in range(-4, 130)] + [True, False, float('nan')]:
+        try:
+            expected = baseline_category(value, cases)
+        except ValueError:
+            with pytest.raises(ValueError):
+                rule(value)
+            continue
+        assert rule(value) == expected
+
+
+@pytest.mark.parametrize("cases", [SPO2, RESPIRATORY_RATE, [case(1, ('ne', 3)), case(2, ('eq', 3))]])
+def test_category_table_matches_cases(cases):
+    table, rule = CategoryTable(cases), CategoryCases(cases)
+    values = [v / 2 for v in range(0, 130)] + [87.9, 88.1, 92.0001]
+
+    for value in values:
+        try:
+            expected = rule(value)
+        except ValueError:
+            with pytest.raises(ValueError):
+                table(value)
+            continue
+        assert table(value) == expected
+
+    assert table.batch(numpy.array(values)).tolist() == [rule(value) for value in values]
+
+
+def test_category_not_suitable():
+    table = CategoryTable([case(0, ('gt', 92)), case(5, ('lt', 88))])
+    for value in (88.5, float('nan')):
+        with pytest.raises(ValueError):
+            table(value)
+    with pytest.raises(ValueError):
+        table.batch(numpy.array([95, 88.5]))
+    with pytest.raises(ValueError):
+        table.batch(numpy.array([95, numpy.nan]))
+
+
+def test_compile_category():
+    assert isinstance(compile_category(SPO2), CategoryTable)
+    lookup = compile_category(SEA)
+    assert isinstance(lookup, CategoryLookup)
+    assert lookup(True) == 1 and lookup(False) == 0
+    assert lookup.batch([True, False, True]).tolist() == [1, 0, 1]
+    with pytest.raises(ValueError):
+        lookup("unknown")
+    assert isinstance(compile_category([case(1, ('gt', "a"))]), CategoryCases)
+
+
+def test_formula():
+    bmi = Formula("[weight]/([height]/100)/([height]/100)")
+    assert bmi.features == ("weight", "height")
+    assert bmi({"weight": 69, "height": 176}) == pytest.approx(22.275309917355372)
+    assert bmi.batch({"weight": numpy.array([69, 80]), "height": numpy.array([176, 200])}).tolist() == \
+        pytest.approx([22.275309917355372, 20])
+    assert Formula("-[a] ** 2 + 3 % [b]")({"a": 2, "b": 2}) == -3
+
+
+@pytest.mark.parametrize("formula", ["__import__('os').system('ls')", "[a].real", "[a] if [b] else 1", "[a] +",
+                                     "open", "[a] < [b]"])
+def test_formula_rejects(formula):
+    with pytest.raises(AttributeError):
+        Formula(formula)
+
+
+def test_transform_plan_checks_index():
+    style = {"a": {"type": "numeric", "index": 1, "rule": None}, "b": {"type": "numeric", "index": 3, "rule": None}}
+    with pytest.raises(IndexError):
+        TransformPlan(style)
@@ -0,0 +1,122 @@
+import json
+import threading
+
+import numpy
+import app as mocab_app
+from base.model_registry import model_registry
+
+
+class FakeEstimator:
+    def __init__(self):
+        self.calls = []
+
+    def predict_proba(self, rows):
+        rows = numpy.asarray(rows, dtype=float)
+        self.calls.append(rows.shape)
+        return numpy.stack([1 - rows[:, 0] / 10, rows[:, 0] / 10], axis=1)
+
+
+def nsti_data(sea):
+    return {"sea": {"date": None, "value": sea}, "wbc": {"date": None, "value": 4400},
+            "crp": {"date": None, "value": 0.5}, "seg": {"date": None, "value": 50.7},
+            "band": {"date": None, "value": 0}}
+
+
+def test_batch_scoring(monkeypatch):
+    estimator = FakeEstimator()
+    monkeypatch.setitem(model_registry._artifacts, "nsti", None)
+    model_registry.register("nsti", "./models/nsti/LR_model_NSTI_5fea", loader=lambda path: estimator)
+
+    def fake_models_feature_search_with_patient_id(patient_id, tables):
+        return {model: KeyError("no data of {}".format(patient_id)) for model in tables}
+
+    monkeypatch.setattr(mocab_app.ds, "models_feature_search_with_patient_id",
+                        fake_models_feature_search_with_patient_id)
+
+    client = mocab_app.app.test_client()
+    response = client.post("/batch", json=[
+        {"model": "nsti", "data": nsti_data(True)},
+        {"model": "nsti", "id": "test-03121002"},
+        {"model": "nsti", "data": nsti_data(False)},
+        {"model": "nsti", "data": {"sea": {"value": True}}},
+    ])
+    lines = sorted((json.loads(line) for line in response.get_data(as_text=True).splitlines()),
+                   key=lambda line: line["index"])
+
+    assert response.mimetype == "application/x-ndjson"
+    assert [line["index"] for line in lines] == [0, 1, 2, 3]
+    assert lines[0]["predict_value"] == 0.1 and lines[2]["predict_value"] == 0.0
+    assert "error" in lines[1] and "error" in lines[3]
+    assert estimator.calls == [(2, 5)]
+
+
+def register_fake_nsti(monkeypatch):
+    estimator = FakeEstimator()
+    monkeypatch.setitem(model_registry._artifacts, "nsti", None)
+    model_registry.register("nsti", "./models/nsti/LR_model_NSTI_5fea", loader=lambda path: estimator)
+    return estimator
+
+
+def test_batch_streams_items_as_they_are_ready(monkeypatch):
+    register_fake_nsti(monkeypatch)
+    searching = threading.Event()
+
+    def slow_models_feature_search_with_patient_id(patient_id, tables):
+        # The search only ends after the line of the data item was read
+        assert searching.wait(timeout=5)
+        return {model: nsti_data(True) for model in tables}
+
+    monkeypatch.setattr(mocab_app.ds, "models_feature_search_with_patient_id",
+                        slow_models_feature_search_with_patient_id)
+
+    client = mocab_app.app.test_client()
+    response = client.post("/batch", json=[{"model": "nsti", "id": "p1"}, {"model": "nsti", "data": nsti_data(False)}],
+                           buffered=False)
+    lines = iter(response.response)
+    assert json.loads(next(lines))["index"] == 1
+    searching.set()
+    assert [json.loads(line)["predict_value"] for line in lines] == [0.1]
+
+
+def test_batch_row_errors_do_not_fail_the_group(monkeypatch):
+    estimator = register_fake_nsti(monkeypatch)
+    monkeypatch.setitem(mocab_app.config['batch'], "PREDICT_ROWS", 2)
+
+    def fake_models_feature_search_with_patient_id(patient_id, tables):
+        data = nsti_data(True)
+        if patient_id == "missing-crp":
+            del data["crp"]
+        if patient_id == "unknown-sea":
+            data["sea"]["value"] = "unknown"
+        return {model: data for model in tables}
+
+    monkeypatch.setattr(mocab_app.ds, "models_feature_search_with_patient_id",
+                        fake_models_feature_search_with_patient_id)
+    monkeypatch.setitem(mocab_app.config['feature_search'], "MAX_WORKERS", 1)
+
+    client = mocab_app.app.test_client()
+    items = [{"model": "nsti", "data": nsti_data(i % 2 == 0)} for i in range(5)] + \
+        [{"model": "nsti", "id": "missing-crp"}, {"model": "nsti", "id": "unknown-sea"}, {"model": "nsti", "id": "p1"}]
+    response = client.post("/batch", json=items)
+    lines = {line["index"]: line for line in map(json.loads, response.get_data(as_text=True).splitlines())}
+
+    assert [lines[i]["predict_value"] for i in range(5)] == [0.1, 0.0, 0.1, 0.0, 0.1]
+    # The missing feature and the value the transformation doesn't know are errors of their own items
+    assert "crp" in lines[5]["error"] and "error" in lines[6]
+    assert lines[7]["predict_value"] == 0.1
+    # The data items are predicted in groups of at most 2 rows
+    assert estimator.calls[:3] == [(2, 5), (2, 5), (1, 5)]
+
+
+def test_return_model_results_predicts_rows_one_by_one_after_failure(monkeypatch):
+    estimator = register_fake_nsti(monkeypatch)
+    bad = nsti_data(True)
+    bad["sea"]["value"] = "unknown"
+    missing = nsti_data(True)
+    del missing["band"]
+
+    results = mocab_app.return_model_results([nsti_data(True), bad, missing, nsti_data(False)], "nsti")
+    assert results[0] == 0.1 and results[3] == 0.0
+    assert isinstance(results[1], ValueError) and isinstance(results[2], KeyError)
+    # The batch of three rows failed, then they were predicted one by one
+    assert estimator.calls == [(1, 5), (1, 5)]
@@ -1,2 +1,168 @@
+import time
+
+import pytest
+from base import patient_data_search as ds
+from base.cache import LRUCache
+
+
 def test_model_feature_search_with_patient_id():
     assert False
+
+
+def fake_get_patient_resources(patient_id, table, default_time, data_alive_time=None, client=None, source=None):
+    time.sleep(0.2)
+    if table['code'] == 'missing':
+        raise KeyError(table['code'])
+    return {'resource': table['code'], 'component_code': None, 'type': 'Observation'}
+
+
+def fake_get_resource_datetime_and_value(data, default_time):
+    return "2022-01-19T11:53", data['resource']
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_concurrent_feature_search(monkeypatch, max_workers):
+    monkeypatch.setattr(ds, "get_patient_resources", fake_get_patient_resources)
+    monkeypatch.setattr(ds, "get_resource_datetime_and_value", fake_get_resource_datetime_and_value)
+    table = {name: {'code': name} for name in ('glucose', 'insulin', 'weight', 'height')}
+
+    start = time.perf_counter()
+    result = ds.model_feature_search_with_patient_id("test-03121002", table, max_workers=max_workers,
+                                                     use_cache=False)
+    elapsed = time.perf_counter() - start
+
+    assert result == {name: {'date': "2022-01-19T11:53", 'value': name} for name in table}
+    if max_workers > 1:
+        assert elapsed < 0.6
+
+
+def test_concurrent_feature_search_raises(monkeypatch):
+    monkeypatch.setattr(ds, "get_patient_resources", fake_get_patient_resources)
+    monkeypatch.setattr(ds, "get_resource_datetime_and_value", fake_get_resource_datetime_and_value)
+    table = {name: {'code': name} for name in ('glucose', 'missing')}
+
+    with pytest.raises(KeyError):
+        ds.model_feature_search_with_patient_id("test-03121002", table, max_workers=4, use_cache=False)
+
+
+def test_concurrent_feature_search_deadline(monkeypatch):
+    def slow_get_patient_resources(patient_id, table, *args, **kwargs):
+        time.sleep(table['delay'])
+        return {'resource': table['code'], 'component_code': None, 'type': 'Observation'}
+
+    monkeypatch.setattr(ds, "get_patient_resources", slow_get_patient_resources)
+    monkeypatch.setattr(ds, "get_resource_datetime_and_value", fake_get_resource_datetime_and_value)
+    table = {name: {'code': name, 'delay': delay} for name, delay in (('glucose', 0.1), ('insulin', 0.6),
+                                                                      ('weight', 0.9))}
+
+    start = time.perf_counter()
+    result = ds._search_features("test-03121002", table, None, None, max_workers=3, timeout=0.4, client=None,
+                                 return_exceptions=True)
+    elapsed = time.perf_counter() - start
+
+    # The timeout is for the whole batch, every search still running at the deadline fails
+    assert result['glucose'] == {'date': "2022-01-19T11:53", 'value': 'glucose'}
+    assert isinstance(result['insulin'], ds.TimeoutError) and isinstance(result['weight'], ds.TimeoutError)
+    assert elapsed < 0.55
+
+
+def test_models_feature_search_shares_features(monkeypatch):
+    searched = []
+
+    def counting_get_patient_resources(patient_id, table, default_time, data_alive_time=None, client=None, source=None):
+        searched.append(table['code'])
+        return fake_get_patient_resources(patient_id, table, default_time, data_alive_time, client, source)
+
+    monkeypatch.setattr(ds, "get_patient_resources", counting_get_patient_resources)
+    monkeypatch.setattr(ds, "get_resource_datetime_and_value", fake_get_resource_datetime_and_value)
+
+    def feature(code):
+        return {'code': code, 'type_of_data': 'observation', 'data_alive_time': None, 'search_type': 'latest',
+                'default_value': None}
+
+    tables = {
+        'qcsi': {'spo2': feature('OA08'), 'respiratory_rate': feature('OA04')},
+        'rox': {'spo2': feature('OA08'), 'respiratory_rate': feature('OA04'), 'fio2': feature('3151-8')},
+        'broken': {'spo2': feature('OA08'), 'lactate': feature('missing')},
+    }
+    result = ds.models_feature_search_with_patient_id("test-03121002", tables, max_workers=4, use_cache=False)
+
+    assert sorted(searched) == ['3151-8', 'OA04', 'OA08', 'missing']
+    assert result['qcsi'] == {'spo2': {'date': "2022-01-19T11:53", 'value': 'OA08'},
+                              'respiratory_rate': {'date': "2022-01-19T11:53", 'value': 'OA04'}}
+    assert result['rox']['fio2']['value'] == '3151-8'
+    assert result['rox']['spo2'] is not result['qcsi']['spo2']
+    assert isinstance(result['broken'], KeyError)
+
+
+def test_feature_search_cache(monkeypatch):
+    searched = []
+
+    def counting_get_patient_resources(patient_id, table, default_time, data_alive_time=None, client=None, source=None):
+        searched.append(table['code'])
+        return fake_get_patient_resources(patient_id, table, default_time, data_alive_time, client, source)
+
+    monkeypatch.setattr(ds, "get_patient_resources", counting_get_patient_resources)
+    monkeypatch.setattr(ds, "get_resource_datetime_and_value", fake_get_resource_datetime_and_value)
+    monkeypatch.setattr(ds, "feature_cache", LRUCache(maxsize=16, ttl=60))
+    table = {name: {'code': name, 'type_of_data': 'observation', 'data_alive_time': None, 'search_type': 'latest'}
+             for name in ('glucose', 'insulin')}
+
+    first = ds.model_feature_search_with_patient_id("test-03121002", table)
+    first['glucose']['value'] = 'changed by the model'
+    second = ds.model_feature_search_with_patient_id("test-03121002", table)
+
+    assert second == {name: {'date': "2022-01-19T11:53", 'value': name} for name in table}
+    assert sorted(searched) == ['glucose', 'insulin']
+    assert ds.feature_cache.stats()['hits'] == 2
+
+    ds.feature_cache.invalidate(patient_id="test-03121002")
+    ds.model_feature_search_with_patient_id("test-03121002", table)
+    assert len(searched) == 4
+
+
+def test_feature_search_cache_per_authorization(monkeypatch):
+    from base.fhir_client_pool import _FHIRClientPool
+
+    searched = []
+
+    def counting_get_patient_resources(patient_id, table, default_time, data_alive_time=None, client=None, source=None):
+        searched.append(client.authorization)
+        return fake_get_patient_resources(patient_id, table, default_time, data_alive_time, client, source)
+
+    monkeypatch.setattr(ds, "get_patient_resources", counting_get_patient_resources)
+    monkeypatch.setattr(ds, "get_resource_datetime_and_value", fake_get_resource_datetime_and_value)
+    monkeypatch.setattr(ds, "feature_cache", LRUCache(maxsize=16, ttl=60))
+    table = {'glucose': {'code': 'glucose', 'type_of_data': 'observation', 'data_alive_time': None,
+                         'search_type': 'latest'}}
+    pool = _FHIRClientPool()
+    clients = [pool.get_client("http://fhir", "Bearer a"), pool.get_client("http://fhir", "Bearer b"),
+               pool.get_client("http://fhir"), pool.get_client("http://fhir", "Bearer a")]
+    for client in clients:
+        ds.model_feature_search_with_patient_id("p1", table, client=client)
+
+    # The tokens of the same server don't share the cached results
+    assert searched == ["Bearer a", "Bearer b", None]
+    assert ds.feature_cache.stats()['hits'] == 1
+    # The key holds a digest of the Authorization header, not the token
+    assert not any("Bearer" in str(part) for key in ds.feature_cache._data for part in key)
+    pool.close()
+
+
+def test_window_features_share_the_search():
+    from tests.fhir_stub import StubFHIRClient
+    from tests.functions.test_search_sets import GLUCOSE
+    from tests.functions.test_search_sets import feature
+
+    client = StubFHIRClient(GLUCOSE, page_size=100)
+    table = {'glucose_mean': feature("72-314", "mean"), 'glucose_count': feature("72-314", "count"),
+             'glucose_max': feature("72-314", "max"), 'glucose_trend': feature("72-314", "slope"),
+             'fio2_count': feature("3151-8", "count")}
+    result = ds.model_feature_search_with_patient_id("p1", table, max_workers=1, client=client, use_cache=False)
+
+    assert {name: value['value'] for name, value in result.items()} == {
+        'glucose_mean': pytest.approx(110), 'glucose_count': 19, 'glucose_max': 119,
+        'glucose_trend': pytest.approx(1), 'fio2_count': 0}
+    # The window features of 72-314 share one search, max and the count of 3151-8 are searched by themselves
+    assert sorted(params.get('_sort', [''])[0] for _, params in client.requests) == \
+        ['-date', '-date', '-value-quantity']